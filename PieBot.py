@@ -1,252 +1,396 @@
 from functions import *
-import argparse
+import contextlib
 import gc
-import schedule
 import signal
-from prometheus_client import start_http_server, Gauge, Enum
-
-pre_flight_checks()
-balance = Gauge('coin_balance', 'The amount of coins', ['coin', 'account'])
-price = Gauge('coin_price', 'The price of a coin in USDT', ['coin', 'account'])
-state = Enum('coin_state', 'The management state of a coin', ['coin', 'account'], states=['managed', 'unmanaged']) # managed, unmanaged
-
+import health
+
+# Only the config file is checked when PieBot is loaded, the connections to the exchange are checked by main()
+trading_accounts = check_config()
+# Serves the coin metrics from the latest snapshots, which the tasks share with it. The metrics are only served
+# in production and on paper, a task run by hand in dev mode doesn't need prometheus_client
+collector = None
+if executes_orders():
+    from prometheus_client import REGISTRY
+    import exporter
+    collector = exporter.SnapshotCollector()
+    REGISTRY.register(collector)
+# What the health endpoints report
+bot_state = health.BotState(trading_accounts, collector)
+# Profiles the next cycles and traces the memory on demand, once main() has started it, see debug_port
+debug = None
 
 
 # Hard codes the minimum order value
 min_order_value = 0.25
 
-# Checks whether the Rebalance threshold has been defined, and allows the bot to run if it hasn't
-try:
-    rebalance_threshold
-except NameError:
-    rebalance_threshold = None
-
-if rebalance_threshold is None:
-    uses_threshold = False
-else:
-    if rebalance_threshold > 0:
-        uses_threshold = True
-    else:
-        uses_threshold = False
+
+# Records snapshots and orders in the state file of each account, if it has one
+def open_state_files():
+    for account in trading_accounts:
+        if account.state_file and account.history is None:
+            import sqlite3
+            import store
+            try:
+                account.history = store.Store(account.state_file, account.name)
+            except (sqlite3.Error, OSError) as error:
+                print(colored(account_message(account, "The state file {} can't be opened: {}".format(account.state_file, error)), "red"))
+                sys.exit()
+
+
+# Gets the account a task runs for, the first one if it isn't given
+def task_account(account):
+    return trading_accounts[0] if account is None else account
+
+
+# Prints the name of a task, with the account it runs for when there are several
+def print_task(title, account):
+    if len(trading_accounts) > 1:
+        title += " (" + account.name + ")"
+    print(colored(title, "yellow"))
+
+
+# Prints the outcome of each order
+def print_orders(results):
+    for result in results:
+        order = result.order
+        print_value = round(order.value, 2)
+        current_time(True)
+        print(str(print_value) + " USDT - " + order.coin, end=" ")
+        if order.side == "BUY":
+            print(colored("[BUY]", "green"))
+        else:
+            print(colored("[SELL]", "magenta"))
+
+        if not result.confirmed:
+            print(result.status_code, result.reason)
+            print(result.content)
+        elif result.fill and result.fill.status != "FILLED":
+            print(colored("Order {} is {} after filling {} at {}".format(result.order_id, result.fill.status, result.fill.quantity, result.fill.avg_price), "yellow"))
+
+
+# Hands a new snapshot of an account to the coin metrics, and to the drift monitor of the account
+def snapshot_taken(account, snapshot):
+    if collector is not None:
+        collector.observe(account, snapshot)
+    if account.drift is not None:
+        account.drift.observe(snapshot)
+
+
+# Places the orders of an account, then prints and records their outcome.
+# The fills are waited for when track is set and track_fills is on, or for every order with track_fills = "all"
+def place_orders(task, orders, account, track=False):
+    if account.history:
+        account.history.record_plan(task, orders)
+    key = bot_state.orders_sent(task, account.name, orders)
+    try:
+        with metrics.phase(task, "submit", account.name):
+            results = account.dispatcher.submit(orders, dry_run=not executes_orders())
+        if (track_fills == "all" or (track and track_fills)) and executes_orders():
+            with metrics.phase(task, "track", account.name):
+                results = account.tracker.wait(results)
+    finally:
+        bot_state.orders_done(key)
+    # Only the orders whose fills were followed have a fill price
+    metrics.observe_fills(results, account.name)
+    print_orders(results)
+    if account.history:
+        account.history.record_orders(task, results)
+    return results
 
 
 # Buy more coins at a regular interval
-def buy(pairs):
+def buy(pairs, account=None):
+    account = task_account(account)
+    started = time.perf_counter()
+
     # Let users know the bot has been called and is running
     print()
     current_time(True)
-    print(colored("Buy", "yellow"))
+    print_task("Buy", account)
     print(colored("Placing orders...", "cyan"))
 
-    total_portfolio_value = get_portfolio_value(pairs, True)
-    total_usdt_reserve = (total_portfolio_value / 100) * (usdt_reserve * 100)
-
-    total_usdt_value = get_coin_balance("USDT")
-    total_usdt_available = total_usdt_value - total_usdt_reserve
-    required_usdt = buy_order_value * len(pairs)
+    with metrics.phase("buy", "fetch", account.name):
+        snapshot = get_snapshot(pairs, account)
+    snapshot_taken(account, snapshot)
+    if account.history:
+        account.history.record_snapshot(snapshot, pairs)
+    total_usdt_available = snapshot.available_usdt(pairs, account.usdt_reserve)
+    required_usdt = account.buy_order_value * len(pairs)
 
     if required_usdt <= total_usdt_available:
-        for pair in pairs:
-            order_value = buy_order_value
-
-            if environment == "production":
-                order_confirmed = False
-                order = order_buy(pair[1], order_value)
-                time.sleep(0.1)
-                if order.status_code == 200:
-                    order_confirmed = True
-
-                print_value = round(order_value, 2)
-                current_time(True)
-                print(str(print_value) + " USDT - " + pair[0], end=" ")
-                print(colored("[BUY]", "green"))
-
-                if not order_confirmed:
-                    print(order.status_code, order.reason)
-                    print(order.content)
-
-            else:
-                print_value = round(order_value, 2)
-                current_time(True)
-                print(str(print_value) + " USDT - " + pair[0], end=" ")
-                print(colored("[BUY]", "green"))
+        with metrics.phase("buy", "plan", account.name):
+            orders = plan_buy(pairs, account.buy_order_value, prices=snapshot.prices)
+        place_orders("buy", orders, account)
 
     else:
         print(colored("Not enough USDT available (have {}, need {})".format(total_usdt_available, required_usdt), "yellow"))
-    total_portfolio_value = get_portfolio_value(pairs, True)
-    print("Total portfolio value is {:.4f}USDT ({:.4f}stable)".format(total_portfolio_value, total_usdt_value))
+    if executes_orders() and required_usdt <= total_usdt_available:
+        # The orders have changed the balances
+        with metrics.phase("buy", "refresh", account.name):
+            snapshot = PortfolioSnapshot.fetch(exchange=account.client)
+        snapshot_taken(account, snapshot)
+    print("Total portfolio value is {:.4f}USDT ({:.4f}stable)".format(snapshot.portfolio_value(pairs, True), snapshot.balance("USDT")))
 
     gc.collect()
+    metrics.task_finished("buy", account.name, started)
 
     print(colored("Waiting to be called...", "cyan"))
 
 
-# Rebalance all coins so they are on target
-def rebalance(pairs):
+# Rebalance all coins so they are on target. With max_orders, only the coins furthest from their target are rebalanced.
+# Returns the number of orders placed
+def rebalance(pairs, account=None, max_orders=None):
+    account = task_account(account)
+    started = time.perf_counter()
+
     # Let users know the bot has been called and is running
     print()
     current_time(True)
-    print(colored("Rebalance", "yellow"))
+    print_task("Rebalance", account)
     print(colored("Placing orders...", "cyan"))
 
-    order_data = []
-    total_portfolio_value = 0
-
-    for pair in pairs:
-        coin_balance, balance_error = get_coin_balance(pair[0])
-        coin_price, price_error = get_coin_price(pair[1])
-        if balance_error or price_error:
-            # maybe this pair was removed from crypto.com
-            print(f"Please check if {pair} really exists")
-            continue
-        pair_value = coin_balance * coin_price
-
-        order_data.append([pair[0], pair[1], coin_price, pair_value])
-        total_portfolio_value += pair_value
-
-    # Equally divide the balance by the number of coins, so we know the target value each coin should aim for
-    target_per_coin = total_portfolio_value / len(pairs)
-    print("target_per_coin is {}".format(target_per_coin))
-
-    buy_orders_data = []
-    sell_orders_data = []
-
-    for pair in order_data:
-        coin_price = pair[2]
-        pair_value = pair[3]
-
-        # The coin value is over target
-        if pair_value > target_per_coin:
-            difference = pair_value - target_per_coin
-
-            if difference >= min_order_value:
-                if uses_threshold:
-                    difference_percentage = (((pair_value - target_per_coin) / target_per_coin) * 100)
-                    print("difference+ of {} is {:.2f} ({:.2f}%)".format(pair[0], difference, difference_percentage))
-
-                    if difference_percentage >= (rebalance_threshold * 100):
-                        order_value = difference / coin_price
-                        sell_orders_data.append([pair[0], pair[1], order_value, difference])
-
-                else:
-                    order_value = difference / coin_price
-                    sell_orders_data.append([pair[0], pair[1], order_value, difference])
-
-        # The coin value is under target
-        elif pair_value < target_per_coin:
-            difference = target_per_coin - pair_value
-
-            if difference >= min_order_value:
-                if uses_threshold:
-                    difference_percentage = 100 if pair_value == 0 else (((target_per_coin - pair_value) / pair_value) * 100)
-                    print("difference- of {} is {:.2f} ({:.2f}%)".format(pair[0], difference, difference_percentage))
-
-                    if difference_percentage >= (rebalance_threshold * 100):
-                        order_value = difference
-                        buy_orders_data.append([pair[0], pair[1], order_value, difference])
-
-                else:
-                    order_value = difference
-                    buy_orders_data.append([pair[0], pair[1], order_value, difference])
-
-    if len(sell_orders_data) >= 1:
-        for order in sell_orders_data:
-            if environment == "production":
-                order_confirmed = False
-                order_request = order_sell(order[1], order[2])
-                time.sleep(0.1)
-                if order_request.status_code == 200:
-                    order_confirmed = True
-
-                print_value = round(order[3], 2)
-                current_time(True)
-                print(str(print_value) + " USDT - " + order[0], end=" ")
-                print(colored("[SELL]", "magenta"))
-
-                if not order_confirmed:
-                    print(order_request.status_code, order_request.reason)
-                    print(order_request.content)
-
-            else:
-                print_value = round(order[3], 2)
-                current_time(True)
-                print(str(print_value) + " USDT - " + order[0], end=" ")
-                print(colored("[SELL]", "magenta"))
-
-    if len(buy_orders_data) >= 1:
-        for order in buy_orders_data:
-            if environment == "production":
-                order_confirmed = False
-                order_request = order_buy(order[1], order[2])
-                time.sleep(0.1)
-                if order_request.status_code == 200:
-                    order_confirmed = True
-
-                print_value = round(order[3], 2)
-                current_time(True)
-                print(str(print_value) + " USDT - " + order[0], end=" ")
-                print(colored("[BUY]", "green"))
-
-                if not order_confirmed:
-                    print(order_request.status_code, order_request.reason)
-                    print(order_request.content)
-
-            else:
-                print_value = round(order[3], 2)
-                current_time(True)
-                print(str(print_value) + " USDT - " + order[0], end=" ")
-                print(colored("[BUY]", "green"))
-
-    total_orders = len(sell_orders_data) + len(buy_orders_data)
+    with metrics.phase("rebalance", "fetch", account.name):
+        snapshot = get_snapshot(pairs, account)
+    snapshot_taken(account, snapshot)
+    if account.history:
+        account.history.record_snapshot(snapshot, pairs)
+    with metrics.phase("rebalance", "plan", account.name):
+        plan = plan_rebalance(pairs, snapshot.balances, snapshot.prices, get_precisions(pairs), account.rebalance_threshold, min_order_value)
+        sells, buys = limit_orders(plan.sells, plan.buys, max_orders)
+        if len(sells) + len(buys) < len(plan.sells) + len(plan.buys):
+            print(colored("Only the {} orders of the coins furthest from their target are placed".format(max_orders), "yellow"))
+        plan = plan._replace(sells=sells, buys=buys)
+
+    for pair in plan.skipped:
+        # maybe this pair was removed from crypto.com
+        print(f"Please check if {pair} really exists")
+
+    print("target_per_coin is {}".format(plan.target_per_coin))
+    if account.uses_threshold():
+        for deviation in plan.deviations:
+            print("difference{} of {} is {:.2f} ({:.2f}%)".format(deviation.side, deviation.coin, deviation.difference, deviation.percentage))
+
+    # All sell orders are finished before the buy orders start, so their USDT is available
+    place_orders("rebalance", plan.sells, account, track=bool(plan.buys))
+    buys = plan.buys
+    if plan.sells and buys and track_fills and executes_orders():
+        # The sells have been filled, so the USDT they brought in can be counted on instead of the reserve
+        with metrics.phase("rebalance", "settle", account.name):
+            settled = PortfolioSnapshot.fetch(exchange=account.client)
+            buys = fit_to_budget(buys, settled.balance("USDT"), get_precisions(pairs), min_order_value)
+        if buys != plan.buys:
+            current_time(True)
+            print(colored("Not enough USDT for all buy orders, they are reduced to the {:.2f} USDT available".format(settled.balance("USDT")), "yellow"))
+    place_orders("rebalance", buys, account)
+
+    total_orders = len(plan.sells) + len(buys)
     if total_orders == 0:
         current_time(True)
         print(colored("No coins were eligible to be rebalanced", "yellow"))
 
-    del order_data
-    del buy_orders_data
-    del sell_orders_data
-    total_portfolio_value = get_portfolio_value(pairs, True)
+    del plan
+    if executes_orders() and total_orders > 0:
+        # The orders have changed the balances
+        with metrics.phase("rebalance", "refresh", account.name):
+            snapshot = PortfolioSnapshot.fetch(exchange=account.client)
+        snapshot_taken(account, snapshot)
+    total_portfolio_value = snapshot.portfolio_value(pairs, True)
     print("Total portfolio value is {:.4f}USDT".format(total_portfolio_value))
     gc.collect()
+    metrics.task_finished("rebalance", account.name, started)
 
     print(colored("Waiting to be called...", "cyan"))
+    return total_orders
 
 
-def update_exporter(pairs):
-    pairs = get_account_details()
-    for pair in pairs:
-        balance.labels(pair["coin"], pair["account"]).set(pair["balance"])
-        price.labels(pair["coin"], pair["account"]).set(pair["price"])
-        state.labels(pair["coin"], pair["account"]).state(pair["state"])
+# Takes a new snapshot for the coin metrics, while the tasks haven't taken one for a while
+def update_exporter(pairs, snapshot=None, account=None):
+    account = task_account(account)
+    started = time.perf_counter()
+    if snapshot is None:
+        snapshot = get_snapshot(pairs, account)
+    if account.history:
+        account.history.record_snapshot(snapshot, pairs)
+    snapshot_taken(account, snapshot)
+    metrics.task_finished("update_exporter", account.name, started)
 
 
-if environment == "production":
-    print(colored("Waiting to be called...", "cyan"))
+# Profiles the cycle of a task and compares its memory while the diagnostics are running
+def debug_cycle(task, account):
+    if debug is None:
+        return contextlib.nullcontext()
+    return debug.cycle(task.__name__, account.name)
+
+
+# Runs a task for one account and returns what it returns, options being passed on to the task.
+# A task that fails is reported, and doesn't affect the other accounts
+def run_task(task, account, trading=True, **options):
+    if not account.ready.is_set():
+        current_time(True)
+        print(colored("{} of {} is skipped, the pre-flight checks of the account haven't passed yet".format(task.__name__, account.name), "yellow"))
+        return
+
+    try:
+        if trading:
+            # Buy and Rebalance of an account never place orders at the same time
+            with account.trading_lock, debug_cycle(task, account):
+                result = task(account.pair_list, account=account, **options)
+        else:
+            result = task(account.pair_list, account=account, **options)
+    except CircuitOpenError as error:
+        # The exchange is failing, the task is skipped until the next cycle instead of waiting for it
+        bot_state.error(task.__name__, account.name, error)
+        current_time(True)
+        print(colored("{} of {} is skipped: {}".format(task.__name__, account.name, error), "yellow"))
+    except Exception as error:
+        bot_state.error(task.__name__, account.name, error)
+        current_time(True)
+        print(colored("{} of {} failed: {!r}".format(task.__name__, account.name, error), "red"))
+    else:
+        bot_state.succeeded(task.__name__, account.name)
+        return result
+
+
+# Starts a task for one account in a thread of its own, so the tasks of all accounts run at the same time
+def start_task(task, account, trading=True):
+    threading.Thread(target=run_task, args=(task, account, trading), name="{}-{}".format(task.__name__, account.name)).start()
+
+
+# Starts a Rebalance of up to max_orders orders for an account whose coins drifted past the threshold,
+# and tells the drift monitor when it is done
+def rebalance_on_drift(account, coins, max_orders):
+    current_time(True)
+    print(colored(account_message(account, "{} drifted past the rebalance threshold".format(", ".join(coins))), "yellow"))
+
+    def run():
+        orders = 0
+        try:
+            orders = run_task(rebalance, account, max_orders=max_orders) or 0
+        finally:
+            account.drift.finished(orders)
+
+    threading.Thread(target=run, name="rebalance-{}".format(account.name)).start()
+
+
+# Starts a drift monitor for every account that rebalances on drift
+def start_drift_monitors():
+    monitors = []
+    for account in trading_accounts:
+        if account.drift_rebalance:
+            import drift
+            account.drift = drift.DriftMonitor(account, rebalance_on_drift, drift_cooldown, drift_max_orders, drift_window, min_order_value)
+            monitors.append(account.drift)
+    if monitors:
+        drift.start(monitors, drift_interval)
+
+
+# Refreshes the coin metrics of an account, once it is ready. Until then, the pre-flight checks provide the first snapshot
+def refresh_metrics(account):
+    if account.ready.is_set():
+        run_task(update_exporter, account, trading=False)
+
+
+# Hands a snapshot taken for the coin metrics to the exporter
+def update_metrics(account, snapshot):
+    run_task(update_exporter, account, trading=False, snapshot=snapshot)
+
+
+# The next run of every job of the schedule runtime
+def scheduled_jobs():
+    import schedule
+    return [{"job": "{} {}".format(job.job_func.args[0].__name__, job.job_func.args[1].name), "next_run": job.next_run.timestamp()}
+            for job in list(schedule.jobs)]
+
+
+# Serves the /debug endpoints and profiles the cycles on a signal, see debug_port
+def start_diagnostics():
+    global debug
+    import diagnostics
+    from prometheus_client import REGISTRY
 
-    if rebalance_frequency > 0:
-        schedule.every(rebalance_frequency).hours.at(":00").do(rebalance, pairs=pair_list)
+    debug = diagnostics.Diagnostics(profile_dir)
+    REGISTRY.register(debug)
+    health.serve_debug(debug, debug_port)
+    debug.handle_signals(lambda message: print(colored(message, "cyan")))
 
 
-    schedule.every(buy_frequency).hours.at(":30").do(buy, pairs=pair_list)
+# Runs PieBot. In production the metrics are served straight away, while the accounts are checked in the background
+def main():
+    open_state_files()
 
-    schedule.every(5).minutes.do(update_exporter, pairs=pair_list)
+    if executes_orders():
+        health.serve(bot_state, 19000)
+        if debug_port:
+            start_diagnostics()
+        print(colored("Performing pre-flight checks...", "cyan"))
+        start_drift_monitors()
+        connect_in_background(trading_accounts, on_ready=snapshot_taken)
+        print(colored("Waiting to be called...", "cyan"))
 
-    start_http_server(19000)
-    stop = StopSignal()
+        # The balance stream would show the exchange's balances instead of the ledger's
+        if streaming and environment == "production":
+            import stream
+            stream.start(sorted({pair for account in trading_accounts for pair in account.pair_list}))
 
-    while not stop.stop_now:
-        schedule.run_pending()
-        time.sleep(1)
+        if runtime == "asyncio":
+            import asyncruntime
 
-else:
-    parser = argparse.ArgumentParser()
-    parser.add_argument("task")
-    args = parser.parse_args()
-    if (args.task == "buy") or (args.task == "Buy"):
-        buy(pairs=pair_list)
+            # The coin metrics are refreshed in the event loop, with the requests of all accounts at the same time
+            jobs = [asyncruntime.Job("Metrics", asyncruntime.refresh_snapshots,
+                                     {"accounts": trading_accounts, "age": collector.age, "refresh": update_metrics, "max_age": exporter_interval},
+                                     min(exporter_interval, 10), None, None)]
+            for account in trading_accounts:
+                jobs.append(asyncruntime.Job("Buy " + account.name, asyncruntime.in_thread(run_task), {"task": buy, "account": account}, account.buy_frequency * 3600, 30, account.name))
+                if account.rebalance_frequency > 0 and not account.drift_rebalance:
+                    jobs.append(asyncruntime.Job("Rebalance " + account.name, asyncruntime.in_thread(run_task), {"task": rebalance, "account": account}, account.rebalance_frequency * 3600, 0, account.name))
 
-    elif (args.task == "rebalance") or (args.task == "Rebalance"):
-        rebalance(pairs=pair_list)
+            bot_state.jobs = asyncruntime.next_runs
+            asyncruntime.run(jobs, heartbeat=bot_state.beat)
+
+        else:
+            import schedule
+
+            collector.start(trading_accounts, refresh_metrics, exporter_interval)
+            for account in trading_accounts:
+                if account.rebalance_frequency > 0 and not account.drift_rebalance:
+                    schedule.every(account.rebalance_frequency).hours.at(":00").do(start_task, rebalance, account)
+
+
+                schedule.every(account.buy_frequency).hours.at(":30").do(start_task, buy, account)
+
+            bot_state.jobs = scheduled_jobs
+            stop = StopSignal()
+
+            while not stop.stop_now:
+                schedule.run_pending()
+                bot_state.beat()
+                time.sleep(1)
 
     else:
-        print(colored("Please specify which task you want to run", "red"))
+        import argparse
+
+        parser = argparse.ArgumentParser()
+        parser.add_argument("task")
+        parser.add_argument("--account", help="Only run the task for this account")
+        args = parser.parse_args()
+        selected = [account for account in trading_accounts if args.account in (None, account.name)]
+        if not selected:
+            print(colored("There is no account called {}".format(args.account), "red"))
+            return
+        selected = pre_flight_checks(selected)
+
+        if (args.task == "buy") or (args.task == "Buy"):
+            for account in selected:
+                run_task(buy, account)
+
+        elif (args.task == "rebalance") or (args.task == "Rebalance"):
+            for account in selected:
+                run_task(rebalance, account)
+
+        else:
+            print(colored("Please specify which task you want to run", "red"))
+
+
+# Runs the tasks when PieBot is started, and nothing when it is imported, e.g. by benchmark.py
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+import asyncio
+from collections import namedtuple
+from functions import *
+
+
+# A task that runs every interval seconds. With at_minute, the first run waits for that minute of the hour.
+# Jobs with the same trading key, e.g. the Buy and Rebalance of one account, never run at the same time
+Job = namedtuple("Job", ["name", "function", "kwargs", "interval", "at_minute", "trading"])
+
+
+# When every job runs next, as seconds since the epoch
+scheduled = {}
+
+
+# The next run of every job, for the health endpoints
+def next_runs():
+    return [{"job": name, "next_run": at} for name, at in sorted(scheduled.items())]
+
+
+# Runs the blocking exchange client in worker threads, so a slow response doesn't hold up the event loop
+class AsyncExchangeClient:
+    def __init__(self, exchange_client):
+        self.client = exchange_client
+
+    async def public(self, method, params=None, timeout=None):
+        return await asyncio.to_thread(self.client.public, method, params, timeout)
+
+    async def private(self, method, params=None, request_id=100, timeout=None):
+        return await asyncio.to_thread(self.client.private, method, params, request_id, timeout)
+
+    # Asks for the balances and the tickers at the same time
+    async def snapshot(self):
+        balance_response, ticker_data = await asyncio.gather(
+            self.private("private/user-balance"),
+            asyncio.to_thread(tickers.get))
+        balance_response.raise_for_status()
+
+        return PortfolioSnapshot.from_data(balance_response.json(), ticker_data)
+
+
+# Gets a snapshot of an account from the streaming feed while it is fresh, like get_snapshot(), otherwise from the REST API
+async def fetch_snapshot(account):
+    if account.client is client:
+        snapshot = get_streamed_snapshot(account.pair_list)
+        if snapshot is not None:
+            return snapshot
+    return await AsyncExchangeClient(account.client).snapshot()
+
+
+# Takes a new snapshot of every ready account whose snapshot is older than max_age seconds, all at the same time,
+# and hands each to refresh(account, snapshot)
+async def refresh_snapshots(accounts, age, refresh, max_age):
+    stale = [account for account in accounts if account.ready.is_set() and age(account) >= max_age]
+    snapshots = await asyncio.gather(*(fetch_snapshot(account) for account in stale), return_exceptions=True)
+    for account, snapshot in zip(stale, snapshots):
+        if isinstance(snapshot, Exception):
+            current_time(True)
+            print(colored("Refreshing the metrics of {} failed: {!r}".format(account.name, snapshot), "red"))
+        else:
+            await asyncio.to_thread(refresh, account, snapshot)
+
+
+# Turns a blocking function into a job function, which runs it in a worker thread
+def in_thread(function):
+    async def run(**kwargs):
+        await asyncio.to_thread(function, **kwargs)
+    return run
+
+
+# Gets the number of seconds until the clock next shows the given minute
+def seconds_until_minute(minute):
+    now = time.time()
+    local = time.localtime(now)
+    wait = (minute - local.tm_min) * 60 - local.tm_sec - (now % 1)
+    if wait <= 0:
+        wait += 3600
+    return wait
+
+
+# Runs a job on its own timer until it is cancelled
+async def run_every(job, trading_locks):
+    if job.at_minute is not None:
+        wait = seconds_until_minute(job.at_minute)
+    else:
+        wait = job.interval
+    scheduled[job.name] = time.time() + wait
+    await asyncio.sleep(wait)
+
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        try:
+            if job.trading:
+                # Buy and Rebalance never place orders at the same time, but they don't hold up anything else
+                async with trading_locks[job.trading]:
+                    await job.function(**job.kwargs)
+            else:
+                await job.function(**job.kwargs)
+        except asyncio.CancelledError:
+            raise
+        except Exception as error:
+            current_time(True)
+            print(colored("{} failed: {!r}".format(job.name, error), "red"))
+
+        wait = max(0, job.interval - (loop.time() - started))
+        scheduled[job.name] = time.time() + wait
+        await asyncio.sleep(wait)
+
+
+# Calls heartbeat every second, for as long as the event loop isn't blocked
+async def beat(heartbeat):
+    while True:
+        heartbeat()
+        await asyncio.sleep(1)
+
+
+# Runs all jobs as independent tasks until PieBot is asked to stop
+async def main(jobs, heartbeat=None):
+    loop = asyncio.get_running_loop()
+    stopped = asyncio.Event()
+    StopSignal(on_stop=lambda: loop.call_soon_threadsafe(stopped.set))
+
+    trading_locks = {job.trading: asyncio.Lock() for job in jobs if job.trading}
+    tasks = [asyncio.create_task(run_every(job, trading_locks), name=job.name) for job in jobs]
+    if heartbeat:
+        tasks.append(asyncio.create_task(beat(heartbeat), name="Heartbeat"))
+
+    await stopped.wait()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+# Starts the asyncio runtime. A job that is running in a thread when PieBot stops is allowed to finish
+def run(jobs, heartbeat=None):
+    asyncio.run(main(jobs, heartbeat))
@@ -0,0 +1,224 @@
+import argparse
+import json
+import os
+import time
+from collections import namedtuple
+
+import numpy as np
+
+from planner import available_usdt, fit_to_budget, plan_buy, plan_rebalance
+
+# Replays historical candles through PieBot's Buy and Rebalance rules, to evaluate settings without trading live.
+# Every file in the data directory holds the candles of one coin pair, e.g. candles/BTC_USDT.csv with the columns
+# timestamp,open,high,low,close,volume. Parquet files need the pyarrow Pip package.
+#
+#   python3 backtest.py --data candles --usdt 1000 --rebalance-threshold 0.03 --output curve.csv
+
+# Hard codes the minimum order value, like PieBot does
+min_order_value = 0.25
+
+# The settings from _config.py that decide when and how much PieBot trades
+Settings = namedtuple("Settings", ["buy_order_value", "buy_frequency", "rebalance_frequency", "rebalance_threshold", "usdt_reserve"])
+
+# The outcome of a backtest. values and usdt are curves with one entry per candle
+Result = namedtuple("Result", ["values", "usdt", "turnover", "fees", "orders", "final_value", "max_drawdown"])
+
+
+# Reads the close prices of one pair, sorted by time
+def load_pair(path):
+    if path.endswith(".parquet"):
+        import pyarrow.parquet
+        table = pyarrow.parquet.read_table(path, columns=["timestamp", "close"])
+        timestamps = table.column("timestamp").to_numpy().astype(np.int64)
+        close = table.column("close").to_numpy().astype(np.float64)
+    else:
+        with open(path) as candles:
+            header = candles.readline().strip().split(",")
+        data = np.loadtxt(path, delimiter=",", skiprows=1, usecols=(header.index("timestamp"), header.index("close")), ndmin=2)
+        timestamps = data[:, 0].astype(np.int64)
+        close = data[:, 1]
+
+    # Timestamps in milliseconds are turned into seconds
+    if len(timestamps) and timestamps[0] > 10 ** 11:
+        timestamps = timestamps // 1000
+
+    order = np.argsort(timestamps, kind="stable")
+    return timestamps[order], close[order]
+
+
+# Loads all pairs and keeps the candles every pair has, so the prices form one matrix of time steps x pairs
+def load_candles(directory, pairs=None):
+    files = {}
+    for name in sorted(os.listdir(directory)):
+        pair, extension = os.path.splitext(name)
+        if extension in (".csv", ".parquet") and (pairs is None or pair in pairs):
+            files[pair] = os.path.join(directory, name)
+    if not files:
+        raise ValueError("No candle files found in " + directory)
+
+    loaded = {pair: load_pair(path) for pair, path in files.items()}
+    timestamps = None
+    for pair_timestamps, close in loaded.values():
+        timestamps = pair_timestamps if timestamps is None else np.intersect1d(timestamps, pair_timestamps, assume_unique=True)
+
+    close = np.empty((len(timestamps), len(loaded)), dtype=np.float64)
+    for column, (pair_timestamps, pair_close) in enumerate(loaded.values()):
+        close[:, column] = pair_close[np.searchsorted(pair_timestamps, timestamps)]
+
+    return timestamps, list(loaded), close
+
+
+# Reads the (quote_decimals, quantity_decimals) of the pairs from a file of the exchange's instruments, like the
+# instrument_cache_file of _config.py, keyed by the pair's column as simulate() expects them. A USDT pair
+# the exchange only lists against USD uses the precisions of that pair, like PieBot does
+def load_precisions(path, pairs):
+    with open(path) as file:
+        instruments = json.load(file)
+    if isinstance(instruments, dict):
+        # A saved public/get-instruments response
+        instruments = instruments["result"]["data"]
+    by_symbol = {instrument["symbol"]: instrument for instrument in instruments}
+
+    precisions = {}
+    for column, pair in enumerate(pairs):
+        details = by_symbol.get(pair) or by_symbol.get(pair.replace("USDT", "USD"))
+        if details is not None:
+            precisions[column] = (details["quote_decimals"], details["quantity_decimals"])
+    return precisions
+
+
+# Gets the number of candles between two runs of a task
+def steps_between(hours, interval):
+    if hours <= 0:
+        return 0
+    return max(1, int(round(hours * 3600 / interval)))
+
+
+# Plans the Rebalance of one moment with the planner's rules, like rebalance() in PieBot.py. The planner sees
+# every column of the price matrix as a coin and pair of its own, named by its index, so precisions maps a column
+# to its (quote_decimals, quantity_decimals)
+def rebalance_orders(holdings, prices, rebalance_threshold, precisions=None):
+    columns = range(len(prices))
+    return plan_rebalance([(column, column) for column in columns], dict(zip(columns, holdings.tolist())), dict(zip(columns, prices.tolist())),
+                          precisions, rebalance_threshold, min_order_value)
+
+
+# Replays the candles. The holdings only change when a task runs, so the loop visits those candles only,
+# and the value curve is computed for all candles at once at the end
+def simulate(close, settings, start_usdt, interval=3600, fee=0.0, start_holdings=None, precisions=None):
+    steps, pair_count = close.shape
+    holdings = np.zeros(pair_count) if start_holdings is None else np.array(start_holdings, dtype=np.float64)
+    initial_holdings = holdings.copy()
+    usdt = float(start_usdt)
+    turnover = 0.0
+    fees = 0.0
+    orders = 0
+
+    buy_every = steps_between(settings.buy_frequency, interval)
+    rebalance_every = steps_between(settings.rebalance_frequency, interval)
+    run_steps = np.union1d(np.arange(0, steps, buy_every) if buy_every else [],
+                           np.arange(0, steps, rebalance_every) if rebalance_every else []).astype(np.int64)
+
+    # The holdings and USDT after each task run, kept for the value curve
+    held = np.empty((len(run_steps), pair_count))
+    cash = np.empty(len(run_steps))
+    required_usdt = settings.buy_order_value * pair_count
+    # Every Buy places the same orders
+    buy_amounts = np.array([order.amount for order in plan_buy([(column, column) for column in range(pair_count)], settings.buy_order_value, precisions)])
+
+    for index, step in enumerate(run_steps):
+        prices = close[step]
+
+        # On the hour, Rebalance runs before Buy
+        if rebalance_every and step % rebalance_every == 0:
+            plan = rebalance_orders(holdings, prices, settings.rebalance_threshold, precisions)
+
+            # All sell orders are finished before the buy orders start
+            for order in plan.sells:
+                value = order.amount * prices[order.pair]
+                holdings[order.pair] -= order.amount
+                usdt += value * (1 - fee)
+                turnover += value
+                fees += value * fee
+
+            # Like PieBot following the fills of the sells, the buys are reduced to the USDT they brought in
+            buys = fit_to_budget(plan.buys, usdt, precisions, min_order_value)
+            for order in buys:
+                holdings[order.pair] += order.amount / prices[order.pair] * (1 - fee)
+                usdt -= order.amount
+                turnover += order.amount
+                fees += order.amount * fee
+            orders += len(plan.sells) + len(buys)
+
+        if buy_every and step % buy_every == 0:
+            total_value = holdings @ prices + usdt
+            if required_usdt <= available_usdt(usdt, total_value, settings.usdt_reserve):
+                holdings += buy_amounts / prices * (1 - fee)
+                usdt -= buy_amounts.sum()
+                turnover += buy_amounts.sum()
+                fees += buy_amounts.sum() * fee
+                orders += pair_count
+
+        held[index] = holdings
+        cash[index] = usdt
+
+    # Every candle uses the holdings of the last task run before it. The candles before the first run use the
+    # holdings at the start, which are added at the end so the index -1 finds them
+    run_index = np.searchsorted(run_steps, np.arange(steps), side="right") - 1
+    usdt_curve = np.append(cash, start_usdt)[run_index]
+    holdings_curve = np.vstack([held, initial_holdings])[run_index]
+    values = np.einsum("ij,ij->i", holdings_curve, close) + usdt_curve
+
+    peaks = np.maximum.accumulate(values)
+    max_drawdown = float(np.max(1 - values / peaks)) if len(values) else 0.0
+
+    return Result(values, usdt_curve, turnover, fees, orders, float(values[-1]) if len(values) else start_usdt, max_drawdown)
+
+
+def print_result(result, start_usdt, timestamps, elapsed):
+    print("Candles:        {}".format(len(timestamps)))
+    print("Final value:    {:.2f} USDT ({:+.2%})".format(result.final_value, result.final_value / start_usdt - 1))
+    print("Max drawdown:   {:.2%}".format(result.max_drawdown))
+    print("Orders:         {}".format(result.orders))
+    print("Turnover:       {:.2f} USDT".format(result.turnover))
+    print("Fees:           {:.2f} USDT".format(result.fees))
+    print("Simulated in    {:.3f}s".format(elapsed))
+
+
+def write_curve(path, timestamps, result):
+    np.savetxt(path, np.column_stack((timestamps, result.values, result.usdt)),
+               delimiter=",", header="timestamp,value,usdt", comments="", fmt=("%d", "%.8f", "%.8f"))
+
+
+def add_settings_arguments(parser):
+    parser.add_argument("--data", required=True, help="Directory with one candle file per coin pair")
+    parser.add_argument("--pairs", nargs="+", help="Only use these coin pairs, e.g. BTC_USDT")
+    parser.add_argument("--usdt", type=float, default=1000, help="USDT at the start")
+    parser.add_argument("--fee", type=float, default=0.00075, help="Trading fee, 0.00075 = 0.075%%")
+    parser.add_argument("--instruments", help="File of the exchange's instruments, e.g. the instrument_cache_file of _config.py, "
+                                               "to round the orders to the decimals the exchange accepts")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Backtests PieBot's Buy and Rebalance tasks on historical candles")
+    add_settings_arguments(parser)
+    parser.add_argument("--buy-order-value", type=float, default=0.5)
+    parser.add_argument("--buy-frequency", type=float, default=6, help="Hours")
+    parser.add_argument("--rebalance-frequency", type=float, default=1, help="Hours, 0 to never rebalance")
+    parser.add_argument("--rebalance-threshold", type=float, default=0.03)
+    parser.add_argument("--usdt-reserve", type=float, default=0.02)
+    parser.add_argument("--output", help="Writes the value curve to this CSV file")
+    args = parser.parse_args()
+
+    timestamps, pairs, close = load_candles(args.data, args.pairs)
+    interval = float(np.median(np.diff(timestamps))) if len(timestamps) > 1 else 3600
+    settings = Settings(args.buy_order_value, args.buy_frequency, args.rebalance_frequency, args.rebalance_threshold, args.usdt_reserve)
+    precisions = load_precisions(args.instruments, pairs) if args.instruments else None
+
+    started = time.perf_counter()
+    result = simulate(close, settings, args.usdt, interval, args.fee, precisions=precisions)
+    print("Pairs:          {}".format(", ".join(pairs)))
+    print_result(result, args.usdt, timestamps, time.perf_counter() - started)
+
+    if args.output:
+        write_curve(args.output, timestamps, result)
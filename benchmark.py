@@ -0,0 +1,222 @@
+import argparse
+import contextlib
+import importlib
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import urllib.request
+
+# Measures a full Buy, Rebalance and exporter cycle against mock_exchange.py, for growing numbers of coin pairs.
+# For every task it reports the wall time, the number of requests, the bytes sent and received, and the peak memory.
+#
+#   python3 benchmark.py --save benchmark_baseline.json
+#   python3 benchmark.py --compare benchmark_baseline.json
+
+here = os.path.dirname(os.path.abspath(__file__))
+api_key = "benchmark-key"
+api_secret = "benchmark-secret"
+
+config_template = '''account_name = "benchmark"
+environment = "production"
+api_key = "{api_key}"
+api_secret = "{api_secret}"
+pair_list = {pair_list!r}
+buy_frequency = 1
+rebalance_frequency = 1
+rebalance_threshold = 0.03
+buy_order_value = 0.50
+usdt_reserve = 0.02
+'''
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+# Builds a portfolio that is out of balance, so Rebalance has orders to place for most pairs
+def make_portfolio(pair_count, seed):
+    generator = random.Random(seed)
+    pairs = [("C{}".format(index), "C{}_USDT".format(index)) for index in range(pair_count)]
+    prices = {pair[1]: round(10 ** generator.uniform(-2, 4), 6) for pair in pairs}
+    balances = {"USDT": 50.0 * pair_count}
+    for coin, pair in pairs:
+        balances[coin] = generator.uniform(0, 20) / prices[pair]
+    return pairs, prices, balances
+
+
+def start_mock(prices, balances, latency, padding_instruments):
+    port = free_port()
+    command = [sys.executable, os.path.join(here, "mock_exchange.py"),
+               "--port", str(port), "--api-key", api_key, "--api-secret", api_secret,
+               "--latency", str(latency), "--padding-instruments", str(padding_instruments),
+               "--pairs"] + ["{}:{}".format(pair, price) for pair, price in prices.items()] + \
+              ["--balances"] + ["{}:{}".format(coin, amount) for coin, amount in balances.items()]
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    url = "http://127.0.0.1:{}/exchange/v1/".format(port)
+
+    for attempt in range(100):
+        try:
+            urllib.request.urlopen(url + "public/get-tickers?instrument_name=" + next(iter(prices)), timeout=1)
+            return process, url
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("The mock exchange did not start")
+
+
+# Counts every request the bot's client sends, with the bytes in both directions
+class TrafficCounter:
+    def __init__(self, session):
+        self.reset()
+        session.hooks["response"].append(self.count)
+
+    def reset(self):
+        self.requests = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def count(self, response, *args, **kwargs):
+        self.requests += 1
+        body = response.request.body or b""
+        self.bytes_sent += len(body) + len(response.request.url)
+        self.bytes_received += len(response.content)
+
+
+# Imports PieBot with a config written for the benchmark
+def load_bot(pairs, url, config_dir):
+    with open(os.path.join(config_dir, "_config.py"), "w") as config:
+        config.write(config_template.format(api_key=api_key, api_secret=api_secret, pair_list=pairs))
+    os.environ["EXCHANGE_URL"] = url
+    sys.path.insert(0, here)
+    sys.path.insert(0, config_dir)
+
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        bot = importlib.import_module("PieBot")
+    return bot
+
+
+# Runs one task. The wall time is only measured while tracemalloc is off, as it slows down every allocation,
+# so the peak memory is measured in a pass of its own
+def measure(task, counter, trace_memory):
+    # The tasks run at least a cycle apart, so the tickers one task downloaded are expired when the next one starts
+    sys.modules["functions"].tickers.invalidate()
+    counter.reset()
+    if trace_memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        task()
+    wall_time = time.perf_counter() - started
+    peak_memory = None
+    if trace_memory:
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    return {
+        "wall_time": round(wall_time, 4),
+        "requests": counter.requests,
+        "bytes_sent": counter.bytes_sent,
+        "bytes_received": counter.bytes_received,
+        "peak_memory": peak_memory,
+    }
+
+
+# Benchmarks one number of pairs. This runs in its own process, so every scenario starts with a fresh bot
+def run_scenario(pair_count, latency, padding_instruments, seed, trace_memory):
+    pairs, prices, balances = make_portfolio(pair_count, seed)
+    process, url = start_mock(prices, balances, latency, padding_instruments)
+    try:
+        with tempfile.TemporaryDirectory() as config_dir:
+            bot = load_bot(pairs, url, config_dir)
+            counter = TrafficCounter(sys.modules["functions"].client.session)
+            return {
+                "buy": measure(lambda: bot.buy(pairs), counter, trace_memory),
+                "rebalance": measure(lambda: bot.rebalance(pairs), counter, trace_memory),
+                "update_exporter": measure(lambda: bot.update_exporter(pairs), counter, trace_memory),
+            }
+    finally:
+        process.kill()
+        process.wait()
+
+
+def run_pass(pair_count, latency, padding_instruments, seed, trace_memory):
+    command = [sys.executable, os.path.abspath(__file__), "--scenario", str(pair_count), "--latency", str(latency),
+               "--padding-instruments", str(padding_instruments), "--seed", str(seed)]
+    if trace_memory:
+        command.append("--trace-memory")
+    output = subprocess.run(command, capture_output=True, text=True, check=True)
+    return json.loads(output.stdout.splitlines()[-1])
+
+
+# Runs every scenario twice from the same start: once for the wall time and the traffic, once for the peak memory
+def run(pair_counts, latency, padding_instruments, seed):
+    results = {}
+    for pair_count in pair_counts:
+        timed = run_pass(pair_count, latency, padding_instruments, seed, False)
+        traced = run_pass(pair_count, latency, padding_instruments, seed, True)
+        for task, numbers in timed.items():
+            numbers["peak_memory"] = traced[task]["peak_memory"]
+        results[str(pair_count)] = timed
+    return results
+
+
+def print_results(results, baseline=None):
+    print("{:>6s} {:<16s} {:>10s} {:>9s} {:>12s} {:>14s} {:>12s}".format(
+        "pairs", "task", "wall (s)", "requests", "sent (B)", "received (B)", "peak (KiB)"))
+    for pair_count, tasks in results.items():
+        for task, numbers in tasks.items():
+            print("{:>6s} {:<16s} {:>10.3f} {:>9d} {:>12d} {:>14d} {:>12.1f}".format(
+                pair_count, task, numbers["wall_time"], numbers["requests"], numbers["bytes_sent"],
+                numbers["bytes_received"], numbers["peak_memory"] / 1024))
+
+            previous = (baseline or {}).get(pair_count, {}).get(task)
+            if previous:
+                print("{:>6s} {:<16s} {:>+10.1%} {:>+9d} {:>+12d} {:>+14d} {:>+12.1f}".format(
+                    "", "vs baseline",
+                    numbers["wall_time"] / previous["wall_time"] - 1 if previous["wall_time"] else 0,
+                    numbers["requests"] - previous["requests"],
+                    numbers["bytes_sent"] - previous["bytes_sent"],
+                    numbers["bytes_received"] - previous["bytes_received"],
+                    (numbers["peak_memory"] - previous["peak_memory"]) / 1024))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks PieBot's tasks against a local mock exchange")
+    parser.add_argument("--pairs", type=int, nargs="+", default=[5, 15, 50, 200])
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds the mock exchange adds to every response")
+    parser.add_argument("--padding-instruments", type=int, default=1000, help="Extra instruments in get-instruments")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--save", help="Writes the results to this file, to be used as the baseline")
+    parser.add_argument("--compare", help="Compares the results with a saved baseline")
+    parser.add_argument("--scenario", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--trace-memory", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.scenario:
+        print(json.dumps(run_scenario(args.scenario, args.latency, args.padding_instruments, args.seed, args.trace_memory)))
+        sys.exit()
+
+    settings = {"latency": args.latency, "padding_instruments": args.padding_instruments, "seed": args.seed}
+    results = run(args.pairs, args.latency, args.padding_instruments, args.seed)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            saved = json.load(baseline_file)
+        if saved.get("settings") != settings:
+            print("The baseline was taken with different settings: {}".format(saved.get("settings")))
+        baseline = saved["results"]
+
+    print_results(results, baseline)
+
+    if args.save:
+        with open(args.save, "w") as baseline_file:
+            json.dump({"settings": settings, "results": results}, baseline_file, indent=2)
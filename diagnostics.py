@@ -0,0 +1,181 @@
+import cProfile
+import gc
+import io
+import marshal
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+from prometheus_client.core import GaugeMetricFamily
+
+# Finds out why the Buy and Rebalance cycles of the running process are slow or keep more memory, without restarting it.
+# The profiler is armed for the next cycles, memory tracing is started and stopped at will, both with a signal or,
+# when debug_port is set, through an HTTP server on localhost:
+#
+#   kill -USR1 <pid>   curl -X POST localhost:19001/debug/profile        profiles the next cycle
+#   kill -USR2 <pid>   curl -X POST localhost:19001/debug/memory/start   starts or stops tracing the memory
+
+# Frames of the tracing itself are left out of the memory diffs
+ignored_files = (tracemalloc.__file__, "<frozen importlib._bootstrap>", "<frozen importlib._bootstrap_external>", "<unknown>")
+
+# Every frame kept for each allocation costs memory, so deeper traces are cut off here
+max_frames = 25
+max_cycles = 100
+
+
+class Diagnostics:
+    def __init__(self, profile_dir=None, top=25):
+        self.profile_dir = profile_dir
+        self.top = top
+        # Reentrant, as the signal handlers take it in whatever the main thread was doing
+        self.lock = threading.RLock()
+        # How many of the next cycles are profiled
+        self.armed = 0
+        self.profiling = False
+        # The latest profile: {"task", "account", "finished_at", "seconds", "stats"}, stats being a pstats.Stats
+        self.last_profile = None
+        self.previous_snapshot = None
+        # What the latest cycle allocated and kept, compared to the cycle before it, while the memory is traced
+        self.last_diff = None
+        # {type name: count} of the objects the garbage collector tracks, counted after every cycle
+        self.object_counts = {}
+        self.objects = 0
+
+    # Profiles the next cycles, up to max_cycles
+    def arm(self, cycles=1):
+        with self.lock:
+            self.armed = min(self.armed + max(1, cycles), max_cycles)
+            return self.armed
+
+    # Whether this cycle is profiled. Only one cycle is profiled at a time, the others wait for their turn
+    def take_armed(self):
+        with self.lock:
+            if self.armed <= 0 or self.profiling:
+                return False
+            self.armed -= 1
+            self.profiling = True
+            return True
+
+    # Wraps one cycle of a task
+    @contextmanager
+    def cycle(self, task, account):
+        profiler = cProfile.Profile() if self.take_armed() else None
+        started = time.perf_counter()
+        if profiler:
+            profiler.enable()
+        try:
+            yield
+        finally:
+            if profiler:
+                profiler.disable()
+                self.keep_profile(profiler, task, account, time.perf_counter() - started)
+            if tracemalloc.is_tracing():
+                self.compare_memory(task, account)
+            self.count_objects()
+
+    def keep_profile(self, profiler, task, account, seconds):
+        try:
+            stats = pstats.Stats(profiler)
+            with self.lock:
+                self.last_profile = {"task": task, "account": account, "finished_at": time.time(), "seconds": seconds, "stats": stats}
+            if self.profile_dir:
+                os.makedirs(self.profile_dir, exist_ok=True)
+                name = "{}-{}-{}.prof".format(task, account, time.strftime("%Y%m%d-%H%M%S"))
+                stats.dump_stats(os.path.join(self.profile_dir, name))
+        finally:
+            with self.lock:
+                self.profiling = False
+
+    # The latest profile as text, sorted by cumulative time
+    def profile_text(self, sort="cumulative"):
+        with self.lock:
+            profile = self.last_profile
+        if profile is None:
+            return None
+        output = io.StringIO()
+        output.write("{} of {}, {:.3f}s, finished at {}\n\n".format(profile["task"], profile["account"], profile["seconds"],
+                                                                     time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(profile["finished_at"]))))
+        # Sorted in a copy, as several requests may print the same profile at once
+        stats = pstats.Stats(stream=output)
+        stats.add(profile["stats"])
+        stats.sort_stats(sort).print_stats(self.top)
+        return output.getvalue()
+
+    # The latest profile in the format of cProfile's .prof files, e.g. for snakeviz
+    def profile_data(self):
+        with self.lock:
+            profile = self.last_profile
+        return None if profile is None else marshal.dumps(profile["stats"].stats)
+
+    def start_tracing(self, frames=1):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(min(max(1, frames), max_frames))
+            self.previous_snapshot = None
+            self.last_diff = None
+
+    def stop_tracing(self):
+        tracemalloc.stop()
+        self.previous_snapshot = None
+
+    def toggle_tracing(self):
+        if tracemalloc.is_tracing():
+            self.stop_tracing()
+        else:
+            self.start_tracing()
+        return tracemalloc.is_tracing()
+
+    def compare_memory(self, task, account):
+        snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, name) for name in ignored_files])
+        with self.lock:
+            previous = self.previous_snapshot
+            self.previous_snapshot = snapshot
+            if previous is not None:
+                self.last_diff = {
+                    "task": task,
+                    "account": account,
+                    "finished_at": time.time(),
+                    "lines": [str(statistic) for statistic in snapshot.compare_to(previous, "lineno")[:self.top]],
+                }
+
+    def count_objects(self):
+        counts = Counter(type(tracked).__name__ for tracked in gc.get_objects())
+        with self.lock:
+            self.objects = sum(counts.values())
+            self.object_counts = dict(counts.most_common(self.top))
+
+    def memory(self):
+        traced, peak = tracemalloc.get_traced_memory()
+        with self.lock:
+            return {"tracing": tracemalloc.is_tracing(), "traced_bytes": traced, "peak_traced_bytes": peak,
+                    "objects": self.objects, "object_counts": self.object_counts, "last_cycle_diff": self.last_diff}
+
+    # The memory gauges, as of the end of the latest cycle. A scrape never walks the objects itself
+    def collect(self):
+        objects = GaugeMetricFamily("python_objects", "Objects tracked by the garbage collector after the latest cycle")
+        by_type = GaugeMetricFamily("python_objects_by_type", "Objects tracked by the garbage collector after the latest cycle, for the most common types",
+                                    labels=["type"])
+        traced = GaugeMetricFamily("python_traced_memory_bytes", "Memory allocated by Python while it is traced, see /debug/memory")
+        with self.lock:
+            objects.add_metric([], self.objects)
+            for name, count in self.object_counts.items():
+                by_type.add_metric([name], count)
+        traced.add_metric([], tracemalloc.get_traced_memory()[0])
+        yield objects
+        yield by_type
+        yield traced
+
+    # Arms the profiler with SIGUSR1 and starts or stops tracing the memory with SIGUSR2
+    def handle_signals(self, on_message=print):
+        import signal
+
+        def profile_next(*args):
+            on_message("Profiling the next {} cycle(s)".format(self.arm()))
+
+        def toggle(*args):
+            on_message("Memory tracing is {}".format("on" if self.toggle_tracing() else "off"))
+
+        signal.signal(signal.SIGUSR1, profile_next)
+        signal.signal(signal.SIGUSR2, toggle)
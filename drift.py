@@ -0,0 +1,179 @@
+import threading
+import time
+from collections import deque
+import functions
+from functions import colored, current_time, metrics, ticker_price
+
+# Starts a Rebalance as soon as a coin drifts past rebalance_threshold, instead of every rebalance_frequency hours.
+#
+# A coin is over its target once value - target >= min_order_value and (value - target) / target >= threshold,
+# and under it once target - value >= min_order_value and (target - value) / value >= threshold, like in
+# plan_rebalance(). A new price only changes the value of its own coin and the total, so only that coin is checked,
+# once all prices of a batch have been applied. The other coins can only cross when the target moves, and they are all
+# checked again once it moves past the range worked out at their last check. Until then, a new price costs the same
+# however many coins there are.
+
+
+# Keeps the value of every coin of an account as prices arrive, and calls on_drift(account, coins, max_orders) when coins
+# cross the threshold, max_orders being what is left of the orders cap. After that, it waits for finished() and the
+# cooldown before calling it again
+class DriftMonitor:
+    def __init__(self, account, on_drift, cooldown=900, max_orders=20, window=3600, min_order_value=0.25):
+        self.account = account
+        self.on_drift = on_drift
+        self.threshold = account.rebalance_threshold
+        self.cooldown = cooldown
+        self.max_orders = max_orders
+        self.window = window
+        self.min_order_value = min_order_value
+        self.lock = threading.Lock()
+        # {pair: coin} of the pairs the account trades
+        self.coins = {pair: coin for coin, pair in account.pair_list}
+        # {pair: quantity} as of the latest snapshot, None until there is one
+        self.quantities = None
+        # {pair: value in USDT} of the pairs with a price
+        self.values = {}
+        self.total = 0.0
+        # The pairs past the threshold
+        self.crossing = set()
+        # The target can move between these without any coin crossing, except those with a new price
+        self.lowest_target = 0.0
+        self.highest_target = float("inf")
+        self.running = False
+        self.fired_at = None
+        self.capped = False
+        # (time, orders) of the drift Rebalances within the window
+        self.placed = deque()
+
+    def target(self):
+        return self.total / len(self.coins)
+
+    def over_below(self, value):
+        return min(value / (1 + self.threshold), value - self.min_order_value)
+
+    def under_above(self, value):
+        return max(value * (1 + self.threshold), value + self.min_order_value)
+
+    def crosses(self, value, target):
+        return target <= self.over_below(value) or target >= self.under_above(value)
+
+    # Checks a coin against the target. A coin that doesn't cross narrows how far the target can move.
+    # Its bound from an older value may be left in the range, which only makes the next scan come sooner
+    def check(self, pair, target):
+        value = self.values[pair]
+        if self.crosses(value, target):
+            self.crossing.add(pair)
+        else:
+            self.crossing.discard(pair)
+            self.lowest_target = max(self.lowest_target, self.over_below(value))
+            self.highest_target = min(self.highest_target, self.under_above(value))
+
+    # Checks every coin against the current target, and works out how far the target can move until the next one crosses
+    def scan(self):
+        target = self.target()
+        self.crossing = set()
+        self.lowest_target = 0.0
+        self.highest_target = float("inf")
+        for pair in self.values:
+            self.check(pair, target)
+
+    # Starts over from the balances and prices of a snapshot of the account
+    def observe(self, snapshot):
+        with self.lock:
+            self.quantities = {pair: snapshot.balances.get(coin, 0.0) for pair, coin in self.coins.items()}
+            self.values = {pair: quantity * snapshot.prices[pair] for pair, quantity in self.quantities.items() if snapshot.prices.get(pair) is not None}
+            self.total = sum(self.values.values())
+            self.scan()
+            due = self.due()
+        if due:
+            self.on_drift(self.account, *due)
+
+    # Takes the prices of a list of tickers, as downloaded or streamed
+    def update(self, ticker_data):
+        with self.lock:
+            if self.quantities is None:
+                return
+            # All prices of the batch are applied before any coin is checked, as each of them moves the target
+            updated = set()
+            for ticker in ticker_data:
+                pair = ticker.get("i")
+                if pair not in self.coins:
+                    continue
+                price = ticker_price(ticker)
+                if price is None:
+                    continue
+
+                value = self.quantities[pair] * price
+                self.total += value - self.values.get(pair, 0.0)
+                self.values[pair] = value
+                updated.add(pair)
+
+            target = self.target()
+            if target <= self.lowest_target or target >= self.highest_target:
+                self.scan()
+            else:
+                for pair in updated:
+                    self.check(pair, target)
+            due = self.due()
+        if due:
+            self.on_drift(self.account, *due)
+
+    # The coins a Rebalance should start for now and how many orders it may place. None while one is running,
+    # in the cooldown, or over the orders cap
+    def due(self):
+        if not self.crossing or self.running:
+            return None
+        now = time.time()
+        if self.fired_at is not None and now - self.fired_at < self.cooldown:
+            return None
+
+        # Coins found crossing earlier may be back in range, now that the target has moved
+        target = self.target()
+        for pair in list(self.crossing):
+            self.check(pair, target)
+        if not self.crossing:
+            return None
+
+        while self.placed and now - self.placed[0][0] > self.window:
+            self.placed.popleft()
+        remaining = self.max_orders - sum(orders for at, orders in self.placed)
+        if remaining < 1:
+            if not self.capped:
+                self.capped = True
+                metrics.drift_rebalances.labels(self.account.name, "capped").inc()
+                current_time(True)
+                print(colored(functions.account_message(self.account, "Drift Rebalance held back, the drift_max_orders cap of {} orders is reached".format(self.max_orders)), "yellow"))
+            return None
+
+        self.capped = False
+        self.running = True
+        self.fired_at = now
+        metrics.drift_rebalances.labels(self.account.name, "started").inc()
+        return sorted(self.coins[pair] for pair in self.crossing), remaining
+
+    # Called when the Rebalance on_drift started is done, with the number of orders it placed
+    def finished(self, orders):
+        with self.lock:
+            self.running = False
+            self.placed.append((time.time(), orders))
+
+
+# Feeds the tickers to the monitors, and downloads them every interval seconds while they aren't streamed
+def start(monitors, interval):
+    for monitor in monitors:
+        functions.ticker_listeners.append(monitor.update)
+
+    def run():
+        while True:
+            time.sleep(interval)
+            if functions.market_feed is not None and functions.market_feed.fresh("market", functions.stream_max_age):
+                continue
+            try:
+                functions.tickers.get()
+            except Exception as error:
+                current_time(True)
+                print(colored("Downloading the prices for the drift check failed: {!r}".format(error), "red"))
+
+    thread = threading.Thread(target=run, name="drift", daemon=True)
+    thread.start()
+    return thread
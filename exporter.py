@@ -0,0 +1,67 @@
+import threading
+import time
+from prometheus_client.core import GaugeMetricFamily, StateSetMetricFamily
+from functions import colored, current_time, get_account_details
+
+# Serves the coin metrics from the latest snapshot of every account. A scrape only reads what is in memory,
+# the snapshots come from the Buy and Rebalance tasks and from a background refresh when those are too old
+
+
+class SnapshotCollector:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # {account name: (positions, taken_at)}
+        self.positions = {}
+        self.refresher = None
+
+    # Keeps the positions of a snapshot, unless a newer snapshot of the account is already known
+    def observe(self, account, snapshot):
+        positions = get_account_details(snapshot, account)
+        with self.lock:
+            current = self.positions.get(account.name)
+            if current is None or snapshot.taken_at >= current[1]:
+                self.positions[account.name] = (positions, snapshot.taken_at)
+
+    # Seconds since the latest snapshot of the account was taken
+    def age(self, account):
+        with self.lock:
+            current = self.positions.get(account.name)
+        return float("inf") if current is None else time.time() - current[1]
+
+    def collect(self):
+        balance = GaugeMetricFamily("coin_balance", "The amount of coins", labels=["coin", "account"])
+        price = GaugeMetricFamily("coin_price", "The price of a coin in USDT", labels=["coin", "account"])
+        state = StateSetMetricFamily("coin_state", "The management state of a coin", labels=["coin", "account"])
+        age = GaugeMetricFamily("coin_snapshot_age_seconds", "Seconds since the coin metrics of the account were taken", labels=["account"])
+
+        with self.lock:
+            accounts = list(self.positions.items())
+        now = time.time()
+        for name, (positions, taken_at) in accounts:
+            for position in positions:
+                balance.add_metric([position["coin"], name], position["balance"])
+                price.add_metric([position["coin"], name], position["price"])
+                state.add_metric([position["coin"], name], {coin_state: position["state"] == coin_state for coin_state in ("managed", "unmanaged")})
+            age.add_metric([name], now - taken_at)
+
+        yield balance
+        yield price
+        yield state
+        yield age
+
+    # Calls refresh(account) for every account whose snapshot is older than interval seconds, in a thread of its own
+    def start(self, accounts, refresh, interval):
+        def run():
+            while True:
+                for account in accounts:
+                    if self.age(account) < interval:
+                        continue
+                    try:
+                        refresh(account)
+                    except Exception as error:
+                        current_time(True)
+                        print(colored("Refreshing the metrics of {} failed: {!r}".format(account.name, error), "red"))
+                time.sleep(min(interval, 10))
+
+        self.refresher = threading.Thread(target=run, name="exporter", daemon=True)
+        self.refresher.start()
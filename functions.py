@@ -4,23 +4,291 @@ import json
 import requests
 import signal
 import sys
-from termcolor import colored as termcolor_colored
 import time
 import os
 import socket
+import threading
+from collections import deque, namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 import requests.packages.urllib3.util.connection
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 
 from _config import *
+from planner import Order, RebalancePlan, plan_buy, plan_rebalance, fit_to_budget, limit_orders
+import planner
+
+
+# Stands in for metrics.py where the metrics aren't served: every metric and helper takes the same calls and keeps nothing
+class NoMetrics:
+    def __getattr__(self, name):
+        return self
+
+    def __call__(self, *args, **kwargs):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+# The metrics are only kept in production and on paper, where they are served. A task run by hand in dev mode
+# doesn't need prometheus_client
+if globals().get("environment") in ("production", "paper"):
+    import metrics
+else:
+    metrics = NoMetrics()
 
 min_order_value = 0.25
 
+# The most orders the exchange accepts in one private/create-order-list request
+max_order_list_size = 10
+
+# Labels the metrics and the records of this account
+try:
+    account_name
+except NameError:
+    account_name = "piebot"
+
+# A SQLite file recording every snapshot and order, None to keep no records
+try:
+    state_file
+except NameError:
+    state_file = None
+
+# The address of the exchange's REST API and WebSocket streams.
+# Point them at mock_exchange.py to run PieBot without the real exchange
+try:
+    exchange_url
+except NameError:
+    exchange_url = "https://api.crypto.com/exchange/v1/"
+
+try:
+    stream_url
+except NameError:
+    stream_url = "wss://stream.crypto.com/exchange/v1/"
+
+if "EXCHANGE_URL" in os.environ:
+    exchange_url = os.environ["EXCHANGE_URL"]
+if "STREAM_URL" in os.environ:
+    stream_url = os.environ["STREAM_URL"]
+
+# The API key and API secret can be given in the environment instead of the config file
+if "API_KEY" in os.environ:
+    api_key = os.environ["API_KEY"]
+if "API_SECRET" in os.environ:
+    api_secret = os.environ["API_SECRET"]
+
+# Sets how the production tasks are run, either "schedule" or "asyncio"
+try:
+    runtime
+except NameError:
+    runtime = "schedule"
+
+# Keeps prices and balances up to date through the exchange's WebSocket channels
+try:
+    streaming
+except NameError:
+    streaming = False
+
+# Sets after how many seconds without a message the streamed data is no longer trusted
+try:
+    stream_max_age
+except NameError:
+    stream_max_age = 60
+
+# The balances and trading fee of the ledger, when trading on paper with environment = "paper"
+try:
+    paper_balances
+except NameError:
+    paper_balances = {"USDT": 1000}
+
+try:
+    paper_fee
+except NameError:
+    paper_fee = 0.00075
+
+# The directory every ticker PieBot downloads or streams is recorded to, see recorder.py. None records nothing
+try:
+    record_ticks
+except NameError:
+    record_ticks = None
+
+# Rebalances as soon as a coin drifts past rebalance_threshold, instead of every rebalance_frequency hours, see drift.py
+try:
+    drift_rebalance
+except NameError:
+    drift_rebalance = False
+
+# Sets how many seconds after a drift Rebalance the next one can start at the earliest
+try:
+    drift_cooldown
+except NameError:
+    drift_cooldown = 900
+
+# Sets how many orders the drift Rebalances of an account may place within drift_window seconds
+try:
+    drift_max_orders
+except NameError:
+    drift_max_orders = 20
+
+try:
+    drift_window
+except NameError:
+    drift_window = 3600
+
+# Sets how many seconds apart the prices are checked for drift, when they aren't streamed
+try:
+    drift_interval
+except NameError:
+    drift_interval = 60
+
+# Serves the /debug endpoints of diagnostics.py on this port of localhost. None doesn't serve them
+try:
+    debug_port
+except NameError:
+    debug_port = None
+
+# The directory the profiles of the cycles profiled on demand are written to, see diagnostics.py. None keeps only the latest in memory
+try:
+    profile_dir
+except NameError:
+    profile_dir = None
+
+# Sets after how many seconds without a Buy or Rebalance the coin metrics are refreshed
+try:
+    exporter_interval
+except NameError:
+    exporter_interval = 300
+
+# Sets how many keep-alive connections are held open to the exchange
+try:
+    http_pool_size
+except NameError:
+    http_pool_size = 10
+
+# Sets how many seconds to wait for the exchange before giving up on a request
+try:
+    http_timeout
+except NameError:
+    http_timeout = 10
+
+# Sets the timeout of single endpoints in seconds, e.g. {"public/get-tickers": 3}. Endpoints not in here use http_timeout
+try:
+    http_timeouts
+except NameError:
+    http_timeouts = {}
+
+# Sets how often a failed request is retried, and the backoff factor between the retries
+try:
+    http_retries
+except NameError:
+    http_retries = 3
+
+try:
+    http_backoff
+except NameError:
+    http_backoff = 0.5
+
+# Holds back the requests to an endpoint for circuit_open_seconds, once circuit_error_rate of its requests within a
+# minute failed, and at least circuit_min_requests were sent
+try:
+    circuit_error_rate
+except NameError:
+    circuit_error_rate = 0.5
+
+try:
+    circuit_min_requests
+except NameError:
+    circuit_min_requests = 5
+
+try:
+    circuit_open_seconds
+except NameError:
+    circuit_open_seconds = 30
+
+# Sends a second public request when the first hasn't been answered within this percentile of the endpoint's
+# response times. 0 never sends a second one
+try:
+    hedge_percentile
+except NameError:
+    hedge_percentile = 0.95
+
+# Forces all connections to the exchange to use ipv4
+try:
+    ipv4_only
+except NameError:
+    ipv4_only = False
+
+# Sets after how many seconds the list of instruments is downloaded again
+try:
+    instrument_cache_ttl
+except NameError:
+    instrument_cache_ttl = 3600
+
+# A file the list of instruments is kept in, so a restart doesn't need to download it again
+try:
+    instrument_cache_file
+except NameError:
+    instrument_cache_file = None
+
+# Sets how many orders are sent to the exchange at the same time
+try:
+    order_concurrency
+except NameError:
+    order_concurrency = 4
+
+# Checks how much of the sell orders of a Rebalance was filled before the buy orders are placed.
+# With "all", this is done for every order
+try:
+    track_fills
+except NameError:
+    track_fills = True
+
+# Sets how many seconds to wait for orders to be filled
+try:
+    fill_timeout
+except NameError:
+    fill_timeout = 30
+
+# Sends each phase of orders as lists with private/create-order-list, instead of one request per order
+try:
+    batch_orders
+except NameError:
+    batch_orders = False
+
+# Sets how many requests per second may be sent to the exchange.
+# The defaults are the limits crypto.com documents for each group of endpoints
+try:
+    public_rate_limit
+except NameError:
+    public_rate_limit = 100
+
+try:
+    private_rate_limit
+except NameError:
+    private_rate_limit = 30
+
+try:
+    order_rate_limit
+except NameError:
+    order_rate_limit = 150
+
+try:
+    order_detail_rate_limit
+except NameError:
+    order_detail_rate_limit = 300
+
 
 # Stops PieBot gracefully
 class StopSignal:
     stop_now = False
 
-    def __init__(self):
+    def __init__(self, on_stop=None):
+        self.on_stop = on_stop
         signal.signal(signal.SIGINT, self.exit_gracefully)
         signal.signal(signal.SIGTERM, self.exit_gracefully)
 
@@ -29,6 +297,8 @@ class StopSignal:
         print()
         print(colored("Shutting down...", "cyan"))
         print()
+        if self.on_stop:
+            self.on_stop()
 
 
 def enforce_ipv4():
@@ -44,10 +314,330 @@ def enforce_ipv4():
         return socket.AF_INET
     requests.packages.urllib3.util.connection.allowed_gai_family = allowed_gai_family
 
+
+# Hands out requests at a steady rate, with room for a short burst
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(1, rate / 10))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    # Blocks until a request may be sent
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if now >= self.paused_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = max(self.paused_until - now, (1 - self.tokens) / self.rate)
+            time.sleep(wait)
+
+    # Takes a token if one is available right away, without waiting
+    def try_acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if now >= self.paused_until and self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+    # Stops handing out requests for a while, after the exchange told us to slow down
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+
+# Raised instead of sending a request while the circuit breaker of its endpoint is open. Nothing reached the exchange,
+# like with a connection error
+class CircuitOpenError(requests.ConnectionError):
+    pass
+
+
+# Stops sending requests to an endpoint for a while once too many of its recent requests failed, so a task fails
+# in moments instead of waiting for every timeout. After open_seconds, one request is let through to try again:
+# if it succeeds the endpoint is used as before, if it fails the breaker opens again
+class CircuitBreaker:
+    def __init__(self, method, error_rate=0.5, min_requests=5, open_seconds=30, window=60):
+        self.method = method
+        self.error_rate = error_rate
+        self.min_requests = min_requests
+        self.open_seconds = open_seconds
+        self.window = window
+        # (time, failed) of the requests within the window
+        self.outcomes = deque()
+        self.opened_at = None
+        self.trying = False
+        self.lock = threading.Lock()
+
+    # Whether a request may be sent now
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if self.trying or time.monotonic() - self.opened_at < self.open_seconds:
+                return False
+            self.trying = True
+            return True
+
+    def record(self, failed):
+        with self.lock:
+            now = time.monotonic()
+            if self.opened_at is not None:
+                # Only the request let through to try again decides, requests sent before the breaker opened don't
+                if not self.trying:
+                    return
+                self.trying = False
+                if failed:
+                    self.opened_at = now
+                else:
+                    self.opened_at = None
+                    metrics.circuit_open.labels(self.method).set(0)
+                return
+
+            self.outcomes.append((now, failed))
+            while self.outcomes and now - self.outcomes[0][0] > self.window:
+                self.outcomes.popleft()
+            requests_sent = len(self.outcomes)
+            failures = sum(1 for at, outcome in self.outcomes if outcome)
+            if requests_sent >= self.min_requests and failures >= self.error_rate * requests_sent:
+                self.opened_at = now
+                self.outcomes.clear()
+                metrics.circuit_open.labels(self.method).set(1)
+                current_time(True)
+                print(colored("{} of {} requests to {} failed, holding back its requests for {} seconds".format(
+                    failures, requests_sent, self.method, self.open_seconds), "red"))
+
+
+# The circuit breakers of all endpoints, shared by the clients of all accounts
+circuit_breakers = {}
+circuit_breakers_lock = threading.Lock()
+
+
+def circuit_breaker(method):
+    with circuit_breakers_lock:
+        if method not in circuit_breakers:
+            circuit_breakers[method] = CircuitBreaker(method, circuit_error_rate, circuit_min_requests, circuit_open_seconds)
+        return circuit_breakers[method]
+
+
+# Runs the hedged public reads, see ExchangeClient.hedged()
+hedge_pool = ThreadPoolExecutor(max_workers=2 * http_pool_size, thread_name_prefix="hedge")
+
+
+# Finds the group of rate limits an endpoint belongs to
+def rate_limit_group(method):
+    if method.startswith("public/"):
+        return "public"
+    if method.startswith("private/create-order") or method.startswith("private/cancel-"):
+        return "order"
+    if method == "private/get-order-detail":
+        return "order_detail"
+    return "private"
+
+
+# Checks whether the exchange rejected a request because we sent too many
+def is_rate_limited(response):
+    if response.status_code == 429:
+        return True
+    if response.status_code != 200:
+        try:
+            return response.json().get("code") == 42901
+        except ValueError:
+            return False
+    return False
+
+
+# Talks to the exchange through one pool of keep-alive connections
+class ExchangeClient:
+    def __init__(self, base_url=exchange_url, pool_size=http_pool_size, timeout=http_timeout, retries=http_retries, backoff=http_backoff, ipv4=ipv4_only,
+                 key=None, secret=None, public_limit=None, timeouts=None, hedge=hedge_percentile):
+        if ipv4:
+            enforce_ipv4()
+
+        self.base_url = base_url.rstrip("/") + "/"
+        self.timeout = timeout
+        self.timeouts = http_timeouts if timeouts is None else timeouts
+        self.hedge = hedge
+        # {method: the latest response times of the endpoint}, to know when a public request is slow
+        self.latencies = {}
+        self.retries = retries
+        self.backoff = backoff
+        # The API key and API secret the private requests are signed with, None if the client has none
+        self.key = key
+        self.secret = secret
+        # The exchange limits public requests per address and private requests per API key,
+        # so clients of several accounts share one public rate limit
+        self.rate_limits = {
+            "public": public_limit or TokenBucket(public_rate_limit),
+            "private": TokenBucket(private_rate_limit),
+            "order": TokenBucket(order_rate_limit),
+            "order_detail": TokenBucket(order_detail_rate_limit),
+        }
+
+        # Only idempotent GET requests are retried after a response, an order must never be sent twice.
+        # Connection errors happen before anything reached the exchange, so these are retried for every request.
+        # Rate limit responses are handled by send(), as nothing was executed for them
+        retry = Retry(total=retries, connect=retries, read=retries, status=retries,
+                      backoff_factor=backoff,
+                      status_forcelist=(500, 502, 503, 504),
+                      allowed_methods=frozenset(["GET"]),
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+
+        self.session = requests.Session()
+        self.session.headers.update({"Content-type": "application/json"})
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def timeout_for(self, method):
+        return self.timeouts.get(method, self.timeout)
+
+    # Sends a request once its rate limit allows it, and backs off while the exchange says we are too fast.
+    # While the endpoint's circuit breaker is open, raises CircuitOpenError instead
+    def send(self, method, request):
+        bucket = self.rate_limits[rate_limit_group(method)]
+        breaker = circuit_breaker(method)
+        attempt = 0
+        while True:
+            if not breaker.allow():
+                metrics.circuit_rejected.labels(method).inc()
+                raise CircuitOpenError("Too many requests to {} failed, it is tried again in up to {} seconds".format(method, breaker.open_seconds))
+            bucket.acquire()
+            started = time.perf_counter()
+            failed = True
+            try:
+                response = request()
+                failed = response.status_code >= 500
+            except requests.RequestException as error:
+                metrics.observe_request(method, type(error).__name__, time.perf_counter() - started)
+                raise
+            finally:
+                breaker.record(failed)
+            metrics.observe_request(method, str(response.status_code), time.perf_counter() - started)
+            metrics.observe_retries(method, response)
+
+            if not is_rate_limited(response):
+                return response
+            metrics.rate_limited.labels(method).inc()
+            if attempt >= self.retries:
+                return response
+            metrics.retries.labels(method, "rate_limit").inc()
+
+            delay = self.backoff * (2 ** attempt)
+            retry_after = response.headers.get("Retry-After")
+            if retry_after and retry_after.isdigit():
+                delay = max(delay, int(retry_after))
+            bucket.pause(delay)
+            attempt += 1
+
+    # Sends a request and keeps its response time, unless the exchange failed
+    def timed(self, method, request):
+        started = time.perf_counter()
+        response = request()
+        if response.status_code < 500:
+            self.latencies.setdefault(method, deque(maxlen=200)).append(time.perf_counter() - started)
+        return response
+
+    # Seconds after which a request to the endpoint is slower than the hedge percentile of its response times,
+    # None until enough of them are known
+    def hedge_delay(self, method):
+        samples = self.latencies.get(method)
+        if not self.hedge or samples is None or len(samples) < 20:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(self.hedge * len(ordered)))]
+
+    # Sends an idempotent request, and sends it a second time if the first is slow. The first response wins,
+    # the slower request finishes in the background. The second request is only sent if the rate limit has room for it
+    def hedged(self, method, request):
+        delay = self.hedge_delay(method)
+        if delay is None:
+            return self.timed(method, request)
+
+        first = hedge_pool.submit(self.timed, method, request)
+        done, pending = wait([first], timeout=delay)
+        if done or not self.rate_limits[rate_limit_group(method)].try_acquire():
+            return first.result()
+
+        second = hedge_pool.submit(self.timed, method, request)
+        pending = {first, second}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    metrics.hedged_requests.labels(method, "first" if future is first else "second").inc()
+                    return future.result()
+        # Both failed
+        return first.result()
+
+    # Sends an unsigned request to a public endpoint, e.g. "public/get-tickers". Slow requests are hedged
+    def public(self, method, params=None, timeout=None):
+        def request():
+            return self.session.get(self.base_url + method, params=params, timeout=timeout or self.timeout_for(method))
+
+        return self.send(method, lambda: self.hedged(method, request))
+
+    # Signs and sends a request to a private endpoint, e.g. "private/user-balance"
+    def private(self, method, params=None, request_id=100, timeout=None):
+        if not (self.key and self.secret):
+            raise ValueError("There is no API key and API secret to sign {} with".format(method))
+
+        # Every attempt needs a new nonce, and with it a new signature
+        def request():
+            private_request = {
+                "id": request_id,
+                "method": method,
+                "api_key": self.key,
+                "params": params or {},
+                "nonce": int(time.time() * 1000)
+            }
+
+            return self.session.post(self.base_url + method,
+                                     data=json.dumps(sign_request(req=private_request, secret=self.secret)),
+                                     timeout=timeout or self.timeout_for(method))
+
+        return self.send(method, request)
+
+    def close(self):
+        self.session.close()
+
+
+# The shared client used for every call to the exchange, signing with the API key of the config file
+client = ExchangeClient(key=globals().get("api_key"), secret=globals().get("api_secret"))
+
+
+# Gets a client that trades on paper, with a ledger of its own at the prices the exchange reports
+def paper_client():
+    import paper
+    return paper.PaperClient(paper.Ledger(paper_market, dict(paper_balances), paper_fee, min_order_value), paper_market)
+
+
+# In paper trading, orders are filled into a local ledger instead of being sent to the exchange, see paper.py
+if globals().get("environment") == "paper":
+    import paper
+    paper_market = paper.Market(client)
+    client = paper_client()
+
+
+# Whether orders are placed, on the exchange or on paper. In dev mode they are only printed
+def executes_orders():
+    return environment in ("production", "paper")
+
 def colored(text, color):
     if not sys.stdin.isatty():
         return text
     else:
+        # Only needed on a terminal, so a service doesn't load it at all
+        from termcolor import colored as termcolor_colored
         return termcolor_colored(text, color)
 
 # Prints the current time
@@ -71,19 +661,7 @@ def get_available_portfolio_value(value):
 
 # Gets the total balance of a coin
 def get_coin_balance(coin):
-    coin_balance_request = {
-        "id": 100,
-        "method": "private/user-balance",
-        "api_key": api_key,
-        "params": {
-            "currency": coin
-        },
-        "nonce": int(time.time() * 1000)
-    }
-
-    coin_balance_response = requests.post("https://api.crypto.com/exchange/v1/private/user-balance",
-                                          headers={"Content-type": "application/json"},
-                                          data=json.dumps(sign_request(req=coin_balance_request)))
+    coin_balance_response = client.private("private/user-balance", {"currency": coin})
     coin_balance_data = json.loads(coin_balance_response.content)
     if not coin_balance_data["result"]["data"]:
         coin_total_balance = 0
@@ -99,296 +677,793 @@ def get_coin_balance(coin):
 
 # Gets the price of a coin pair
 def get_coin_price(pair):
-    get_price_response = requests.get("https://api.crypto.com/exchange/v1/public/get-tickers?instrument_name=" + pair)
+    get_price_response = client.public("public/get-tickers", {"instrument_name": pair})
     error = False
-    ticker = json.loads(get_price_response.content)
-    if "message" in ticker and ticker["message"] == "Invalid instrument_name":
+    try:
+        ticker = json.loads(get_price_response.content)
+        if "message" in ticker and ticker["message"] == "Invalid instrument_name":
+            return 0.0, True
+        coin_price = ticker_price(ticker["result"]["data"][0])
+    except (ValueError, KeyError, IndexError, TypeError):
+        # an error page, or a payload in a format we don't know
         return 0.0, True
-    coin_price = ticker["result"]["data"][0]["b"]
-    if coin_price == None:
-        # there is no bid at this moment, take latest trade's price
-        coin_price = ticker["result"]["data"][0]["a"]
-    return float(coin_price), error
+    if coin_price is None:
+        return 0.0, True
+    return coin_price, error
+
+
+# Keeps the details of all instruments, so they are downloaded once instead of for every order
+class InstrumentRegistry:
+    # An unknown instrument triggers a download at most this often
+    min_refresh_interval = 60
+
+    def __init__(self, ttl=instrument_cache_ttl, cache_file=instrument_cache_file):
+        self.ttl = ttl
+        self.cache_file = cache_file
+        self.instruments = {}
+        self.loaded_at = 0
+        self.lock = threading.Lock()
+
+    def expired(self):
+        return time.time() - self.loaded_at >= self.ttl
+
+    # Downloads the list of instruments, or reads it from the cache file if that is recent enough
+    def refresh(self, use_file=True):
+        if use_file and self.cache_file and os.path.exists(self.cache_file):
+            modified = os.path.getmtime(self.cache_file)
+            if time.time() - modified < self.ttl:
+                try:
+                    with open(self.cache_file) as cache:
+                        self.store(json.load(cache), modified)
+                    return
+                except (OSError, ValueError):
+                    pass
+
+        response = client.public("public/get-instruments")
+        instruments = json.loads(response.content)["result"]["data"]
+        self.store(instruments, time.time())
+
+        if self.cache_file:
+            try:
+                with open(self.cache_file + ".tmp", "w") as cache:
+                    json.dump(instruments, cache)
+                os.replace(self.cache_file + ".tmp", self.cache_file)
+            except OSError as error:
+                print(colored("Could not write the instrument cache: {}".format(error), "yellow"))
+
+    def store(self, instruments, loaded_at):
+        self.instruments = {instrument["symbol"]: instrument for instrument in instruments}
+        self.loaded_at = loaded_at
+
+    def lookup(self, pair):
+        details = self.instruments.get(pair)
+        if details is None:
+            # there is no HNT_USDT any more, try HNT_USD
+            details = self.instruments.get(pair.replace("USDT", "USD"))
+        return details
+
+    def get(self, pair):
+        with self.lock:
+            if self.expired():
+                self.refresh()
+            details = self.lookup(pair)
+            if details is None and time.time() - self.loaded_at >= self.min_refresh_interval:
+                # the instrument may have been listed after the last download
+                self.refresh(use_file=False)
+                details = self.lookup(pair)
+            return details
+
+    # Forces a new download the next time an instrument is looked up
+    def invalidate(self):
+        with self.lock:
+            self.loaded_at = 0
+            if self.cache_file and os.path.exists(self.cache_file):
+                os.remove(self.cache_file)
+
+
+# The shared registry used for every order
+instruments = InstrumentRegistry()
 
 
 # Gets the details of a coin pair
 def get_pair_details(pair):
-    def get_instrument(instruments, name):
-        for instrument in instruments:
-            if instrument["symbol"] == name:
-                return instrument
+    return instruments.get(pair)
 
-    response = requests.get("https://api.crypto.com/exchange/v1/public/get-instruments")
-    data = json.loads(response.content)
-    instruments = data["result"]["data"]
 
-    details = get_instrument(instruments, pair)
-    if details == None:
-        # there is no HNT_USDT any more, try HNT_USD
-        details = get_instrument(instruments, pair.replace("USDT", "USD"))
+# Gets the (quote_decimals, quantity_decimals) of every coin pair the exchange knows
+def get_precisions(pairs):
+    precisions = {}
+    for pair in pairs:
+        details = get_pair_details(pair[1])
+        if details is not None:
+            precisions[pair[1]] = (details["quote_decimals"], details["quantity_decimals"])
+    return precisions
 
-    return details
 
+# Gets the available quantity of every coin from the data of a user-balance response or message
+def parse_balances(accounts):
+    balances = {}
+    for account in accounts:
+        for position in account.get("position_balances", []):
+            balances[position["instrument_name"]] = float(position["quantity"]) - float(position.get("reserved_qty", 0))
+    return balances
 
-# Gets the total value of the portfolio
-def get_portfolio_value(pairs, include_usdt):
-    total_balance = 0
 
-    for pair in pairs:
-        # Gets the total number of coins for this coin pair
-        coin_balance, balance_error = get_coin_balance(pair[0])
+# Gets the price of a coin pair from a ticker
+def ticker_price(ticker):
+    coin_price = ticker.get("b")
+    if coin_price is None:
+        # there is no bid at this moment, take latest trade's price
+        coin_price = ticker.get("a")
+    if coin_price is None:
+        return None
+    return float(coin_price)
 
-        # Gets the current price for this coin pair
-        coin_price, price_error = get_coin_price(pair[1])
 
-        total_balance = total_balance + (coin_balance * coin_price)
+# Shares one download of all tickers between the tasks that need them at about the same moment,
+# e.g. the Buy tasks of several accounts
+class TickerCache:
+    def __init__(self, max_age=2):
+        self.max_age = max_age
+        self.data = None
+        self.loaded_at = 0
+        self.lock = threading.Lock()
 
-    if include_usdt:
-        # Get the total balance of USDT and add it to the current collected balance
-        usdt_total_balance, usdt_error = get_coin_balance("USDT")
+    # Forces a new download the next time the tickers are needed
+    def invalidate(self):
+        with self.lock:
+            self.data = None
 
-        total_balance = total_balance + usdt_total_balance
+    def get(self):
+        with self.lock:
+            if self.data is None or time.monotonic() - self.loaded_at > self.max_age:
+                ticker_response = client.public("public/get-tickers")
+                ticker_response.raise_for_status()
+                self.data = ticker_response.json()
+                self.loaded_at = time.monotonic()
+                publish_tickers(self.data["result"]["data"])
+            return self.data
 
-    return total_balance
 
+# The pairs traded by any account of the config file
+def configured_pairs():
+    pairs = {pair for coin, pair in globals().get("pair_list") or ()}
+    for account_config in globals().get("accounts", ()):
+        pairs.update(pair for coin, pair in account_config.get("pair_list", ()))
+    return pairs
 
-# Submits a buy order
-def order_buy(pair, notional):
-    # Finds the required price precision for this coin pair
-    pair_data = get_pair_details(pair)
-    price_precision = pair_data["quote_decimals"]
 
-    # Converts the notional into a number with the correct number of decimal places
-    notional = "%0.*f" % (price_precision, notional)
+# Called with every list of tickers PieBot downloads or streams, e.g. by the tick recorder and the drift monitors
+ticker_listeners = []
+
+
+def publish_tickers(ticker_data):
+    for listener in ticker_listeners:
+        listener(ticker_data)
+
+
+# Records the tickers of the traded pairs when record_ticks is set
+if record_ticks:
+    import recorder
+    ticker_listeners.append(recorder.TickRecorder(record_ticks, configured_pairs()).record)
+
+# The shared tickers used for every snapshot
+tickers = TickerCache()
+
+
+# Holds all balances and prices of the account, collected with one balance and one ticker request
+class PortfolioSnapshot:
+    def __init__(self, balances, prices, taken_at=None):
+        # {coin: available quantity} and {instrument: price}
+        self.balances = balances
+        self.prices = prices
+        self.taken_at = taken_at or time.time()
+
+    # Downloads all balances of the account the exchange client signs for, and all tickers
+    @classmethod
+    def fetch(cls, balance_response=None, exchange=None):
+        if balance_response is None:
+            balance_response = (exchange or client).private("private/user-balance")
+        balance_response.raise_for_status()
+
+        return cls.from_data(balance_response.json(), tickers.get())
+
+    @classmethod
+    def from_data(cls, balance_data, ticker_data):
+        balances = parse_balances(balance_data["result"]["data"])
+
+        prices = {}
+        for ticker in ticker_data["result"]["data"]:
+            coin_price = ticker_price(ticker)
+            if coin_price is not None:
+                prices[ticker["i"]] = coin_price
 
-    order_buy_request = {
-        "id": time.time_ns(),
-        "method": "private/create-order",
-        "api_key": api_key,
-        "params": {
+        return cls(balances, prices)
+
+    def age(self):
+        return time.time() - self.taken_at
+
+    def balance(self, coin):
+        return self.balances.get(coin, 0.0)
+
+    def price(self, pair):
+        return self.prices.get(pair, 0.0)
+
+    def has_price(self, pair):
+        return pair in self.prices
+
+    def pair_value(self, pair):
+        return self.balance(pair[0]) * self.price(pair[1])
+
+    def portfolio_value(self, pairs, include_usdt):
+        total_balance = sum(self.pair_value(pair) for pair in pairs)
+
+        if include_usdt:
+            total_balance = total_balance + self.balance("USDT")
+
+        return total_balance
+
+    # The USDT which can be spent, after keeping aside the defined USDT reserve
+    def available_usdt(self, pairs, reserve=None):
+        if reserve is None:
+            reserve = usdt_reserve
+        return planner.available_usdt(self.balance("USDT"), self.portfolio_value(pairs, True), reserve)
+
+
+# The streaming feed of prices and balances, if it has been started
+market_feed = None
+
+
+# Gets a snapshot from the streaming feed, or None if it isn't running or its data is stale
+def get_streamed_snapshot(pairs):
+    if market_feed is None:
+        return None
+    return market_feed.snapshot(pairs, stream_max_age)
+
+
+# Gets a snapshot from the streaming feed while it is fresh, otherwise from the REST API.
+# The balance stream belongs to the API key of the config file, other accounts always ask for their balances
+def get_snapshot(pairs, account=None):
+    if account is not None and account.client is not client:
+        return PortfolioSnapshot.fetch(exchange=account.client)
+
+    snapshot = get_streamed_snapshot(pairs)
+    if snapshot is not None:
+        return snapshot
+
+    return PortfolioSnapshot.fetch()
+
+
+# Gets the total value of the portfolio
+def get_portfolio_value(pairs, include_usdt, snapshot=None):
+    if snapshot is None:
+        snapshot = PortfolioSnapshot.fetch()
+
+    return snapshot.portfolio_value(pairs, include_usdt)
+
+
+# Builds the parameters of a market order, with the amount rounded to the instrument's precision
+def order_params(pair, side, amount):
+    pair_data = get_pair_details(pair)
+
+    if side == "BUY":
+        # Converts the notional into a number with the correct number of decimal places
+        return {
             "instrument_name": pair,
             "side": "BUY",
             "type": "MARKET",
-            "notional": notional
-        },
-        "nonce": int(time.time() * 1000)
+            "notional": "%0.*f" % (pair_data["quote_decimals"], amount)
+        }
+
+    # Converts the quantity into a number with the correct number of decimal places
+    return {
+        "instrument_name": pair,
+        "side": "SELL",
+        "type": "MARKET",
+        "quantity": "%0.*f" % (pair_data["quantity_decimals"], amount)
     }
 
-    order_buy_response = requests.post("https://api.crypto.com/exchange/v1/private/create-order",
-                                  headers={"Content-type": "application/json"},
-                                  data=json.dumps(sign_request(req=order_buy_request)))
+
+# Submits a buy order
+def order_buy(pair, notional, exchange=None):
+    order_buy_response = (exchange or client).private("private/create-order", order_params(pair, "BUY", notional), request_id=time.time_ns())
+    check_instrument_error(order_buy_response)
 
     return order_buy_response
 
 
 # Submits a sell order
-def order_sell(pair, quantity):
-    # Finds the required quantity precision for this coin pair
-    pair_data = get_pair_details(pair)
-    quantity_precision = pair_data["quantity_decimals"]
+def order_sell(pair, quantity, exchange=None):
+    order_sell_response = (exchange or client).private("private/create-order", order_params(pair, "SELL", quantity), request_id=time.time_ns())
+    check_instrument_error(order_sell_response)
 
-    # Converts the quantity into a number with the correct number of decimal places
-    quantity = "%0.*f" % (quantity_precision, quantity)
+    return order_sell_response
 
-    order_sell_request = {
-        "id": time.time_ns(),
-        "method": "private/create-order",
-        "api_key": api_key,
-        "params": {
-            "instrument_name": pair,
-            "side": "SELL",
-            "type": "MARKET",
-            "quantity": quantity
-        },
-        "nonce": int(time.time() * 1000)
-    }
 
-    order_sell_response = requests.post("https://api.crypto.com/exchange/v1/private/create-order",
-                                       headers={"Content-type": "application/json"},
-                                       data=json.dumps(sign_request(req=order_sell_request)))
+# Submits several orders with one request
+def order_list(params_list, exchange=None):
+    order_list_response = (exchange or client).private("private/create-order-list", {
+        "contingency_type": "LIST",
+        "order_list": params_list
+    }, request_id=time.time_ns())
+    check_instrument_error(order_list_response)
 
-    return order_sell_response
+    return order_list_response
 
 
-# Checks everything is in order before the bot runs
-def pre_flight_checks():
-    print(colored("Performing pre-flight checks...", "cyan"))
+# Downloads the instruments again if the exchange doesn't know the one we used
+def check_instrument_error(response):
+    if response.status_code != 200:
+        try:
+            message = response.json().get("message", "")
+        except ValueError:
+            return
+        if "instrument" in str(message).lower():
+            instruments.invalidate()
 
-    # Checks whether the environment has been defined
-    try:
-        environment
-    except NameError:
-        print(colored("Your environment is missing from the config file", "red"))
-        sys.exit()
 
-    # Checks whether the API key and API secret have been defined
-    if "API_KEY" in os.environ:
-        global api_key
-        api_key = os.environ["API_KEY"]
-    if "API_SECRET" in os.environ:
-        global api_secret
-        api_secret = os.environ["API_SECRET"]
+# What became of an order
+OrderResult = namedtuple("OrderResult", ["order", "confirmed", "status_code", "reason", "order_id", "content", "fill"], defaults=(None,))
+
+# How much of an order was filled, and at which average price
+Fill = namedtuple("Fill", ["status", "quantity", "avg_price", "value"])
+
+# Once an order has one of these, it won't change any more
+terminal_statuses = ("FILLED", "CANCELED", "REJECTED", "EXPIRED")
+
+
+# Places a single order and reports the outcome instead of raising
+def place_order(order, exchange=None):
+    if get_pair_details(order.pair) is None:
+        return OrderResult(order, False, None, "Unknown instrument", None, None)
+
+    try:
+        if order.side == "BUY":
+            response = order_buy(order.pair, order.amount, exchange)
+        else:
+            response = order_sell(order.pair, order.amount, exchange)
+    except requests.RequestException as error:
+        return OrderResult(order, False, None, type(error).__name__, None, str(error))
+
+    order_id = None
+    if response.status_code == 200:
+        try:
+            order_id = response.json()["result"]["order_id"]
+        except (ValueError, KeyError, TypeError):
+            pass
+
+    return OrderResult(order, response.status_code == 200, response.status_code, response.reason, order_id, response.content)
+
+
+# Places up to max_order_list_size orders with one request, and maps the outcome of each back to its order
+def place_order_list(orders, exchange=None):
+    results = [None] * len(orders)
+    batch = []
+    for index, order in enumerate(orders):
+        if get_pair_details(order.pair) is None:
+            results[index] = OrderResult(order, False, None, "Unknown instrument", None, None)
+        else:
+            batch.append(index)
+
+    if len(batch) == 1:
+        results[batch[0]] = place_order(orders[batch[0]], exchange)
+    elif batch:
+        try:
+            response = order_list([order_params(orders[index].pair, orders[index].side, orders[index].amount) for index in batch], exchange)
+        except requests.RequestException as error:
+            for index in batch:
+                results[index] = OrderResult(orders[index], False, None, type(error).__name__, None, str(error))
+            return results
+
+        legs = {}
+        if response.status_code == 200:
+            try:
+                legs = {leg["index"]: leg for leg in response.json()["result"]["result_list"]}
+            except (ValueError, KeyError, TypeError):
+                pass
+
+        for position, index in enumerate(batch):
+            leg = legs.get(position)
+            if leg is None:
+                results[index] = OrderResult(orders[index], False, response.status_code, response.reason, None, response.content)
+            else:
+                confirmed = leg.get("code", 0) == 0
+                results[index] = OrderResult(orders[index], confirmed, response.status_code,
+                                             "OK" if confirmed else leg.get("message", response.reason),
+                                             leg.get("order_id"), json.dumps(leg))
+
+    return results
+
+
+# Sends independent orders to the exchange concurrently
+class OrderDispatcher:
+    def __init__(self, concurrency=order_concurrency, exchange=None):
+        self.concurrency = max(1, concurrency)
+        self.exchange = exchange
+
+    # Places all orders and waits for them, so the caller can run its phases one after the other.
+    # The results are in the same order as the orders
+    def submit(self, orders, dry_run=False, batch=None):
+        if dry_run:
+            return [OrderResult(order, True, None, "Dry run", None, None) for order in orders]
+        if not orders:
+            return []
+        if batch is None:
+            batch = batch_orders
+
+        # Looking up one instrument downloads the list for all others
+        get_pair_details(orders[0].pair)
+
+        # The client keeps the orders within the exchange's rate limit
+        if batch:
+            chunks = [orders[start:start + max_order_list_size] for start in range(0, len(orders), max_order_list_size)]
+            with ThreadPoolExecutor(max_workers=min(self.concurrency, len(chunks))) as executor:
+                return [result for results in executor.map(place_order_list, chunks, [self.exchange] * len(chunks)) for result in results]
+
+        with ThreadPoolExecutor(max_workers=min(self.concurrency, len(orders))) as executor:
+            return list(executor.map(place_order, orders, [self.exchange] * len(orders)))
+
+
+# The shared dispatcher used for every order
+dispatcher = OrderDispatcher()
+
+
+# Follows placed orders until the exchange has finished with them. Their details have a rate limit of their own,
+# so more of them are asked for at once than orders are sent
+class OrderTracker:
+    def __init__(self, timeout=fill_timeout, poll_interval=0.5, concurrency=16, exchange=None):
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.concurrency = max(1, concurrency)
+        self.exchange = exchange or client
+
+    def order_detail(self, order_id):
+        try:
+            response = self.exchange.private("private/get-order-detail", {"order_id": order_id})
+            if response.status_code != 200:
+                return None
+            detail = response.json()["result"]
+            return Fill(detail["status"],
+                        float(detail.get("cumulative_quantity") or 0),
+                        float(detail.get("avg_price") or 0),
+                        float(detail.get("cumulative_value") or 0))
+        except (requests.RequestException, ValueError, KeyError, TypeError):
+            return None
+
+    # Polls until every confirmed order has reached a final status or the timeout has passed,
+    # and returns the results with what is known about their fills
+    def wait(self, results):
+        pending = {str(result.order_id) for result in results if result.confirmed and result.order_id is not None}
+        fills = {}
+        deadline = time.monotonic() + self.timeout
+
+        while pending:
+            # Market orders are usually filled by the time they are confirmed, so there is no point in asking
+            # which orders are still open first
+            polled = sorted(pending)
+            with ThreadPoolExecutor(max_workers=min(self.concurrency, len(polled))) as executor:
+                for order_id, fill in zip(polled, executor.map(self.order_detail, polled)):
+                    if fill is None:
+                        continue
+                    fills[order_id] = fill
+                    if fill.status in terminal_statuses:
+                        pending.discard(order_id)
+
+            if not pending or time.monotonic() + self.poll_interval > deadline:
+                break
+            time.sleep(self.poll_interval)
+
+        return [result._replace(fill=fills.get(str(result.order_id))) for result in results]
+
+
+# The shared tracker used for every order
+tracker = OrderTracker()
+
+
+# Sends the requests of the config file's account to a paper client instead of the exchange,
+# e.g. to replay recorded prices. Needs to be called before the accounts are loaded
+def use_paper_client(replacement):
+    global client, tracker, environment, paper_market
+    client = replacement
+    tracker = OrderTracker(exchange=replacement)
+    paper_market = replacement.market
+    environment = "paper"
+
+
+# The settings an account of the accounts list can set for itself. Those it leaves out are taken from the config file
+account_settings = ("pair_list", "buy_frequency", "rebalance_frequency", "rebalance_threshold", "buy_order_value", "usdt_reserve", "state_file",
+                    "drift_rebalance")
+
+
+# An account PieBot trades for. Every account has its own API key, orders and records,
+# while the tickers, the instruments and the metrics endpoint are shared by all of them
+class Account:
+    def __init__(self, name, api_key=None, api_secret=None, **settings):
+        self.name = name
+        for setting in account_settings:
+            setattr(self, setting, settings.pop(setting, globals().get(setting)))
+        self.unknown_settings = sorted(settings)
+        # The state store of the account, if it has a state file
+        self.history = None
+        # Set once PieBot could connect to the account
+        self.ready = threading.Event()
+        # The drift monitor of the account, if it rebalances on drift
+        self.drift = None
+        # Held while Buy or Rebalance places the orders of the account
+        self.trading_lock = threading.Lock()
+
+        if environment == "paper" and uses_accounts_list():
+            # Every account trades on paper, with a ledger of its own
+            self.client = paper_client()
+            self.dispatcher = OrderDispatcher(exchange=self.client)
+            self.tracker = OrderTracker(exchange=self.client)
+        elif api_key is None and api_secret is None:
+            # The account of the API key in the config file uses the shared client
+            self.client = client
+            self.dispatcher = dispatcher
+            self.tracker = tracker
+        else:
+            self.client = ExchangeClient(key=api_key, secret=api_secret, public_limit=client.rate_limits["public"])
+            self.dispatcher = OrderDispatcher(exchange=self.client)
+            self.tracker = OrderTracker(exchange=self.client)
+
+    def uses_threshold(self):
+        return self.rebalance_threshold is not None and self.rebalance_threshold > 0
+
+
+# Gets the accounts to trade for. Without an accounts list, the config file describes a single account
+def load_accounts():
     try:
-        api_key and api_secret
+        account_configs = accounts
     except NameError:
-        print(colored("Your API key and API secret are missing from the config file", "red"))
-        sys.exit()
+        return [Account(account_name)]
+
+    loaded = []
+    for index, account_config in enumerate(account_configs):
+        account_config = dict(account_config)
+        name = account_config.pop("name", "{}-{}".format(account_name, index + 1))
+        loaded.append(Account(name, **account_config))
+    return loaded
+
+
+# Gets what is wrong with the settings of an account, nothing if they are all valid
+def account_problems(account):
+    problems = []
+    if account.unknown_settings:
+        problems.append("Unknown settings: " + ", ".join(account.unknown_settings))
+
+    # An account without a key of its own uses the one of the config file
+    if environment != "paper" and not (account.client.key and account.client.secret):
+        problems.append("Your API key and API secret are missing from the config file")
 
     # Checks whether the trading pairs have been defined, and if there is enough to begin trading
-    try:
-        pair_list
-    except NameError:
-        print(colored("Your trading coin pairs are missing from the config file", "red"))
-        sys.exit()
-    else:
-        if len(pair_list) < 1:
-            print(colored("You need to use at least one coin pair", "red"))
-            sys.exit()
+    if account.pair_list is None:
+        problems.append("Your trading coin pairs are missing from the config file")
+    elif len(account.pair_list) < 1:
+        problems.append("You need to use at least one coin pair")
 
     # Checks whether the Buy task frequency has been defined
-    try:
-        buy_frequency
-    except NameError:
-        print(colored("Your Buy task frequency is missing from the config file", "red"))
-        sys.exit()
-    else:
-        if buy_frequency < 1:
-            print(colored("Your Buy task frequency must be at least 1 hour", "red"))
-            sys.exit()
+    if account.buy_frequency is None:
+        problems.append("Your Buy task frequency is missing from the config file")
+    elif account.buy_frequency < 1:
+        problems.append("Your Buy task frequency must be at least 1 hour")
 
     # Checks whether the Rebalance task frequency has been defined
-    try:
-        rebalance_frequency
-    except NameError:
-        print(colored("Your Rebalance task frequency is missing from the config file", "red"))
-        sys.exit()
-    else:
-        if rebalance_frequency < 0:
-            print(colored("Your Rebalance task frequency cannot be less than 0", "red"))
-            sys.exit()
+    if account.rebalance_frequency is None:
+        problems.append("Your Rebalance task frequency is missing from the config file")
+    elif account.rebalance_frequency < 0:
+        problems.append("Your Rebalance task frequency cannot be less than 0")
+
+    # Only a coin that drifts past the threshold starts a Rebalance
+    if account.drift_rebalance and not account.uses_threshold():
+        problems.append("Rebalancing on drift needs a rebalance threshold greater than 0")
 
     # Checks whether the maximum Buy order value has been defined and is valid
+    if account.buy_order_value is None:
+        problems.append("Your Buy order value is missing from the config file")
+    elif account.buy_order_value < min_order_value:
+        problems.append("Your Buy order value cannot be smaller than the minimum order value")
+
+    # Checks whether the USDT reserve amount has been defined
+    if account.usdt_reserve is None:
+        problems.append("Your USDT reserve amount is missing from the config file")
+    elif account.usdt_reserve < 0:
+        problems.append("You need to define a valid USDT reserve. If you don't want to use a reserve, set the value as 0")
+    elif account.usdt_reserve > 80:
+        problems.append("Your USDT reserve must be 80% or lower")
+
+    return problems
+
+
+# Whether the config file has an accounts list, instead of describing a single account
+def uses_accounts_list():
     try:
-        buy_order_value
+        accounts
     except NameError:
-        print(colored("Your Buy order value is missing from the config file", "red"))
-        sys.exit()
-    else:
-        if buy_order_value < min_order_value:
-            print(colored("Your Buy order value cannot be smaller than the minimum order value", "red"))
-            sys.exit()
+        return False
+    return True
 
-    # Checks whether the USDT reserve amount has been defined
+
+# Puts the name of the account in front of a message when there are several accounts
+def account_message(account, message):
+    if uses_accounts_list():
+        return account.name + ": " + message
+    return message
+
+
+# Checks the config file before the bot runs, without talking to the exchange, and returns the accounts to trade for.
+# With an accounts list, an account with invalid settings is left out and the others carry on
+def check_config():
+    # Checks whether the environment has been defined
     try:
-        usdt_reserve
+        environment
     except NameError:
-        print(colored("Your USDT reserve amount is missing from the config file", "red"))
+        print(colored("Your environment is missing from the config file", "red"))
         sys.exit()
-    else:
-        if usdt_reserve < 0:
-            print(colored("You need to define a valid USDT reserve. If you don't want to use a reserve, set the value as 0", "red"))
-            sys.exit()
-        elif usdt_reserve > 80:
-            print(colored("Your USDT reserve must be 80% or lower", "red"))
-            sys.exit()
-
-    # Send a private request to test if the API key and API secret are correct
-    init_request = {
-        "id": 100,
-        "method": "private/user-balance",
-        "api_key": api_key,
-        "params": {
-            "currency": "USDT"
-        },
-        "nonce": int(time.time() * 1000)
-    }
 
-    init_response = requests.post("https://api.crypto.com/exchange/v1/private/user-balance",
-                                  headers={"Content-type": "application/json"},
-                                  data=json.dumps(sign_request(req=init_request)))
-    init_status = init_response.status_code
+    checked = load_accounts()
+    names = [account.name for account in checked]
+    valid = []
+    for account in checked:
+        problems = account_problems(account)
+        if names.count(account.name) > 1:
+            problems.append("The account name is used more than once")
+        for problem in problems:
+            print(colored(account_message(account, problem), "red"))
+        if not problems:
+            valid.append(account)
+
+    if not valid or (not uses_accounts_list() and len(valid) < len(checked)):
+        sys.exit()
+    return valid
 
-    if init_status == 200:
-        # The bot can connect to the account, has been started, and is waiting to be called
-        print(colored("Pre-flight checks successful", "green"))
-        for position in get_account_details():
-            print("{:<10s} {:20.4f} {:14.8f} = {:10.2f} {:s}".format(position["coin"], position["balance"], float(position["price"]), float(position["balance"]) * float(position["price"]), position["state"]))
 
-    else:
-        # Could not connect to the account
-        print(colored("Could not connect to your account. Please ensure the API key and API secret are correct and have the right privileges", "red"))
-        sys.exit()
+# Sends a private request to test if the API key and API secret of an account are correct.
+# Returns "ready" with a snapshot of the account, "rejected" if the exchange refused the key,
+# or "unreachable" if the exchange couldn't be asked right now
+def check_connection(account):
+    try:
+        init_response = account.client.private("private/user-balance")
+        if init_response.status_code == 200:
+            return "ready", PortfolioSnapshot.fetch(init_response)
+        if init_response.status_code in (401, 403):
+            return "rejected", None
+    except (requests.RequestException, ValueError):
+        pass
+    return "unreachable", None
+
+
+# Marks an account as ready and prints its positions
+def account_connected(account, snapshot):
+    # The bot can connect to the account, has been started, and is waiting to be called
+    print(colored(account_message(account, "Pre-flight checks successful"), "green"))
+    for position in get_account_details(snapshot, account):
+        print("{:<10s} {:20.4f} {:14.8f} = {:10.2f} {:s}".format(position["coin"], position["balance"], float(position["price"]), float(position["balance"]) * float(position["price"]), position["state"]))
+    account.ready.set()
+    metrics.account_ready.labels(account.name).set(1)
+
+
+def connection_failed(account):
+    # Could not connect to the account
+    print(colored(account_message(account, "Could not connect to your account. Please ensure the API key and API secret are correct and have the right privileges"), "red"))
+
+
+# Checks everything is in order before the bot runs, and returns the accounts which are ready to trade.
+# The accounts are checked at the same time. With an accounts list, an account that fails is left out
+def pre_flight_checks(checked=None):
+    print(colored("Performing pre-flight checks...", "cyan"))
+    if checked is None:
+        checked = check_config()
 
+    with ThreadPoolExecutor(max_workers=len(checked)) as executor:
+        outcomes = list(executor.map(check_connection, checked))
 
-def get_account_details():
-    # return a list of positions with keys coin, balance, price each
-    positions = []
-    init_request = {
-        "id": 100,
-        "method": "private/user-balance",
-        "api_key": api_key,
-        "params": {
-#            "currency": "USDT"
-        },
-        "nonce": int(time.time() * 1000)
-    }
+    ready = []
+    for account, (status, snapshot) in zip(checked, outcomes):
+        if status == "ready":
+            account_connected(account, snapshot)
+            ready.append(account)
+        else:
+            connection_failed(account)
 
-    init_response = requests.post("https://api.crypto.com/exchange/v1/private/user-balance",
-                                  headers={"Content-type": "application/json"},
-                                  data=json.dumps(sign_request(req=init_request)))
-    init_status = init_response.status_code
-
-    if init_status == 200:
-        summary_data = init_response.json()
-        ticker_request = {
-            "id": 100,
-            "method": "private/user-balance",
-            "api_key": api_key,
-            "params": {},
-            "nonce": int(time.time() * 1000)
-        }
+    if not ready or (not uses_accounts_list() and len(ready) < len(checked)):
+        sys.exit()
+    return ready
+
+
+# Checks the connection to every account in the background, so PieBot starts without waiting for the exchange.
+# An account the exchange can't be reached for is tried again with a growing delay, one whose key is refused is left out.
+# on_ready(account, snapshot) is called once an account is ready
+def connect_in_background(checked, on_ready=None, retry_delay=5, max_retry_delay=300):
+    def connect(account):
+        delay = retry_delay
+        while True:
+            status, snapshot = check_connection(account)
+            if status == "ready":
+                account_connected(account, snapshot)
+                if on_ready:
+                    on_ready(account, snapshot)
+                return
+            if status == "rejected":
+                connection_failed(account)
+                return
+
+            current_time(True)
+            print(colored(account_message(account, "The exchange can't be reached, trying again in {} seconds".format(delay)), "yellow"))
+            time.sleep(delay)
+            delay = min(delay * 2, max_retry_delay)
+
+    for account in checked:
+        metrics.account_ready.labels(account.name).set(0)
+        threading.Thread(target=connect, args=(account,), name="pre-flight-" + account.name, daemon=True).start()
+
+
+def get_account_details(snapshot=None, account=None):
+    # return a list of positions with keys coin, balance, price each
+    if snapshot is None:
+        snapshot = PortfolioSnapshot.fetch(exchange=None if account is None else account.client)
+    name = account_name if account is None else account.name
 
-        ticker_response = requests.get("https://api.crypto.com/exchnage/v1/public/get-tickers",
-                                  headers={"Content-type": "application/json"},
-                                  data=json.dumps(sign_request(req=ticker_request)))
-        ticker_status = ticker_response.status_code
-        ticker_data = ticker_response.json()
-        for account in sorted(summary_data["result"]["data"], key=lambda x: x["i"]):
-            if account["i"] == "USDT":
+    managed_pairs = dict(pair_list if account is None else account.pair_list)
+    positions = []
+    for coin in sorted(snapshot.balances):
+        if coin == "USDT":
+            positions.append({
+                "account": name,
+                "coin": "USDT",
+                "balance": snapshot.balance("USDT"),
+                "price": 1,
+                "state": "unmanaged",
+            })
+        elif snapshot.balance(coin) > 0.0:
+            pair = managed_pairs.get(coin, coin + "_USDT")
+            if snapshot.has_price(pair):
                 positions.append({
-                    "account": account_name,
-                    "coin": "USDT",
-                    "balance": account["balance"],
-                    "price": 1,
-                    "state": "unmanaged",
+                    "account": name,
+                    "coin": coin,
+                    "balance": snapshot.balance(coin),
+                    "price": snapshot.price(pair),
+                    "state": "managed" if coin in managed_pairs else "unmanaged",
                 })
-            elif account["balance"] > 0.0:
-                pair = account["currency"]+"_USDT"
-                latest_bid = [tick["a"] for tick in ticker_data["result"]["data"] if tick["i"] == pair]
-                if latest_bid:
-                    positions.append({
-                        "account": account_name,
-                        "coin": account["currency"],
-                        "balance": account["balance"],
-                        "price": latest_bid[0],
-                        "state": "managed" if [p for p in pair_list if p[0] == account["currency"]] else "unmanaged",
-                    })
-        return positions
+    return positions
+
+
+# Turns the parameters of a private request into the string that is signed.
+# Lists of orders are flattened, one level deeper for each nested object
+def params_to_str(params, level=0):
+    if level >= 3:
+        return str(params)
+
+    param_string = ""
+    for key in sorted(params):
+        param_string += key
+        if params[key] is None:
+            param_string += "null"
+        elif isinstance(params[key], list):
+            for item in params[key]:
+                if isinstance(item, dict):
+                    param_string += params_to_str(item, level + 1)
+                else:
+                    param_string += str(item)
+        else:
+            param_string += str(params[key])
+
+    return param_string
 
 
 # Signs private requests
-def sign_request(req):
+def sign_request(req, secret=None):
+    if secret is None:
+        secret = api_secret
     param_string = ""
 
     if "params" in req:
-        for key in sorted(req["params"]):
-            param_string += key
-            param_string += str(req["params"][key])
+        param_string = params_to_str(req["params"])
 
     sig_payload = req["method"] + str(req["id"]) + req["api_key"] + param_string + str(req["nonce"])
 
     req["sig"] = hmac.new(
-        bytes(str(api_secret), "utf-8"),
+        bytes(str(secret), "utf-8"),
         msg=bytes(sig_payload, "utf-8"),
         digestmod=hashlib.sha256
     ).hexdigest()
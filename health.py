@@ -0,0 +1,183 @@
+import itertools
+import json
+import threading
+import time
+from collections import deque
+from urllib.parse import parse_qs
+from wsgiref.simple_server import WSGIRequestHandler, make_server
+
+# Serves /healthz, /readyz and /state next to the Prometheus /metrics, all from what PieBot keeps in memory.
+# None of them ever talks to the exchange, so probes don't add load to the tasks
+
+
+# What PieBot is doing right now: the heartbeat of its loop, the orders on their way, and the latest errors
+class BotState:
+    def __init__(self, accounts=(), collector=None, heartbeat_timeout=60, max_errors=20):
+        self.accounts = list(accounts)
+        self.collector = collector
+        self.heartbeat_timeout = heartbeat_timeout
+        self.started_at = time.time()
+        self.heartbeat_at = None
+        # Returns the next run of every job, set by the runtime
+        self.jobs = None
+        self.lock = threading.Lock()
+        self.errors = deque(maxlen=max_errors)
+        self.in_flight = {}
+        self.order_keys = itertools.count()
+        # {(task, account name): time}
+        self.last_success = {}
+
+    # Called by the loop of the runtime, to show it is still running
+    def beat(self):
+        self.heartbeat_at = time.time()
+
+    def error(self, task, account, error):
+        with self.lock:
+            self.errors.append({"time": time.time(), "task": task, "account": account, "error": repr(error)})
+
+    def succeeded(self, task, account):
+        with self.lock:
+            self.last_success[(task, account)] = time.time()
+
+    # Remembers orders until orders_done() is called with the key this returns
+    def orders_sent(self, task, account, orders):
+        key = next(self.order_keys)
+        with self.lock:
+            self.in_flight[key] = {
+                "task": task,
+                "account": account,
+                "sent_at": time.time(),
+                "orders": [{"coin": order.coin, "pair": order.pair, "side": order.side, "amount": order.amount} for order in orders],
+            }
+        return key
+
+    def orders_done(self, key):
+        with self.lock:
+            self.in_flight.pop(key, None)
+
+    # Alive while the loop has beaten recently. Before the first beat, PieBot is still starting
+    def alive(self):
+        if self.heartbeat_at is None:
+            return time.time() - self.started_at < self.heartbeat_timeout
+        return time.time() - self.heartbeat_at < self.heartbeat_timeout
+
+    # Ready once any account has passed its pre-flight checks
+    def ready(self):
+        return any(account.ready.is_set() for account in self.accounts)
+
+    def snapshot_age(self, account):
+        if self.collector is None:
+            return None
+        age = self.collector.age(account)
+        return None if age == float("inf") else age
+
+    def state(self):
+        with self.lock:
+            errors = list(self.errors)
+            in_flight = list(self.in_flight.values())
+            last_success = dict(self.last_success)
+
+        accounts = {}
+        for account in self.accounts:
+            accounts[account.name] = {
+                "ready": account.ready.is_set(),
+                "snapshot_age": self.snapshot_age(account),
+                "last_success": {task: at for (task, name), at in last_success.items() if name == account.name},
+            }
+
+        return {
+            "alive": self.alive(),
+            "ready": self.ready(),
+            "started_at": self.started_at,
+            "heartbeat_at": self.heartbeat_at,
+            "accounts": accounts,
+            "jobs": self.jobs() if self.jobs else [],
+            "in_flight_orders": in_flight,
+            "errors": errors,
+        }
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def reply(start_response, status, body, content_type="application/json"):
+    if isinstance(body, str):
+        data = body.encode("utf-8")
+    elif isinstance(body, bytes):
+        data = body
+    else:
+        data = json.dumps(body).encode("utf-8")
+    start_response(status, [("Content-Type", content_type), ("Content-Length", str(len(data)))])
+    return [data]
+
+
+# The profiler and the memory tracing of diagnostics.py. Anything that changes them needs a POST
+def debug_app(diagnostics, environ, start_response):
+    path = environ.get("PATH_INFO", "/")
+    method = environ.get("REQUEST_METHOD", "GET")
+    query = parse_qs(environ.get("QUERY_STRING", ""))
+
+    try:
+        if path == "/debug/profile" and method == "POST":
+            return reply(start_response, "200 OK", {"armed": diagnostics.arm(int(query.get("cycles", ["1"])[0]))})
+        if path == "/debug/profile":
+            text = diagnostics.profile_text(query.get("sort", ["cumulative"])[0])
+            if text is None:
+                return reply(start_response, "404 Not Found", {"error": "No cycle has been profiled yet, POST to /debug/profile first"})
+            return reply(start_response, "200 OK", text, "text/plain; charset=utf-8")
+        if path == "/debug/profile.prof":
+            data = diagnostics.profile_data()
+            if data is None:
+                return reply(start_response, "404 Not Found", {"error": "No cycle has been profiled yet, POST to /debug/profile first"})
+            return reply(start_response, "200 OK", data, "application/octet-stream")
+        if path == "/debug/memory/start" and method == "POST":
+            diagnostics.start_tracing(int(query.get("frames", ["1"])[0]))
+            return reply(start_response, "200 OK", diagnostics.memory())
+        if path == "/debug/memory/stop" and method == "POST":
+            diagnostics.stop_tracing()
+            return reply(start_response, "200 OK", diagnostics.memory())
+        if path == "/debug/memory":
+            return reply(start_response, "200 OK", diagnostics.memory())
+    except ValueError as error:
+        return reply(start_response, "400 Bad Request", {"error": str(error)})
+    return reply(start_response, "404 Not Found", {"error": "Unknown path " + path})
+
+
+# Starts the HTTP server for the metrics and the health endpoints in a thread
+def serve(state, port=19000, address="0.0.0.0"):
+    from prometheus_client import make_wsgi_app
+    from prometheus_client.exposition import ThreadingWSGIServer
+
+    metrics_app = make_wsgi_app()
+
+    def app(environ, start_response):
+        path = environ.get("PATH_INFO", "/")
+        if path == "/healthz":
+            alive = state.alive()
+            return reply(start_response, "200 OK" if alive else "503 Service Unavailable", {"alive": alive, "heartbeat_at": state.heartbeat_at})
+        if path == "/readyz":
+            ready = state.ready()
+            return reply(start_response, "200 OK" if ready else "503 Service Unavailable",
+                         {"ready": ready, "accounts": {account.name: account.ready.is_set() for account in state.accounts}})
+        if path == "/state":
+            return reply(start_response, "200 OK", state.state())
+        return metrics_app(environ, start_response)
+
+    server = make_server(address, port, app, ThreadingWSGIServer, handler_class=QuietHandler)
+    threading.Thread(target=server.serve_forever, name="http-server", daemon=True).start()
+    return server
+
+
+# Starts the HTTP server for the /debug endpoints in a thread. They can change how PieBot runs and show its code,
+# so they get a port of their own, only reachable from the same host unless another address is given
+def serve_debug(diagnostics, port, address="127.0.0.1"):
+    from prometheus_client.exposition import ThreadingWSGIServer
+
+    def app(environ, start_response):
+        return debug_app(diagnostics, environ, start_response)
+
+    server = make_server(address, port, app, ThreadingWSGIServer, handler_class=QuietHandler)
+    threading.Thread(target=server.serve_forever, name="debug-server", daemon=True).start()
+    return server
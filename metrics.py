@@ -0,0 +1,70 @@
+import time
+from prometheus_client import Counter, Gauge, Histogram
+
+# The metrics of the exchange requests and the tasks, exported together with the coin metrics of PieBot.py
+
+request_seconds = Histogram("exchange_request_seconds", "Duration of the requests to the exchange", ["method", "status"],
+                            buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+requests_sent = Counter("exchange_requests", "Requests sent to the exchange", ["method", "status"])
+retries = Counter("exchange_retries", "Requests sent again after a server error, a connection error or a rate limit", ["method", "reason"])
+rate_limited = Counter("exchange_rate_limited", "Responses saying that too many requests were sent", ["method"])
+circuit_open = Gauge("exchange_circuit_open", "1 while the requests to an endpoint are held back after too many failed", ["method"])
+circuit_rejected = Counter("exchange_circuit_rejected", "Requests held back while the circuit breaker of their endpoint was open", ["method"])
+hedged_requests = Counter("exchange_hedged_requests", "Public requests sent a second time because the first was slow, by which one answered first",
+                          ["method", "winner"])
+
+phase_seconds = Histogram("task_phase_seconds", "Duration of each phase of the Buy and Rebalance tasks", ["task", "phase", "account"],
+                          buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60))
+task_seconds = Histogram("task_seconds", "Duration of the tasks", ["task", "account"],
+                         buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300))
+last_success = Gauge("task_last_success_timestamp_seconds", "When a task last finished without an error", ["task", "account"])
+account_ready = Gauge("account_ready", "1 once PieBot could connect to the account, 0 until then", ["account"])
+
+drift_rebalances = Counter("drift_rebalances", "Rebalances started because a coin drifted past the threshold, and those held back by the orders cap",
+                           ["account", "outcome"])
+
+# Positive when the fill was worse than the price the order was planned with. The exchange only reports the fill
+# price of an order when it is asked for it, so only the orders whose fills PieBot follows are observed, see track_fills
+slippage = Histogram("order_slippage_ratio", "Difference between the planned price and the average fill price of the orders whose fills were followed",
+                     ["side", "account"],
+                     buckets=(-0.01, -0.005, -0.001, 0, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05))
+
+
+# Records one request to the exchange. status is the HTTP status, or the name of the error if there was no response
+def observe_request(method, status, seconds):
+    request_seconds.labels(method, status).observe(seconds)
+    requests_sent.labels(method, status).inc()
+
+
+# Counts the retries urllib3 made before the response arrived
+def observe_retries(method, response):
+    history = getattr(getattr(response, "raw", None), "retries", None)
+    for attempt in getattr(history, "history", ()):
+        retries.labels(method, "connection" if attempt.error is not None else "server_error").inc()
+
+
+# Times a phase of a task, e.g. with phase("buy", "fetch", "piebot"):
+def phase(task, name, account):
+    return phase_seconds.labels(task, name, account).time()
+
+
+def task_finished(task, account, started):
+    task_seconds.labels(task, account).observe(time.perf_counter() - started)
+    last_success.labels(task, account).set_to_current_time()
+
+
+# The slippage of a filled order as a share of its planned price, None if either price is unknown
+def order_slippage(order, fill):
+    if not order.price or fill is None or not fill.avg_price:
+        return None
+    if order.side == "BUY":
+        return (fill.avg_price - order.price) / order.price
+    return (order.price - fill.avg_price) / order.price
+
+
+# Observes the slippage of every order with a fill price, the others are left out
+def observe_fills(results, account):
+    for result in results:
+        ratio = order_slippage(result.order, result.fill)
+        if ratio is not None:
+            slippage.labels(result.order.side, account).observe(ratio)
@@ -0,0 +1,535 @@
+import argparse
+import base64
+import hashlib
+import hmac
+import json
+import random
+import select
+import struct
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+# A local stand-in for the Crypto.com Exchange, so PieBot can be run, tested and benchmarked without the real API.
+# Point exchange_url at http://127.0.0.1:<port>/exchange/v1/ and stream_url at ws://127.0.0.1:<port>/exchange/v1/
+
+api_path = "/exchange/v1/"
+websocket_guid = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+
+# Turns the parameters of a private request into the string that is signed, like the exchange does
+def params_to_str(params, level=0):
+    if level >= 3:
+        return str(params)
+
+    param_string = ""
+    for key in sorted(params):
+        param_string += key
+        if params[key] is None:
+            param_string += "null"
+        elif isinstance(params[key], list):
+            for item in params[key]:
+                param_string += params_to_str(item, level + 1) if isinstance(item, dict) else str(item)
+        else:
+            param_string += str(params[key])
+    return param_string
+
+
+def signature(secret, req):
+    sig_payload = req["method"] + str(req["id"]) + req["api_key"] + params_to_str(req.get("params", {})) + str(req["nonce"])
+    return hmac.new(bytes(secret, "utf-8"), msg=bytes(sig_payload, "utf-8"), digestmod=hashlib.sha256).hexdigest()
+
+
+# Finds the group of rate limits an endpoint belongs to
+def rate_limit_group(method):
+    if method.startswith("public/"):
+        return "public"
+    if method.startswith("private/create-order") or method.startswith("private/cancel-"):
+        return "order"
+    if method == "private/get-order-detail":
+        return "order_detail"
+    return "private"
+
+
+# A token bucket which refuses instead of waiting
+class RateLimit:
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.capacity = max(1.0, rate / 10)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+
+class ExchangeError(Exception):
+    def __init__(self, status, code, message):
+        super().__init__(message)
+        self.status = status
+        self.code = code
+        self.message = message
+
+
+# The state of the simulated exchange: the accounts and their balances, the prices, and the orders placed.
+# sub_accounts maps further API keys to their (api_secret, balances)
+class MockExchange:
+    def __init__(self, prices, balances, api_key="key", api_secret="secret", latency=0.0, jitter=0.0,
+                 error_rate=0.0, rate_limits=None, spread=0.001, fee=0.0, volatility=0.0,
+                 padding_instruments=0, heartbeat_interval=30, ticker_interval=1.0, seed=None, sub_accounts=None):
+        self.prices = dict(prices)
+        self.balances = dict(balances)
+        self.api_key = api_key
+        self.api_secret = api_secret
+        # {api_key: (api_secret, balances)}, the balances of the main account are self.balances
+        self.accounts = {api_key: (api_secret, self.balances)}
+        for key, (secret, sub_balances) in (sub_accounts or {}).items():
+            self.accounts[key] = (secret, dict(sub_balances))
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limits = {group: RateLimit(rate) for group, rate in (rate_limits or {}).items()}
+        self.spread = spread
+        self.fee = fee
+        self.volatility = volatility
+        self.padding_instruments = padding_instruments
+        self.heartbeat_interval = heartbeat_interval
+        self.ticker_interval = ticker_interval
+        self.random = random.Random(seed)
+        self.orders = {}
+        self.balance_version = 0
+        self.lock = threading.Lock()
+        self.server = None
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.stats = {"requests": 0, "bytes_in": 0, "bytes_out": 0, "rate_limited": 0, "errors": 0, "by_method": {}}
+
+    def count(self, method, bytes_in, bytes_out):
+        with self.lock:
+            self.stats["requests"] += 1
+            self.stats["bytes_in"] += bytes_in
+            self.stats["bytes_out"] += bytes_out
+            self.stats["by_method"][method] = self.stats["by_method"].get(method, 0) + 1
+
+    def start(self, host="127.0.0.1", port=0):
+        self.server = ThreadingHTTPServer((host, port), MockHandler)
+        self.server.daemon_threads = True
+        self.server.exchange = self
+        threading.Thread(target=self.server.serve_forever, name="mock-exchange", daemon=True).start()
+        return "http://{}:{}{}".format(host, self.server.server_port, api_path)
+
+    @property
+    def stream_url(self):
+        return "ws://{}:{}{}".format(self.server.server_address[0], self.server.server_port, api_path)
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def wait(self):
+        delay = self.latency + (self.random.uniform(0, self.jitter) if self.jitter else 0)
+        if delay > 0:
+            time.sleep(delay)
+
+    def check_limits(self, method):
+        limit = self.rate_limits.get(rate_limit_group(method))
+        if limit and not limit.allow():
+            with self.lock:
+                self.stats["rate_limited"] += 1
+            raise ExchangeError(429, 42901, "TOO_MANY_REQUESTS")
+        if self.error_rate and self.random.random() < self.error_rate:
+            with self.lock:
+                self.stats["errors"] += 1
+            raise ExchangeError(500, 50001, "SYS_ERROR")
+
+    # Returns the balances of the account the request is signed for
+    def authenticate(self, req):
+        account = self.accounts.get(req.get("api_key"))
+        if account is None or req.get("sig") != signature(account[0], req):
+            raise ExchangeError(401, 40101, "Authentication failure")
+        if abs(int(req.get("nonce", 0)) - time.time() * 1000) > 60000:
+            raise ExchangeError(401, 40102, "Invalid nonce")
+        return account[1]
+
+    def move_prices(self):
+        if self.volatility:
+            with self.lock:
+                for pair in self.prices:
+                    self.prices[pair] *= 1 + self.random.gauss(0, self.volatility)
+
+    # Market data
+
+    def ticker(self, pair):
+        price = self.prices[pair]
+        return {
+            "i": pair,
+            "b": "%.8f" % (price * (1 - self.spread / 2)),
+            "k": "%.8f" % (price * (1 + self.spread / 2)),
+            "a": "%.8f" % price,
+            "t": int(time.time() * 1000),
+        }
+
+    def get_tickers(self, params):
+        self.move_prices()
+        pair = params.get("instrument_name")
+        if pair:
+            if pair not in self.prices:
+                raise ExchangeError(400, 40004, "Invalid instrument_name")
+            return {"data": [self.ticker(pair)]}
+        return {"data": [self.ticker(pair) for pair in sorted(self.prices)]}
+
+    def get_instruments(self, params):
+        instruments = []
+        for pair, price in sorted(self.prices.items()):
+            base, quote = pair.split("_", 1)
+            instruments.append({
+                "symbol": pair,
+                "inst_type": "CCY_PAIR",
+                "base_ccy": base,
+                "quote_ccy": quote,
+                "quote_decimals": 6 if price < 1 else 2,
+                "quantity_decimals": 0 if price < 0.01 else (2 if price < 100 else 5),
+                "tradable": True,
+            })
+        for index in range(self.padding_instruments):
+            instruments.append({
+                "symbol": "PAD{}_USDT".format(index),
+                "inst_type": "CCY_PAIR",
+                "base_ccy": "PAD{}".format(index),
+                "quote_ccy": "USDT",
+                "quote_decimals": 4,
+                "quantity_decimals": 2,
+                "tradable": False,
+            })
+        return {"data": instruments}
+
+    # Account
+
+    def account(self, currency=None, balances=None):
+        balances = self.balances if balances is None else balances
+        positions = []
+        with self.lock:
+            for coin, quantity in sorted(balances.items()):
+                if currency and coin != currency:
+                    continue
+                positions.append({
+                    "instrument_name": coin,
+                    "quantity": "%.8f" % quantity,
+                    "reserved_qty": "0",
+                    "market_value": "%.8f" % (quantity * self.prices.get(coin + "_USDT", 1 if coin == "USDT" else 0)),
+                })
+        return {"total_available_balance": "%.8f" % balances.get("USDT", 0), "position_balances": positions}
+
+    def user_balance(self, params, balances):
+        account = self.account(params.get("currency"), balances)
+        return {"data": [account] if account["position_balances"] else []}
+
+    def execute(self, order, balances):
+        pair = order.get("instrument_name")
+        if pair not in self.prices:
+            raise ExchangeError(400, 40004, "Invalid instrument_name")
+        base, quote = pair.split("_", 1)
+        price = self.prices[pair]
+        if quote == "USD":
+            # USD pairs are settled with the USDT balance
+            quote = "USDT"
+
+        with self.lock:
+            if order.get("side") == "BUY":
+                notional = float(order["notional"])
+                if balances.get(quote, 0) < notional:
+                    raise ExchangeError(400, 306, "INSUFFICIENT_AVAILABLE_BALANCE")
+                fill_price = price * (1 + self.spread / 2)
+                quantity = notional / fill_price * (1 - self.fee)
+                balances[quote] = balances.get(quote, 0) - notional
+                balances[base] = balances.get(base, 0) + quantity
+            else:
+                quantity = float(order["quantity"])
+                if balances.get(base, 0) < quantity:
+                    raise ExchangeError(400, 306, "INSUFFICIENT_AVAILABLE_BALANCE")
+                fill_price = price * (1 - self.spread / 2)
+                notional = quantity * fill_price * (1 - self.fee)
+                balances[base] = balances.get(base, 0) - quantity
+                balances[quote] = balances.get(quote, 0) + notional
+            self.balance_version += 1
+
+            order_id = str(uuid.uuid4().int >> 64)
+            self.orders[order_id] = {
+                "order_id": order_id,
+                "instrument_name": pair,
+                "side": order.get("side"),
+                "type": "MARKET",
+                "status": "FILLED",
+                "cumulative_quantity": "%.8f" % quantity,
+                "cumulative_value": "%.8f" % (quantity * fill_price),
+                "avg_price": "%.8f" % fill_price,
+                "create_time": int(time.time() * 1000),
+            }
+        return order_id
+
+    def create_order(self, params, balances):
+        return {"order_id": self.execute(params, balances)}
+
+    def create_order_list(self, params, balances):
+        result_list = []
+        for index, order in enumerate(params.get("order_list", [])):
+            try:
+                result_list.append({"index": index, "code": 0, "order_id": self.execute(order, balances)})
+            except ExchangeError as error:
+                result_list.append({"index": index, "code": error.code, "message": error.message})
+        return {"result_list": result_list}
+
+    def get_order_detail(self, params, balances):
+        order = self.orders.get(str(params.get("order_id")))
+        if order is None:
+            raise ExchangeError(400, 40401, "NOT_FOUND")
+        return order
+
+    # Market orders are filled straight away, so there is never an open order
+    def get_open_orders(self, params, balances):
+        return {"data": []}
+
+    endpoints = {
+        "public/get-tickers": "get_tickers",
+        "public/get-instruments": "get_instruments",
+        "private/user-balance": "user_balance",
+        "private/create-order": "create_order",
+        "private/create-order-list": "create_order_list",
+        "private/get-order-detail": "get_order_detail",
+        "private/get-open-orders": "get_open_orders",
+    }
+
+    def handle(self, method, params, req=None):
+        self.wait()
+        self.check_limits(method)
+        if method not in self.endpoints:
+            if method.startswith("private/"):
+                self.authenticate(req)
+            raise ExchangeError(404, 40401, "Unknown method " + method)
+        if method.startswith("private/"):
+            return getattr(self, self.endpoints[method])(params, self.authenticate(req))
+        return getattr(self, self.endpoints[method])(params)
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately, which would otherwise stall every keep-alive response on a delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, method, status, body, bytes_in):
+        data = json.dumps(body).encode("utf-8")
+        # Counted before the reply is sent, so the stats are complete once the client has the response
+        self.server.exchange.count(method, bytes_in, len(data))
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        if status == 429:
+            self.send_header("Retry-After", "1")
+        self.end_headers()
+        self.wfile.write(data)
+
+    def call(self, method, params, req, bytes_in):
+        request_id = req.get("id", 1) if req else 1
+        try:
+            result = self.server.exchange.handle(method, params, req)
+        except ExchangeError as error:
+            self.reply(method, error.status, {"id": request_id, "method": method, "code": error.code, "message": error.message}, bytes_in)
+        else:
+            self.reply(method, 200, {"id": request_id, "method": method, "code": 0, "result": result}, bytes_in)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if self.headers.get("Upgrade", "").lower() == "websocket":
+            return WebSocketSession(self).run()
+
+        method = url.path[len(api_path):] if url.path.startswith(api_path) else url.path
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        self.call(method, params, None, len(self.requestline) + len(str(self.headers)))
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        method = url.path[len(api_path):] if url.path.startswith(api_path) else url.path
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+        bytes_in = len(self.requestline) + len(str(self.headers)) + length
+        try:
+            req = json.loads(body)
+        except ValueError:
+            return self.reply(method, 400, {"code": 40001, "message": "BAD_REQUEST"}, bytes_in)
+        self.call(method, req.get("params", {}), req, bytes_in)
+
+
+# A minimal WebSocket server for the market and user streams: heartbeats, authentication,
+# ticker.<instrument> and user.balance subscriptions
+class WebSocketSession:
+    def __init__(self, handler):
+        self.handler = handler
+        self.exchange = handler.server.exchange
+        self.socket = handler.connection
+        self.user = handler.path.rstrip("/").endswith("/user")
+        self.authenticated = False
+        # The balances of the account the session authenticated for
+        self.balances = None
+        self.tickers = []
+        self.balance = False
+        self.balance_version = -1
+
+    def handshake(self):
+        key = self.handler.headers["Sec-WebSocket-Key"]
+        accept = base64.b64encode(hashlib.sha1((key + websocket_guid).encode("utf-8")).digest()).decode("utf-8")
+        self.handler.send_response(101, "Switching Protocols")
+        self.handler.send_header("Upgrade", "websocket")
+        self.handler.send_header("Connection", "Upgrade")
+        self.handler.send_header("Sec-WebSocket-Accept", accept)
+        self.handler.end_headers()
+        self.handler.wfile.flush()
+
+    def receive_exactly(self, size):
+        data = b""
+        while len(data) < size:
+            chunk = self.socket.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError("closed")
+            data += chunk
+        return data
+
+    def receive(self):
+        first, second = self.receive_exactly(2)
+        opcode = first & 0x0F
+        length = second & 0x7F
+        if length == 126:
+            length = struct.unpack(">H", self.receive_exactly(2))[0]
+        elif length == 127:
+            length = struct.unpack(">Q", self.receive_exactly(8))[0]
+        mask = self.receive_exactly(4) if second & 0x80 else b"\0\0\0\0"
+        payload = bytes(byte ^ mask[index % 4] for index, byte in enumerate(self.receive_exactly(length)))
+        return opcode, payload
+
+    def send_frame(self, opcode, payload):
+        header = bytes([0x80 | opcode])
+        if len(payload) < 126:
+            header += bytes([len(payload)])
+        elif len(payload) < 65536:
+            header += bytes([126]) + struct.pack(">H", len(payload))
+        else:
+            header += bytes([127]) + struct.pack(">Q", len(payload))
+        self.socket.sendall(header + payload)
+
+    def send(self, message):
+        data = json.dumps(message).encode("utf-8")
+        self.send_frame(0x1, data)
+        self.exchange.count("websocket", 0, len(data))
+
+    def on_message(self, message):
+        method = message.get("method")
+        if method == "public/auth":
+            try:
+                self.balances = self.exchange.authenticate(message)
+                self.authenticated = True
+                self.send({"id": message.get("id"), "method": "public/auth", "code": 0})
+            except ExchangeError as error:
+                self.send({"id": message.get("id"), "method": "public/auth", "code": error.code, "message": error.message})
+
+        elif method == "subscribe":
+            for channel in message.get("params", {}).get("channels", []):
+                if channel.startswith("ticker."):
+                    self.tickers.append(channel[len("ticker."):])
+                elif channel == "user.balance" and self.user and self.authenticated:
+                    self.balance = True
+            self.send({"id": message.get("id"), "method": "subscribe", "code": 0})
+
+    def push(self):
+        for pair in self.tickers:
+            if pair in self.exchange.prices:
+                self.send({"method": "subscribe", "result": {
+                    "channel": "ticker", "instrument_name": pair, "subscription": "ticker." + pair,
+                    "data": [self.exchange.ticker(pair)]}})
+        if self.balance and self.balance_version != self.exchange.balance_version:
+            self.balance_version = self.exchange.balance_version
+            self.send({"method": "subscribe", "result": {
+                "channel": "user.balance", "subscription": "user.balance",
+                "data": [self.exchange.account(balances=self.balances)]}})
+
+    def run(self):
+        self.handshake()
+        self.handler.close_connection = True
+        next_heartbeat = time.monotonic() + self.exchange.heartbeat_interval
+        next_push = time.monotonic()
+        try:
+            while True:
+                readable, _, _ = select.select([self.socket], [], [], 0.1)
+                if readable:
+                    opcode, payload = self.receive()
+                    if opcode == 0x8:
+                        self.send_frame(0x8, b"")
+                        return
+                    if opcode == 0x9:
+                        self.send_frame(0xA, payload)
+                    elif opcode == 0x1:
+                        self.on_message(json.loads(payload))
+
+                now = time.monotonic()
+                if now >= next_heartbeat:
+                    self.send({"id": int(time.time() * 1000), "method": "public/heartbeat", "code": 0})
+                    next_heartbeat = now + self.exchange.heartbeat_interval
+                if now >= next_push:
+                    self.exchange.move_prices()
+                    self.push()
+                    next_push = now + self.exchange.ticker_interval
+        except (ConnectionError, OSError):
+            return
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs a local stand-in for the Crypto.com Exchange")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--api-key", default="key")
+    parser.add_argument("--api-secret", default="secret")
+    parser.add_argument("--pairs", nargs="+", default=["BTC_USDT:30000", "ETH_USDT:2000", "CRO_USDT:0.1"],
+                        help="Instruments and their prices, e.g. BTC_USDT:30000")
+    parser.add_argument("--balances", nargs="+", default=["USDT:1000"], help="Coins and their balances, e.g. USDT:1000")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every response")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Up to this many random seconds added to every response")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests answered with a server error")
+    parser.add_argument("--rate-limit", type=float, nargs=3, metavar=("PUBLIC", "PRIVATE", "ORDER"),
+                        help="Requests per second before answering with 429")
+    parser.add_argument("--fee", type=float, default=0.0)
+    parser.add_argument("--volatility", type=float, default=0.0, help="Standard deviation of the price moves")
+    parser.add_argument("--padding-instruments", type=int, default=0, help="Extra instruments to make get-instruments realistically large")
+    args = parser.parse_args()
+
+    rate_limits = None
+    if args.rate_limit:
+        rate_limits = dict(zip(("public", "private", "order"), args.rate_limit))
+
+    exchange = MockExchange(
+        prices={pair: float(price) for pair, price in (item.split(":") for item in args.pairs)},
+        balances={coin: float(amount) for coin, amount in (item.split(":") for item in args.balances)},
+        api_key=args.api_key, api_secret=args.api_secret, latency=args.latency, jitter=args.jitter,
+        error_rate=args.error_rate, rate_limits=rate_limits, fee=args.fee, volatility=args.volatility,
+        padding_instruments=args.padding_instruments)
+    url = exchange.start(args.host, args.port)
+    print("Mock exchange listening on {}".format(url))
+    print("WebSocket streams on {}".format(exchange.stream_url))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        exchange.stop()
@@ -0,0 +1,189 @@
+import argparse
+import contextlib
+import json
+import os
+import time
+import requests
+from mock_exchange import MockExchange, ExchangeError
+
+# Trades on paper: orders are filled into a local ledger instead of being sent to the exchange, and the balances
+# are read from that ledger. With environment = "paper" in _config.py, PieBot runs its normal loop at the exchange's
+# live prices. Run this file to replay recorded candles through PieBot's tasks as fast as they can run:
+#
+#   python3 paper.py --data candles --usdt 1000
+#
+# or ticks written by recorder.py, sampled every --interval seconds:
+#
+#   python3 paper.py --ticks ticks --interval 60 --usdt 1000
+
+
+# The latest prices, shared by the ledgers of all accounts. With an exchange client, the prices are taken from
+# every ticker download it makes, otherwise they are set by whoever replays them
+class Market:
+    def __init__(self, client=None, spread=0.001):
+        self.client = client
+        self.spread = spread
+        self.prices = {}
+
+    def update(self, ticker_data):
+        for ticker in ticker_data["result"]["data"]:
+            bid, ask = ticker.get("b"), ticker.get("k")
+            if bid is not None and ask is not None:
+                self.prices[ticker["i"]] = (float(bid) + float(ask)) / 2
+            elif ticker.get("a") is not None:
+                self.prices[ticker["i"]] = float(ticker["a"])
+
+
+# The balances and orders of one account. Market orders fill straight away at the market price, less the fee.
+# Orders worth less than the minimum order value are rejected
+class Ledger(MockExchange):
+    def __init__(self, market, balances, fee=0.00075, min_order_value=0.25):
+        super().__init__(market.prices, balances, spread=market.spread, fee=fee)
+        # The ledger reads the market's prices instead of a copy of them
+        self.prices = market.prices
+        self.min_order_value = min_order_value
+        self.fees = 0.0
+
+    def execute(self, order, balances):
+        pair = order.get("instrument_name")
+        if order.get("side") == "BUY":
+            value = float(order.get("notional", 0))
+        else:
+            value = float(order.get("quantity", 0)) * self.prices.get(pair, 0)
+        if value < self.min_order_value:
+            raise ExchangeError(400, 213, "INVALID_ORDERQTY")
+
+        order_id = super().execute(order, balances)
+        with self.lock:
+            self.fees += value * self.fee
+        return order_id
+
+    def value(self):
+        with self.lock:
+            return sum(quantity * (1 if coin in ("USDT", "USD") else self.prices.get(coin + "_USDT", self.prices.get(coin + "_USD", 0)))
+                       for coin, quantity in self.balances.items())
+
+
+# Builds the response the exchange would have sent
+def make_response(method, status, body):
+    response = requests.Response()
+    response.status_code = status
+    response.reason = "OK" if status == 200 else "Error"
+    response._content = json.dumps(body).encode("utf-8")
+    response.headers["Content-Type"] = "application/json"
+    response.url = method
+    return response
+
+
+# Stands in for ExchangeClient. Private requests are answered by the ledger, public ones by the market's exchange
+# client, or by the ledger from the market's prices if there is none
+class PaperClient:
+    def __init__(self, ledger, market):
+        self.ledger = ledger
+        self.market = market
+        self.key = None
+        self.secret = None
+
+    def call(self, method, params, request_id=1):
+        name = self.ledger.endpoints.get(method)
+        try:
+            if name is None:
+                raise ExchangeError(404, 40401, "Unknown method " + method)
+            if method.startswith("private/"):
+                result = getattr(self.ledger, name)(params, self.ledger.balances)
+            else:
+                result = getattr(self.ledger, name)(params)
+        except ExchangeError as error:
+            return make_response(method, error.status, {"id": request_id, "method": method, "code": error.code, "message": error.message})
+        return make_response(method, 200, {"id": request_id, "method": method, "code": 0, "result": result})
+
+    def public(self, method, params=None, timeout=None):
+        if self.market.client is None:
+            return self.call(method, params or {})
+
+        response = self.market.client.public(method, params, timeout)
+        if method == "public/get-tickers" and not (params or {}).get("instrument_name") and response.status_code == 200:
+            self.market.update(response.json())
+        return response
+
+    def private(self, method, params=None, request_id=100, timeout=None):
+        return self.call(method, params or {}, request_id)
+
+    def close(self):
+        if self.market.client is not None:
+            self.market.client.close()
+
+
+# Replays the candles through PieBot's Buy and Rebalance tasks on a simulated clock, like backtest.py does with
+# its model of them. The tasks run at the same candles as in the backtest, Rebalance before Buy
+def replay(bot, ledger, market, timestamps, pairs, close, interval, verbose=False):
+    import backtest
+    import functions
+
+    account = bot.trading_accounts[0]
+    buy_every = backtest.steps_between(account.buy_frequency, interval)
+    rebalance_every = backtest.steps_between(account.rebalance_frequency, interval)
+    runs = 0
+
+    output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(open(os.devnull, "w"))
+    with output:
+        for step in range(len(timestamps)):
+            rebalance_due = rebalance_every and step % rebalance_every == 0
+            buy_due = buy_every and step % buy_every == 0
+            if not (rebalance_due or buy_due):
+                continue
+
+            market.prices.update(zip(pairs, close[step].tolist()))
+            # Every candle has new prices, tickers downloaded for the last one are no longer valid
+            functions.tickers.invalidate()
+            if rebalance_due:
+                bot.run_task(bot.rebalance, account)
+                runs += 1
+            if buy_due:
+                bot.run_task(bot.buy, account)
+                runs += 1
+
+    return runs
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs PieBot's tasks on paper, on recorded candles and a simulated clock")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--data", help="Directory with one candle file per coin pair, see backtest.py")
+    source.add_argument("--ticks", help="Directory with the ticks written by recorder.py")
+    parser.add_argument("--interval", type=int, default=60, help="Seconds between two samples of the ticks")
+    parser.add_argument("--usdt", type=float, default=1000, help="USDT at the start")
+    parser.add_argument("--fee", type=float, default=0.00075, help="Trading fee, 0.00075 = 0.075%%")
+    parser.add_argument("--verbose", action="store_true", help="Prints the output of every task")
+    args = parser.parse_args()
+
+    import numpy as np
+    import backtest
+    import functions
+
+    market = Market()
+    ledger = Ledger(market, {"USDT": args.usdt}, args.fee, functions.min_order_value)
+    functions.use_paper_client(PaperClient(ledger, market))
+
+    import PieBot
+    account = PieBot.trading_accounts[0]
+    if args.ticks:
+        import recorder
+        timestamps, pairs, close = recorder.load_prices(args.ticks, [pair for coin, pair in account.pair_list], args.interval)
+        interval = args.interval
+    else:
+        timestamps, pairs, close = backtest.load_candles(args.data, [pair for coin, pair in account.pair_list])
+        interval = float(np.median(np.diff(timestamps))) if len(timestamps) > 1 else 3600
+    market.prices.update(zip(pairs, close[0].tolist()))
+    account.ready.set()
+
+    started = time.perf_counter()
+    runs = replay(PieBot, ledger, market, timestamps, pairs, close, interval, args.verbose)
+    elapsed = time.perf_counter() - started
+
+    print("Pairs:          {}".format(", ".join(pairs)))
+    print("Candles:        {} ({:.0f} days)".format(len(timestamps), len(timestamps) * interval / 86400))
+    print("Final value:    {:.2f} USDT ({:+.2%})".format(ledger.value(), ledger.value() / args.usdt - 1))
+    print("Orders:         {}".format(len(ledger.orders)))
+    print("Fees:           {:.2f} USDT".format(ledger.fees))
+    print("Tasks run:      {} in {:.2f}s ({:.0f} per second)".format(runs, elapsed, runs / elapsed if elapsed else 0))
@@ -0,0 +1,116 @@
+from collections import namedtuple
+
+# Decides which orders the Buy and Rebalance tasks place. Nothing in here talks to the exchange or prints,
+# so a plan only depends on the balances, prices and instrument precisions it is given.
+
+# An order that should be placed. The amount is the notional in USDT for a BUY, and the quantity of coins for a SELL.
+# The value is the order's worth in USDT, and price the price of the coin it was planned with, if known
+Order = namedtuple("Order", ["coin", "pair", "side", "amount", "value", "price"], defaults=(None,))
+
+# How far a coin is from its target, in USDT and in percent. side is "+" over target and "-" under target
+Deviation = namedtuple("Deviation", ["coin", "side", "difference", "percentage"])
+
+# The orders of a Rebalance, the sells before the buys. skipped holds the pairs without a price
+RebalancePlan = namedtuple("RebalancePlan", ["target_per_coin", "sells", "buys", "deviations", "skipped"])
+
+
+# Rounds an amount to the decimals the exchange accepts, the same way the order is formatted when it is sent
+def round_to(amount, decimals):
+    if decimals is None:
+        return amount
+    return float("%0.*f" % (decimals, amount))
+
+
+# Plans a Rebalance. precisions maps a pair to its (quote_decimals, quantity_decimals), the amounts of pairs
+# without an entry are not rounded. Orders which round to nothing are left out
+def plan_rebalance(pairs, balances, prices, precisions=None, rebalance_threshold=None, min_order_value=0.25):
+    precisions = precisions or {}
+    uses_threshold = rebalance_threshold is not None and rebalance_threshold > 0
+
+    holdings = []
+    skipped = []
+    total_portfolio_value = 0.0
+    for coin, pair in pairs:
+        coin_price = prices.get(pair)
+        if coin_price is None:
+            skipped.append(pair)
+            continue
+        pair_value = balances.get(coin, 0.0) * coin_price
+        holdings.append((coin, pair, coin_price, pair_value))
+        total_portfolio_value += pair_value
+
+    # Equally divide the balance by the number of coins, so we know the target value each coin should aim for
+    target_per_coin = total_portfolio_value / len(pairs) if pairs else 0.0
+
+    sells = []
+    buys = []
+    deviations = []
+    for coin, pair, coin_price, pair_value in holdings:
+        quote_decimals, quantity_decimals = precisions.get(pair, (None, None))
+
+        # The coin value is over target
+        if pair_value > target_per_coin:
+            difference = pair_value - target_per_coin
+            if difference < min_order_value:
+                continue
+            difference_percentage = (difference / target_per_coin) * 100 if target_per_coin else 100
+            deviations.append(Deviation(coin, "+", difference, difference_percentage))
+
+            if not uses_threshold or difference_percentage >= (rebalance_threshold * 100):
+                quantity = round_to(difference / coin_price, quantity_decimals)
+                if quantity > 0:
+                    sells.append(Order(coin, pair, "SELL", quantity, difference, coin_price))
+
+        # The coin value is under target
+        elif pair_value < target_per_coin:
+            difference = target_per_coin - pair_value
+            if difference < min_order_value:
+                continue
+            difference_percentage = 100 if pair_value == 0 else (difference / pair_value) * 100
+            deviations.append(Deviation(coin, "-", difference, difference_percentage))
+
+            if not uses_threshold or difference_percentage >= (rebalance_threshold * 100):
+                notional = round_to(difference, quote_decimals)
+                if notional > 0:
+                    buys.append(Order(coin, pair, "BUY", notional, difference, coin_price))
+
+    return RebalancePlan(target_per_coin, tuple(sells), tuple(buys), tuple(deviations), tuple(skipped))
+
+
+# The USDT which can be spent, after keeping aside the reserve, a share of the portfolio's value including USDT
+def available_usdt(usdt, portfolio_value, reserve):
+    return usdt - (portfolio_value / 100) * (reserve * 100)
+
+
+# Plans a Buy of the same value of every coin. prices, if given, are kept with the orders
+def plan_buy(pairs, buy_order_value, precisions=None, prices=None):
+    precisions = precisions or {}
+    prices = prices or {}
+    return tuple(Order(coin, pair, "BUY", round_to(buy_order_value, precisions.get(pair, (None, None))[0]), buy_order_value, prices.get(pair))
+                 for coin, pair in pairs)
+
+
+# Shrinks buy orders in proportion so that together they cost no more than the budget.
+# Orders which fall below the minimum order value are left out
+def fit_to_budget(orders, budget, precisions=None, min_order_value=0.25):
+    precisions = precisions or {}
+    total = sum(order.amount for order in orders)
+    if not orders or total <= budget:
+        return tuple(orders)
+
+    share = max(budget, 0.0) / total
+    fitted = []
+    for order in orders:
+        notional = round_to(order.amount * share, precisions.get(order.pair, (None, None))[0])
+        if notional >= min_order_value:
+            fitted.append(order._replace(amount=notional, value=order.value * share))
+    return tuple(fitted)
+
+
+# Keeps no more than max_orders of the sells and buys of a Rebalance, those furthest from their target first.
+# Returns the sells and the buys that are kept, each in their original order
+def limit_orders(sells, buys, max_orders=None):
+    if max_orders is None or len(sells) + len(buys) <= max_orders:
+        return tuple(sells), tuple(buys)
+    kept = set(sorted(list(sells) + list(buys), key=lambda order: order.value, reverse=True)[:max(max_orders, 0)])
+    return tuple(order for order in sells if order in kept), tuple(order for order in buys if order in kept)
@@ -0,0 +1,187 @@
+import argparse
+import os
+import threading
+import time
+
+import numpy as np
+
+# Records the tickers PieBot sees into compact binary files, for analysis and for replays with paper.py.
+# Every file holds the ticks of one pair for one UTC day, e.g. ticks/2024-05-01/BTC_USDT.ticks, as fixed-width
+# records without a header, so a file can be memory-mapped and read as a NumPy array without copying it.
+#
+#   python3 recorder.py --output ticks --interval 5
+
+# One tick is 32 bytes: the exchange's time in milliseconds, then the bid, the ask and the last trade's price.
+# A price the ticker didn't have is NaN
+tick_dtype = np.dtype([("time", "<i8"), ("bid", "<f8"), ("ask", "<f8"), ("last", "<f8")])
+
+extension = ".ticks"
+
+
+def day_of(milliseconds):
+    return time.strftime("%Y-%m-%d", time.gmtime(milliseconds // 1000))
+
+
+def price_or_nan(value):
+    return float("nan") if value is None else float(value)
+
+
+# Appends the ticks of the pairs to their files. A tick is only written if it is newer than the last one written
+# for its pair, so the tickers of several tasks downloaded at the same moment are stored once
+class TickRecorder:
+    def __init__(self, directory, pairs=None):
+        self.directory = directory
+        self.pairs = None if pairs is None else set(pairs)
+        self.lock = threading.Lock()
+        # {pair: (day, open file)}
+        self.files = {}
+        # {pair: exchange time of the last tick written}
+        self.last_time = {}
+
+    def file(self, pair, day):
+        current = self.files.get(pair)
+        if current is not None and current[0] == day:
+            return current[1]
+        if current is not None:
+            current[1].close()
+
+        os.makedirs(os.path.join(self.directory, day), exist_ok=True)
+        path = os.path.join(self.directory, day, pair + extension)
+        handle = open(path, "ab")
+        # A crash can leave half a tick at the end, which would shift every tick written after it
+        size = handle.tell()
+        if size % tick_dtype.itemsize:
+            handle.truncate(size - size % tick_dtype.itemsize)
+            handle.seek(0, os.SEEK_END)
+        self.files[pair] = (day, handle)
+        return handle
+
+    # Records the tickers of one get-tickers response, or of one message of the ticker stream
+    def record(self, tickers, received_at=None):
+        received_at = int((received_at or time.time()) * 1000)
+        with self.lock:
+            written = set()
+            for ticker in tickers:
+                pair = ticker.get("i")
+                if pair is None or (self.pairs is not None and pair not in self.pairs):
+                    continue
+                tick_time = int(ticker.get("t") or received_at)
+                if tick_time <= self.last_time.get(pair, 0):
+                    continue
+
+                tick = np.array([(tick_time, price_or_nan(ticker.get("b")), price_or_nan(ticker.get("k")), price_or_nan(ticker.get("a")))],
+                                dtype=tick_dtype)
+                handle = self.file(pair, day_of(tick_time))
+                handle.write(tick.tobytes())
+                written.add(handle)
+                self.last_time[pair] = tick_time
+
+            for handle in written:
+                handle.flush()
+
+    def close(self):
+        with self.lock:
+            for day, handle in self.files.values():
+                handle.close()
+            self.files = {}
+
+
+# The days of a recording, sorted
+def days(directory):
+    return sorted(name for name in os.listdir(directory) if os.path.isdir(os.path.join(directory, name)))
+
+
+# The pairs with ticks on any day of a recording, sorted
+def pairs(directory):
+    found = set()
+    for day in days(directory):
+        found.update(name[:-len(extension)] for name in os.listdir(os.path.join(directory, day)) if name.endswith(extension))
+    return sorted(found)
+
+
+# The ticks of one pair on one day, memory-mapped instead of read, so nothing is copied until it is used.
+# Returns an empty array if there are none
+def read_day(directory, pair, day):
+    path = os.path.join(directory, day, pair + extension)
+    try:
+        count = os.path.getsize(path) // tick_dtype.itemsize
+    except FileNotFoundError:
+        count = 0
+    if count == 0:
+        return np.empty(0, dtype=tick_dtype)
+    return np.memmap(path, dtype=tick_dtype, mode="r", shape=(count,))
+
+
+# The ticks of one pair between two times in seconds, both optional. Within one day the result is a view
+# of the memory-mapped file, ticks from several days are joined into a new array
+def read(directory, pair, start=None, end=None):
+    first = None if start is None else day_of(int(start * 1000))
+    last = None if end is None else day_of(int(end * 1000))
+    parts = []
+    for day in days(directory):
+        if (first is not None and day < first) or (last is not None and day > last):
+            continue
+        ticks = read_day(directory, pair, day)
+        if start is not None:
+            ticks = ticks[np.searchsorted(ticks["time"], int(start * 1000)):]
+        if end is not None:
+            ticks = ticks[:np.searchsorted(ticks["time"], int(end * 1000), side="right")]
+        if len(ticks):
+            parts.append(ticks)
+
+    if not parts:
+        return np.empty(0, dtype=tick_dtype)
+    return parts[0] if len(parts) == 1 else np.concatenate(parts)
+
+
+# The price PieBot would have used for every tick: the bid, or the last trade's price if there was no bid
+def tick_prices(ticks):
+    return np.where(np.isnan(ticks["bid"]), ticks["last"], ticks["bid"])
+
+
+# Samples the prices of the pairs every interval seconds, like the candles backtest.load_candles returns.
+# Every sample is the latest price at that moment, and only moments at which every pair has a price are kept
+def load_prices(directory, pair_names=None, interval=60, start=None, end=None):
+    pair_names = pairs(directory) if pair_names is None else list(pair_names)
+    loaded = {}
+    for pair in pair_names:
+        ticks = read(directory, pair, start, end)
+        if len(ticks):
+            loaded[pair] = (ticks["time"] // 1000, tick_prices(ticks))
+    if not loaded:
+        raise ValueError("No ticks found in " + directory)
+
+    first = max(int(times[0]) for times, prices in loaded.values())
+    last = min(int(times[-1]) for times, prices in loaded.values())
+    timestamps = np.arange(first, last + 1, interval, dtype=np.int64)
+
+    close = np.empty((len(timestamps), len(loaded)), dtype=np.float64)
+    for column, (times, prices) in enumerate(loaded.values()):
+        close[:, column] = prices[np.searchsorted(times, timestamps, side="right") - 1]
+    return timestamps, list(loaded), close
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Records the tickers of the pairs of _config.py")
+    parser.add_argument("--output", required=True, help="Directory the ticks are written to")
+    parser.add_argument("--interval", type=float, default=5, help="Seconds between two downloads of the tickers")
+    parser.add_argument("--all", action="store_true", help="Records every pair of the exchange instead of the pairs of _config.py")
+    args = parser.parse_args()
+
+    import functions
+    recorder = TickRecorder(args.output, None if args.all else functions.configured_pairs())
+    functions.current_time(True)
+    print(functions.colored("Recording tickers to {} every {}s".format(args.output, args.interval), "green"))
+    try:
+        while True:
+            started = time.monotonic()
+            try:
+                response = functions.client.public("public/get-tickers")
+                response.raise_for_status()
+                recorder.record(response.json()["result"]["data"])
+            except Exception as error:
+                functions.current_time(True)
+                print(functions.colored("Downloading the tickers failed: {!r}".format(error), "red"))
+            time.sleep(max(0, args.interval - (time.monotonic() - started)))
+    except KeyboardInterrupt:
+        recorder.close()
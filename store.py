@@ -0,0 +1,220 @@
+import atexit
+import queue
+import sqlite3
+import threading
+import time
+
+# Keeps a local record of what PieBot sees and does: portfolio snapshots, planned orders, and the orders sent
+# with the exchange's response. Writes are queued and stored in batches by a background thread, so recording
+# never holds up a task. If the writer falls behind or a batch can't be written, rows are dropped instead of
+# piling up in memory.
+
+schema = """
+CREATE TABLE IF NOT EXISTS positions (
+    taken_at REAL NOT NULL,
+    account TEXT NOT NULL,
+    coin TEXT NOT NULL,
+    pair TEXT,
+    balance REAL NOT NULL,
+    price REAL,
+    value REAL
+);
+CREATE INDEX IF NOT EXISTS positions_pair_time ON positions (pair, taken_at);
+CREATE INDEX IF NOT EXISTS positions_time ON positions (taken_at);
+
+CREATE TABLE IF NOT EXISTS planned_orders (
+    planned_at REAL NOT NULL,
+    account TEXT NOT NULL,
+    task TEXT NOT NULL,
+    coin TEXT NOT NULL,
+    pair TEXT NOT NULL,
+    side TEXT NOT NULL,
+    amount REAL NOT NULL,
+    value REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS planned_orders_pair_time ON planned_orders (pair, planned_at);
+
+CREATE TABLE IF NOT EXISTS orders (
+    submitted_at REAL NOT NULL,
+    account TEXT NOT NULL,
+    task TEXT NOT NULL,
+    coin TEXT NOT NULL,
+    pair TEXT NOT NULL,
+    side TEXT NOT NULL,
+    amount REAL NOT NULL,
+    value REAL NOT NULL,
+    confirmed INTEGER NOT NULL,
+    status_code INTEGER,
+    reason TEXT,
+    order_id TEXT,
+    response TEXT
+);
+CREATE INDEX IF NOT EXISTS orders_pair_time ON orders (pair, submitted_at);
+CREATE INDEX IF NOT EXISTS orders_order_id ON orders (order_id);
+
+CREATE TABLE IF NOT EXISTS fills (
+    updated_at REAL NOT NULL,
+    account TEXT NOT NULL,
+    order_id TEXT NOT NULL,
+    pair TEXT NOT NULL,
+    side TEXT NOT NULL,
+    status TEXT NOT NULL,
+    quantity REAL NOT NULL,
+    avg_price REAL NOT NULL,
+    value REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS fills_pair_time ON fills (pair, updated_at);
+CREATE INDEX IF NOT EXISTS fills_order_id ON fills (order_id);
+"""
+
+
+# Opening the state file raises sqlite3.Error or OSError, e.g. when its directory doesn't exist or is read-only
+class Store:
+    def __init__(self, path, account, flush_interval=1.0, batch_size=500, max_queued=10000):
+        self.path = path
+        self.account = account
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.queue = queue.Queue(maxsize=max_queued)
+        self.local = threading.local()
+        # Rows that could not be queued or written
+        self.dropped = 0
+        self.warned = False
+
+        # Opened here, so a state file that can't be used is reported to the caller instead of the writer thread.
+        # Only the writer uses the connection from now on
+        connection = self.connect(check_same_thread=False)
+        try:
+            connection.executescript(schema)
+        except sqlite3.Error:
+            connection.close()
+            raise
+
+        self.writer = threading.Thread(target=self.write_forever, args=(connection,), name="store-writer", daemon=True)
+        self.writer.start()
+        atexit.register(self.close)
+
+    def connect(self, check_same_thread=True):
+        connection = sqlite3.connect(self.path, timeout=30, check_same_thread=check_same_thread)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    def drop(self, rows, reason):
+        self.dropped += rows
+        if not self.warned:
+            self.warned = True
+            print("State file {}: {}, rows are dropped".format(self.path, reason))
+
+    # Writes queued rows in one transaction per batch, until close() queues None.
+    # A batch that can't be written is dropped, the writer carries on with the next one
+    def write_forever(self, connection):
+        running = True
+        while running:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+
+            statements = {}
+            for item in batch:
+                if item is None:
+                    running = False
+                    continue
+                statement, rows = item
+                statements.setdefault(statement, []).extend(rows)
+
+            try:
+                with connection:
+                    for statement, rows in statements.items():
+                        connection.executemany(statement, rows)
+            except sqlite3.Error as error:
+                self.drop(sum(len(rows) for rows in statements.values()), "writing failed with {!r}".format(error))
+            finally:
+                for item in batch:
+                    self.queue.task_done()
+
+        connection.close()
+
+    def put(self, statement, rows):
+        if not rows:
+            return
+        if not self.writer.is_alive():
+            self.drop(len(rows), "the writer has stopped")
+            return
+        try:
+            self.queue.put_nowait((statement, rows))
+        except queue.Full:
+            self.drop(len(rows), "the writer can't keep up")
+
+    def record_snapshot(self, snapshot, pairs):
+        rows = []
+        for coin, pair in pairs:
+            balance = snapshot.balance(coin)
+            coin_price = snapshot.prices.get(pair)
+            rows.append((snapshot.taken_at, self.account, coin, pair, balance, coin_price,
+                         None if coin_price is None else balance * coin_price))
+        rows.append((snapshot.taken_at, self.account, "USDT", None, snapshot.balance("USDT"), 1.0, snapshot.balance("USDT")))
+        self.put("INSERT INTO positions VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def record_plan(self, task, orders):
+        planned_at = time.time()
+        self.put("INSERT INTO planned_orders VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                 [(planned_at, self.account, task, order.coin, order.pair, order.side, order.amount, order.value) for order in orders])
+
+    def record_orders(self, task, results):
+        submitted_at = time.time()
+        rows = []
+        for result in results:
+            order = result.order
+            content = result.content
+            if isinstance(content, bytes):
+                content = content.decode("utf-8", "replace")
+            rows.append((submitted_at, self.account, task, order.coin, order.pair, order.side, order.amount, order.value,
+                         int(result.confirmed), result.status_code, result.reason,
+                         None if result.order_id is None else str(result.order_id), content))
+        self.put("INSERT INTO orders VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+        self.put("INSERT INTO fills VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                 [(submitted_at, self.account, str(result.order_id), result.order.pair, result.order.side, result.fill.status,
+                   result.fill.quantity, result.fill.avg_price, result.fill.value)
+                  for result in results if result.fill is not None])
+
+    # Waits until everything queued so far has been written, or dropped
+    def flush(self):
+        if self.writer.is_alive():
+            self.queue.join()
+
+    def close(self):
+        if self.writer.is_alive():
+            self.queue.put(None)
+            self.writer.join()
+
+    # Reads with a connection of the calling thread. WAL lets reads run while the writer is busy
+    def query(self, statement, parameters=()):
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = self.local.connection = self.connect()
+        return connection.execute(statement, parameters).fetchall()
+
+    # The positions of the most recent snapshot, e.g. to pick up where PieBot stopped after a restart
+    def last_positions(self):
+        return self.query("SELECT coin, pair, balance, price, value, taken_at FROM positions "
+                          "WHERE account = ? AND taken_at = (SELECT MAX(taken_at) FROM positions WHERE account = ?)",
+                          (self.account, self.account))
+
+    def orders_since(self, since, pair=None):
+        if pair is None:
+            return self.query("SELECT * FROM orders WHERE account = ? AND submitted_at >= ? ORDER BY submitted_at",
+                              (self.account, since))
+        return self.query("SELECT * FROM orders WHERE account = ? AND pair = ? AND submitted_at >= ? ORDER BY submitted_at",
+                          (self.account, pair, since))
+
+    # The value of a pair over time, one row per snapshot of the account, by default the one of this store.
+    # Accounts may share a state file
+    def value_history(self, pair, since=0, account=None):
+        return self.query("SELECT taken_at, balance, price, value FROM positions WHERE account = ? AND pair = ? AND taken_at >= ? ORDER BY taken_at",
+                          (self.account if account is None else account, pair, since))
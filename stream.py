@@ -0,0 +1,187 @@
+import json
+import threading
+import time
+from collections import namedtuple
+import functions
+from functions import colored, current_time, sign_request, parse_balances, ticker_price, PortfolioSnapshot
+
+
+# The latest ticker of a pair. The bid and the ask are None while the exchange has none, price is what PieBot
+# trades at, see ticker_price()
+Quote = namedtuple("Quote", ["bid", "ask", "price", "received_at"])
+
+
+def price_or_none(value):
+    return None if value is None else float(value)
+
+
+# Keeps the latest prices and balances received from the exchange, with the time they arrived
+class MarketBook:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # {instrument: Quote}
+        self.prices = {}
+        self.balances = {}
+        self.balances_updated = 0
+        # The last message of any kind on each stream, heartbeats included
+        self.last_message = {"market": 0, "user": 0}
+
+    def seen(self, stream):
+        self.last_message[stream] = time.time()
+
+    def disconnected(self, stream):
+        self.last_message[stream] = 0
+
+    def update_ticker(self, pair, ticker):
+        coin_price = ticker_price(ticker)
+        if coin_price is not None:
+            with self.lock:
+                self.prices[pair] = Quote(price_or_none(ticker.get("b")), price_or_none(ticker.get("k")), coin_price, time.time())
+
+    def update_balances(self, accounts):
+        balances = parse_balances(accounts)
+        with self.lock:
+            self.balances = balances
+            self.balances_updated = time.time()
+
+    def fresh(self, stream, max_age):
+        return time.time() - self.last_message[stream] <= max_age
+
+    # The latest ticker of a pair, or None if there is none newer than max_age seconds
+    def quote(self, pair, max_age):
+        with self.lock:
+            quote = self.prices.get(pair)
+        if quote is None or time.time() - quote.received_at > max_age:
+            return None
+        return quote
+
+    # Builds a snapshot of the pairs, or returns None if anything is missing or the streams have gone quiet.
+    # A pair whose ticker hasn't changed for max_age seconds counts as missing, as the heartbeats keep a stream
+    # fresh even when the exchange stopped sending it tickers. The balances only change with orders, so their age
+    # doesn't matter as long as the user stream is fresh
+    def snapshot(self, pairs, max_age):
+        if not (self.fresh("market", max_age) and self.fresh("user", max_age)):
+            return None
+
+        now = time.time()
+        with self.lock:
+            if not self.balances_updated:
+                return None
+            quotes = [self.prices.get(pair[1]) for pair in pairs]
+            if any(quote is None or now - quote.received_at > max_age for quote in quotes):
+                return None
+
+            prices = {pair: quote.price for pair, quote in self.prices.items()}
+            taken_at = min([self.balances_updated] + [quote.received_at for quote in quotes])
+            return PortfolioSnapshot(dict(self.balances), prices, taken_at)
+
+
+# One WebSocket connection, which reconnects and subscribes again when it drops
+class Stream:
+    def __init__(self, name, url, book, channels, authenticate=False):
+        self.name = name
+        self.url = url
+        self.book = book
+        self.channels = channels
+        self.authenticate = authenticate
+        self.stop_now = False
+        self.socket = None
+
+    def start(self):
+        thread = threading.Thread(target=self.run, name="stream-" + self.name, daemon=True)
+        thread.start()
+        return thread
+
+    def run(self):
+        import websocket
+
+        while not self.stop_now:
+            self.socket = websocket.WebSocketApp(self.url,
+                                                 on_open=self.on_open,
+                                                 on_message=self.on_message,
+                                                 on_close=self.on_close)
+            self.socket.run_forever()
+            if not self.stop_now:
+                time.sleep(5)
+
+    def stop(self):
+        self.stop_now = True
+        if self.socket:
+            self.socket.close()
+
+    def send(self, ws, method, params=None, request_id=None):
+        message = {
+            "id": request_id or int(time.time() * 1000),
+            "method": method,
+            "nonce": int(time.time() * 1000)
+        }
+        if params is not None:
+            message["params"] = params
+        ws.send(json.dumps(message))
+
+    def on_open(self, ws):
+        # The exchange drops requests sent within the first second of a connection
+        time.sleep(1)
+        if self.authenticate:
+            auth_request = {
+                "id": int(time.time() * 1000),
+                "method": "public/auth",
+                "api_key": functions.api_key,
+                "nonce": int(time.time() * 1000)
+            }
+            ws.send(json.dumps(sign_request(req=auth_request)))
+        else:
+            self.send(ws, "subscribe", {"channels": self.channels})
+
+    def on_close(self, ws, *args):
+        self.book.disconnected(self.name)
+
+    def on_message(self, ws, message):
+        message = json.loads(message)
+        method = message.get("method")
+        self.book.seen(self.name)
+
+        if method == "public/heartbeat":
+            ws.send(json.dumps({"id": message["id"], "method": "public/respond-heartbeat"}))
+
+        elif method == "public/auth":
+            if message.get("code") == 0:
+                self.send(ws, "subscribe", {"channels": self.channels})
+            else:
+                current_time(True)
+                print(colored("Could not authenticate the user stream: {}".format(message), "red"))
+                self.stop_now = True
+                ws.close()
+
+        elif method == "subscribe" and "result" in message:
+            result = message["result"]
+            if result.get("channel") == "ticker":
+                for ticker in result.get("data", []):
+                    self.book.update_ticker(result["instrument_name"], ticker)
+                if functions.ticker_listeners:
+                    functions.publish_tickers([dict(ticker, i=result["instrument_name"]) for ticker in result.get("data", [])])
+            elif result.get("channel") == "user.balance":
+                self.book.update_balances(result.get("data", []))
+
+
+# Starts streaming the tickers of the pairs and the balances of the account.
+# Snapshots are served from the streams from now on, with the REST API as fallback while they are stale
+def start(pairs):
+    try:
+        import websocket
+    except ImportError:
+        print(colored("Streaming needs the websocket-client package, falling back to the REST API", "yellow"))
+        return None
+
+    book = MarketBook()
+    streams = [
+        Stream("market", functions.stream_url.rstrip("/") + "/market", book, ["ticker." + pair[1] for pair in pairs]),
+    ]
+    # The balances can only be streamed for the API key of the config file, an accounts list may not have one
+    if getattr(functions, "api_key", None):
+        streams.append(Stream("user", functions.stream_url.rstrip("/") + "/user", book, ["user.balance"], authenticate=True))
+    for stream in streams:
+        stream.start()
+
+    functions.market_feed = book
+    return book
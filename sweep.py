@@ -0,0 +1,102 @@
+import argparse
+import csv
+import itertools
+import os
+import time
+from multiprocessing import Pool, shared_memory
+
+import numpy as np
+
+from backtest import Settings, add_settings_arguments, load_candles, load_precisions, simulate
+
+# Backtests every combination of a grid of settings, spread over all CPU cores.
+# The candles are loaded once into shared memory, and every worker reads them from there without a copy.
+#
+#   python3 sweep.py --data candles --rebalance-threshold 0.01:0.1:0.01 --rebalance-frequency 1,2,4,8 --output sweep.csv
+
+# The price matrix as seen by a worker process
+worker_close = None
+worker_memory = None
+
+
+# Turns "0.01,0.03,0.05" or "0.01:0.1:0.01" (start:stop:step, stop included) into a list of values
+def parse_range(text):
+    if ":" in text:
+        start, stop, step = (float(part) for part in text.split(":"))
+        count = int(round((stop - start) / step)) + 1
+        return [round(start + index * step, 10) for index in range(count)]
+    return [float(part) for part in text.split(",")]
+
+
+def attach(memory_name, shape):
+    global worker_close, worker_memory
+    worker_memory = shared_memory.SharedMemory(name=memory_name)
+    worker_close = np.ndarray(shape, dtype=np.float64, buffer=worker_memory.buf)
+
+
+def run_one(job):
+    settings, start_usdt, interval, fee, precisions = job
+    result = simulate(worker_close, settings, start_usdt, interval, fee, precisions=precisions)
+    return settings, result.final_value, result.max_drawdown, result.orders, result.turnover, result.fees
+
+
+def sweep(close, grid, start_usdt, interval, fee, processes=None, precisions=None):
+    memory = shared_memory.SharedMemory(create=True, size=close.nbytes)
+    try:
+        shared_close = np.ndarray(close.shape, dtype=np.float64, buffer=memory.buf)
+        shared_close[:] = close
+
+        jobs = [(settings, start_usdt, interval, fee, precisions) for settings in grid]
+        processes = processes or os.cpu_count()
+        chunksize = max(1, len(jobs) // (processes * 4))
+        with Pool(processes, initializer=attach, initargs=(memory.name, close.shape)) as pool:
+            return list(pool.imap_unordered(run_one, jobs, chunksize=chunksize))
+    finally:
+        memory.close()
+        memory.unlink()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Backtests a grid of PieBot settings on all CPU cores")
+    add_settings_arguments(parser)
+    parser.add_argument("--buy-order-value", default="0.5", help="Values as 0.5,1 or start:stop:step")
+    parser.add_argument("--buy-frequency", default="6")
+    parser.add_argument("--rebalance-frequency", default="1")
+    parser.add_argument("--rebalance-threshold", default="0.03")
+    parser.add_argument("--usdt-reserve", default="0.02")
+    parser.add_argument("--rank-by", default="final_value", choices=["final_value", "max_drawdown", "orders", "turnover", "fees"])
+    parser.add_argument("--processes", type=int, help="Worker processes, all CPU cores by default")
+    parser.add_argument("--top", type=int, default=10, help="How many results to print")
+    parser.add_argument("--output", default="sweep.csv", help="Writes all results, ranked, to this CSV file")
+    args = parser.parse_args()
+
+    timestamps, pairs, close = load_candles(args.data, args.pairs)
+    interval = float(np.median(np.diff(timestamps))) if len(timestamps) > 1 else 3600
+    grid = [Settings(*values) for values in itertools.product(
+        parse_range(args.buy_order_value), parse_range(args.buy_frequency), parse_range(args.rebalance_frequency),
+        parse_range(args.rebalance_threshold), parse_range(args.usdt_reserve))]
+
+    print("{} pairs, {} candles, {} combinations".format(len(pairs), len(timestamps), len(grid)))
+    started = time.perf_counter()
+    precisions = load_precisions(args.instruments, pairs) if args.instruments else None
+    results = sweep(close, grid, args.usdt, interval, args.fee, args.processes, precisions)
+    print("Simulated in {:.2f}s".format(time.perf_counter() - started))
+
+    columns = ["final_value", "max_drawdown", "orders", "turnover", "fees"]
+    metric = columns.index(args.rank_by) + 1
+    # A lower drawdown, fewer orders or lower fees rank higher, a higher value or turnover too
+    results.sort(key=lambda row: row[metric], reverse=args.rank_by in ("final_value", "turnover"))
+
+    with open(args.output, "w", newline="") as output:
+        writer = csv.writer(output)
+        writer.writerow(["rank"] + list(Settings._fields) + columns)
+        for rank, row in enumerate(results, 1):
+            writer.writerow([rank] + list(row[0]) + list(row[1:]))
+
+    print("{:>4s} {:>8s} {:>6s} {:>6s} {:>9s} {:>7s} {:>12s} {:>9s} {:>7s}".format(
+        "rank", "buy", "buy h", "reb h", "threshold", "reserve", "final value", "drawdown", "orders"))
+    for rank, row in enumerate(results[:args.top], 1):
+        settings = row[0]
+        print("{:>4d} {:>8.2f} {:>6g} {:>6g} {:>9.3f} {:>7.3f} {:>12.2f} {:>9.2%} {:>7d}".format(
+            rank, settings.buy_order_value, settings.buy_frequency, settings.rebalance_frequency,
+            settings.rebalance_threshold, settings.usdt_reserve, row[1], row[2], row[3]))
@@ -0,0 +1,43 @@
+import os
+import sys
+import tempfile
+import pytest
+
+# functions.py reads its settings from _config.py, so the tests get one of their own, like benchmark.py does.
+# Nothing is sent to the exchange: the tests that need one use the exchange fixture
+here = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+config_dir = tempfile.mkdtemp(prefix="piebot-tests-")
+
+with open(os.path.join(config_dir, "_config.py"), "w") as config:
+    config.write('''account_name = "tests"
+environment = "dev"
+api_key = "key"
+api_secret = "secret"
+pair_list = [("BTC", "BTC_USDT"), ("ETH", "ETH_USDT"), ("CRO", "CRO_USD")]
+buy_frequency = 1
+rebalance_frequency = 1
+rebalance_threshold = 0.03
+buy_order_value = 0.50
+usdt_reserve = 0.02
+''')
+
+os.environ["EXCHANGE_URL"] = "http://127.0.0.1:9/exchange/v1/"
+sys.path.insert(0, here)
+sys.path.insert(0, config_dir)
+
+
+# A mock exchange, with the shared client, instruments and tickers of functions.py pointed at it
+@pytest.fixture
+def exchange(monkeypatch):
+    import functions
+    import mock_exchange
+
+    exchange = mock_exchange.MockExchange({"BTC_USDT": 30000.0, "ETH_USDT": 2000.0, "CRO_USD": 0.1}, {"USDT": 100.0, "ETH": 1.0})
+    url = exchange.start()
+    exchange.client = functions.ExchangeClient(base_url=url, key="key", secret="secret")
+    monkeypatch.setattr(functions, "client", exchange.client)
+    monkeypatch.setattr(functions, "instruments", functions.InstrumentRegistry(cache_file=None))
+    monkeypatch.setattr(functions, "tickers", functions.TickerCache())
+    yield exchange
+    exchange.stop()
+    exchange.client.close()
@@ -0,0 +1,30 @@
+import asyncio
+import threading
+from types import SimpleNamespace
+import asyncruntime
+import functions
+
+
+def account(name, exchange_client, ready=True):
+    account = SimpleNamespace(name=name, client=exchange_client, pair_list=[("ETH", "ETH_USDT")], ready=threading.Event())
+    if ready:
+        account.ready.set()
+    return account
+
+
+def test_stale_snapshots_are_refreshed_at_the_same_time(exchange, monkeypatch):
+    monkeypatch.setattr(asyncruntime, "tickers", functions.tickers)
+    rejected = functions.ExchangeClient(base_url=exchange.client.base_url, key="other", secret="other")
+    accounts = [account("main", exchange.client), account("waiting", exchange.client, ready=False), account("rejected", rejected),
+                account("fresh", exchange.client)]
+    ages = {"main": 400, "waiting": 400, "rejected": 400, "fresh": 10}
+    refreshed = []
+
+    asyncio.run(asyncruntime.refresh_snapshots(accounts, lambda account: ages[account.name],
+                                               lambda account, snapshot: refreshed.append((account.name, snapshot)), 300))
+    rejected.close()
+
+    assert [(name, snapshot.balances) for name, snapshot in refreshed] == [("main", {"USDT": 100.0, "ETH": 1.0})]
+    assert refreshed[0][1].prices["ETH_USDT"] == 1999.0
+    # Both accounts asked for their balances, and shared one download of the tickers
+    assert exchange.stats["by_method"]["public/get-tickers"] == 1
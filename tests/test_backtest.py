@@ -0,0 +1,54 @@
+import json
+import numpy as np
+import pytest
+import backtest
+from backtest import Settings, load_precisions, rebalance_orders, simulate
+from planner import plan_rebalance
+
+never = Settings(buy_order_value=1.0, buy_frequency=0, rebalance_frequency=0, rebalance_threshold=0.03, usdt_reserve=0.02)
+
+
+def test_the_rebalance_is_planned_like_piebot_plans_it():
+    holdings = np.array([0.0123456, 2.0, 30.0])
+    prices = np.array([30000.0, 100.0, 1.0])
+    precisions = {0: (2, 5), 1: (2, 2), 2: (6, 0)}
+    plan = rebalance_orders(holdings, prices, 0.03, precisions)
+
+    pairs = [("BTC", "BTC_USDT"), ("ETH", "ETH_USDT"), ("CRO", "CRO_USDT")]
+    expected = plan_rebalance(pairs, dict(zip(["BTC", "ETH", "CRO"], holdings)), dict(zip(["BTC_USDT", "ETH_USDT", "CRO_USDT"], prices)),
+                              {"BTC_USDT": (2, 5), "ETH_USDT": (2, 2), "CRO_USDT": (6, 0)}, 0.03, backtest.min_order_value)
+    assert [(order.pair, order.side, order.amount) for order in plan.sells + plan.buys] == \
+        [(pairs.index((order.coin, order.pair)), order.side, order.amount) for order in expected.sells + expected.buys]
+    # The quantities are rounded to the decimals of the pair
+    assert [order.amount for order in plan.sells] == [0.00567]
+
+
+def test_a_buy_keeps_the_reserve():
+    settings = never._replace(buy_frequency=1, usdt_reserve=0.5)
+    # 2 USDT for the two coins leaves more than half of the portfolio in USDT, then the reserve stops the buys
+    result = simulate(np.full((3, 2), 10.0), settings, 4.0)
+    assert result.orders == 2
+    assert result.usdt.tolist() == [2.0, 2.0, 2.0]
+
+
+def test_the_buys_of_a_rebalance_are_fitted_to_the_usdt():
+    settings = never._replace(rebalance_frequency=1, rebalance_threshold=0)
+    # A is worth 20 and B nothing: A sells 10, which only covers the buy of B after the fee
+    result = simulate(np.array([[10.0, 10.0]]), settings, 0.0, fee=0.01, start_holdings=[2.0, 0.0])
+    assert result.orders == 2
+    assert result.usdt[0] == pytest.approx(0.0)
+    assert result.fees == pytest.approx(0.1 + 0.099)
+
+
+def test_nothing_trades_without_a_task(tmp_path):
+    result = simulate(np.full((3, 2), 10.0), never, 100.0, start_holdings=[1.0, 2.0])
+    assert result.orders == 0
+    assert result.values.tolist() == [130.0] * 3
+    assert result.max_drawdown == 0.0
+
+
+def test_the_precisions_are_read_from_the_instruments(tmp_path):
+    path = tmp_path / "instruments.json"
+    path.write_text(json.dumps([{"symbol": "BTC_USDT", "quote_decimals": 2, "quantity_decimals": 5},
+                                {"symbol": "CRO_USD", "quote_decimals": 6, "quantity_decimals": 0}]))
+    assert load_precisions(str(path), ["CRO_USDT", "XYZ_USDT", "BTC_USDT"]) == {0: (6, 0), 2: (2, 5)}
@@ -0,0 +1,167 @@
+import time
+from collections import deque
+import pytest
+import functions
+import mock_exchange
+from functions import CircuitBreaker, CircuitOpenError, InstrumentRegistry, TokenBucket, rate_limit_group
+
+
+def test_instruments_are_downloaded_once(exchange):
+    registry = InstrumentRegistry(ttl=3600, cache_file=None)
+    assert registry.get("BTC_USDT")["quantity_decimals"] == 5
+    # There is no CRO_USDT, only CRO_USD
+    assert registry.get("CRO_USDT")["symbol"] == "CRO_USD"
+    assert exchange.stats["by_method"]["public/get-instruments"] == 1
+
+
+def test_expired_instruments_are_downloaded_again(exchange):
+    registry = InstrumentRegistry(ttl=3600, cache_file=None)
+    registry.get("BTC_USDT")
+    registry.loaded_at -= 3600
+    registry.get("BTC_USDT")
+    assert exchange.stats["by_method"]["public/get-instruments"] == 2
+
+
+def test_an_unknown_instrument_is_looked_for_at_most_once_a_minute(exchange):
+    registry = InstrumentRegistry(ttl=3600, cache_file=None)
+    assert registry.get("XYZ_USDT") is None
+    assert registry.get("XYZ_USDT") is None
+    assert exchange.stats["by_method"]["public/get-instruments"] == 1
+
+    registry.loaded_at -= InstrumentRegistry.min_refresh_interval
+    exchange.prices["XYZ_USDT"] = 1.0
+    assert registry.get("XYZ_USDT")["symbol"] == "XYZ_USDT"
+    assert exchange.stats["by_method"]["public/get-instruments"] == 2
+
+
+def test_instruments_are_read_from_a_recent_cache_file(exchange, tmp_path):
+    cache_file = str(tmp_path / "instruments.json")
+    InstrumentRegistry(ttl=3600, cache_file=cache_file).get("BTC_USDT")
+    assert InstrumentRegistry(ttl=3600, cache_file=cache_file).get("ETH_USDT")["symbol"] == "ETH_USDT"
+    assert exchange.stats["by_method"]["public/get-instruments"] == 1
+
+    InstrumentRegistry(ttl=3600, cache_file=cache_file).invalidate()
+    assert not (tmp_path / "instruments.json").exists()
+
+
+@pytest.mark.parametrize("method, group", [
+    ("public/get-tickers", "public"),
+    ("private/user-balance", "private"),
+    ("private/create-order", "order"),
+    ("private/create-order-list", "order"),
+    ("private/cancel-all-orders", "order"),
+    ("private/get-order-detail", "order_detail"),
+])
+def test_rate_limit_groups(method, group):
+    assert rate_limit_group(method) == group
+
+
+def test_a_bucket_allows_a_burst_then_its_rate():
+    bucket = TokenBucket(100)
+    started = time.monotonic()
+    for request in range(20):
+        bucket.acquire()
+    # The first 10 are the burst, the next 10 take 0.1s
+    assert 0.08 <= time.monotonic() - started < 0.5
+
+
+def test_a_paused_bucket_hands_out_nothing():
+    bucket = TokenBucket(10)
+    assert bucket.try_acquire()
+    assert not bucket.try_acquire()
+
+    bucket = TokenBucket(1000)
+    bucket.pause(60)
+    assert not bucket.try_acquire()
+
+
+def test_a_rate_limited_request_is_sent_again(exchange):
+    exchange.rate_limits["public"] = mock_exchange.RateLimit(1)
+    assert exchange.client.public("public/get-tickers").status_code == 200
+    started = time.monotonic()
+    # The exchange asks to wait a second before the next one
+    assert exchange.client.public("public/get-tickers").status_code == 200
+    assert time.monotonic() - started >= 1
+    assert exchange.stats["rate_limited"] >= 1
+
+
+def record(breaker, outcomes):
+    for failed in outcomes:
+        breaker.record(failed)
+
+
+@pytest.mark.parametrize("outcomes, allowed", [
+    ([], True),
+    # Too few requests to judge
+    ([True] * 4, True),
+    ([True, False, True, False, False], True),
+    ([True, False, True, False, True], False),
+    ([True] * 5, False),
+])
+def test_circuit_breaker_opens_at_the_error_rate(outcomes, allowed):
+    breaker = CircuitBreaker("public/get-tickers", error_rate=0.5, min_requests=5, open_seconds=30)
+    record(breaker, outcomes)
+    assert breaker.allow() == allowed
+
+
+def test_circuit_breaker_lets_one_request_try_again():
+    breaker = CircuitBreaker("public/get-tickers", min_requests=1, open_seconds=0)
+    breaker.record(True)
+    # A request sent before the breaker opened doesn't close it
+    breaker.record(False)
+    assert breaker.opened_at is not None
+
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.record(True)
+    assert breaker.opened_at is not None
+
+    assert breaker.allow()
+    breaker.record(False)
+    assert breaker.opened_at is None
+    assert breaker.allow() and breaker.allow()
+
+
+def test_a_failing_endpoint_is_held_back(exchange, monkeypatch):
+    monkeypatch.setattr(functions, "circuit_breakers", {})
+    exchange.error_rate = 1.0
+    for request in range(functions.circuit_min_requests):
+        assert exchange.client.private("private/user-balance").status_code == 500
+    with pytest.raises(CircuitOpenError):
+        exchange.client.private("private/user-balance")
+    assert exchange.stats["errors"] == functions.circuit_min_requests
+    # The breakers are per endpoint
+    exchange.error_rate = 0.0
+    assert exchange.client.public("public/get-tickers").status_code == 200
+
+
+# Makes the first request of the exchange take the given seconds
+def slow_first(exchange, seconds):
+    requests_seen = []
+
+    def wait():
+        requests_seen.append(None)
+        if len(requests_seen) == 1:
+            time.sleep(seconds)
+
+    exchange.wait = wait
+
+
+def test_a_slow_public_request_is_sent_again(exchange):
+    exchange.client.latencies["public/get-tickers"] = deque([0.01] * 20)
+    slow_first(exchange, 1)
+    started = time.monotonic()
+    assert exchange.client.public("public/get-tickers").status_code == 200
+    # The second request answered first
+    assert time.monotonic() - started < 0.8
+    time.sleep(1)
+    assert exchange.stats["by_method"]["public/get-tickers"] == 2
+
+
+def test_requests_are_not_hedged_before_their_response_times_are_known(exchange):
+    slow_first(exchange, 0.3)
+    started = time.monotonic()
+    assert exchange.client.public("public/get-tickers").status_code == 200
+    assert time.monotonic() - started >= 0.3
+    assert exchange.stats["by_method"]["public/get-tickers"] == 1
+    assert len(exchange.client.latencies["public/get-tickers"]) == 1
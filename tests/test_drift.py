@@ -0,0 +1,72 @@
+import pytest
+from drift import DriftMonitor
+from functions import PortfolioSnapshot
+
+
+class Account:
+    name = "tests"
+    rebalance_threshold = 0.1
+    pair_list = [("A", "A_USDT"), ("B", "B_USDT"), ("C", "C_USDT"), ("D", "D_USDT")]
+
+
+def ticker(pair, price):
+    return {"i": pair, "b": str(price)}
+
+
+# A monitor of four coins worth 100 each, and the (coins, max_orders) of every Rebalance it starts
+@pytest.fixture
+def monitor():
+    started = []
+    monitor = DriftMonitor(Account(), lambda account, coins, max_orders: started.append((coins, max_orders)), cooldown=0, max_orders=3)
+    monitor.started = started
+    monitor.observe(PortfolioSnapshot({"A": 1.0, "B": 1.0, "C": 1.0, "D": 1.0}, {pair: 100.0 for coin, pair in Account.pair_list}))
+    return monitor
+
+
+def test_nothing_starts_on_target(monitor):
+    assert monitor.started == []
+    assert monitor.crossing == set()
+
+
+def test_prices_before_a_snapshot_are_ignored():
+    started = []
+    monitor = DriftMonitor(Account(), lambda *args: started.append(args))
+    monitor.update([ticker("A_USDT", 1000)])
+    assert started == []
+
+
+def test_a_coin_over_the_threshold_starts_a_rebalance(monitor):
+    # A is worth 115 and the target 103.75, 10.8% over it
+    monitor.update([ticker("A_USDT", 115)])
+    assert monitor.started == [(["A"], 3)]
+
+
+def test_a_batch_is_checked_once_all_its_prices_are_in(monitor):
+    # With A and B at 115, the target is 107.5 and neither is 10% off it
+    monitor.update([ticker("A_USDT", 115), ticker("B_USDT", 115)])
+    assert monitor.started == []
+
+
+def test_coins_back_in_range_are_dropped_before_starting(monitor):
+    monitor.update([ticker("A_USDT", 115)])
+    # B catches up while the first Rebalance runs, which takes A back within the threshold
+    monitor.update([ticker("B_USDT", 115)])
+    monitor.finished(1)
+    monitor.update([ticker("C_USDT", 100)])
+    assert monitor.started == [(["A"], 3)]
+
+
+def test_the_target_moving_past_the_bounds_rescans(monitor):
+    # Every price but D's rises, so D falls under the target without a price of its own
+    monitor.update([ticker("A_USDT", 120), ticker("B_USDT", 120), ticker("C_USDT", 120)])
+    assert monitor.started == [(["D"], 3)]
+
+
+def test_the_orders_cap_is_shared_by_the_window(monitor):
+    monitor.update([ticker("A_USDT", 115)])
+    monitor.finished(2)
+    monitor.update([ticker("B_USDT", 130)])
+    monitor.finished(1)
+    monitor.update([ticker("C_USDT", 150)])
+    assert [max_orders for coins, max_orders in monitor.started] == [3, 1]
+    assert monitor.capped
@@ -0,0 +1,76 @@
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+from types import SimpleNamespace
+import pytest
+import health
+# Registers the request metrics, as PieBot does in production
+import metrics
+from functions import Order
+
+
+def account(name):
+    return SimpleNamespace(name=name, ready=threading.Event())
+
+
+# A bot state of two accounts, served on a free port
+@pytest.fixture
+def served():
+    state = health.BotState([account("main"), account("savings")], heartbeat_timeout=60)
+    server = health.serve(state, port=0, address="127.0.0.1")
+    yield state, "http://127.0.0.1:{}".format(server.server_port)
+    server.shutdown()
+    server.server_close()
+
+
+def get(url):
+    try:
+        with urllib.request.urlopen(url, timeout=5) as response:
+            return response.status, response.read()
+    except urllib.error.HTTPError as error:
+        return error.code, error.read()
+
+
+def test_alive_while_the_loop_beats(served):
+    state, url = served
+    # Still starting
+    assert get(url + "/healthz")[0] == 200
+    state.beat()
+    assert get(url + "/healthz")[0] == 200
+    state.heartbeat_at = time.time() - 61
+    status, body = get(url + "/healthz")
+    assert status == 503
+    assert json.loads(body)["alive"] is False
+
+
+def test_ready_once_an_account_is_ready(served):
+    state, url = served
+    assert get(url + "/readyz")[0] == 503
+    state.accounts[1].ready.set()
+    status, body = get(url + "/readyz")
+    assert status == 200
+    assert json.loads(body)["accounts"] == {"main": False, "savings": True}
+
+
+def test_the_state_shows_orders_on_their_way_and_errors(served):
+    state, url = served
+    key = state.orders_sent("buy", "main", [Order("BTC", "BTC_USDT", "BUY", 10.0, 10.0)])
+    state.error("rebalance", "savings", ValueError("no prices"))
+    state.succeeded("buy", "savings")
+
+    body = json.loads(get(url + "/state")[1])
+    assert [order["orders"] for order in body["in_flight_orders"]] == [[{"coin": "BTC", "pair": "BTC_USDT", "side": "BUY", "amount": 10.0}]]
+    assert [(error["task"], error["error"]) for error in body["errors"]] == [("rebalance", "ValueError('no prices')")]
+    assert list(body["accounts"]["savings"]["last_success"]) == ["buy"]
+
+    state.orders_done(key)
+    assert json.loads(get(url + "/state")[1])["in_flight_orders"] == []
+
+
+def test_the_metrics_are_served_next_to_them(served):
+    state, url = served
+    status, body = get(url + "/metrics")
+    assert status == 200
+    assert b"# HELP exchange_requests_total" in body
@@ -0,0 +1,37 @@
+import pytest
+from prometheus_client import REGISTRY
+import functions
+import metrics
+from functions import Fill, Order, OrderResult
+
+
+def observed(side, account):
+    return REGISTRY.get_sample_value("order_slippage_ratio_count", {"side": side, "account": account}) or 0
+
+
+@pytest.mark.parametrize("order, fill, ratio", [
+    (Order("BTC", "BTC_USDT", "BUY", 10.0, 10.0, 100.0), Fill("FILLED", 0.1, 101.0, 10.0), 0.01),
+    (Order("BTC", "BTC_USDT", "SELL", 0.1, 10.0, 100.0), Fill("FILLED", 0.1, 101.0, 10.0), -0.01),
+    # Without a planned price or a fill price there is nothing to compare
+    (Order("BTC", "BTC_USDT", "BUY", 10.0, 10.0), Fill("FILLED", 0.1, 101.0, 10.0), None),
+    (Order("BTC", "BTC_USDT", "BUY", 10.0, 10.0, 100.0), None, None),
+])
+def test_order_slippage(order, fill, ratio):
+    assert metrics.order_slippage(order, fill) == (None if ratio is None else pytest.approx(ratio))
+
+
+def test_only_the_orders_with_a_fill_price_are_observed():
+    order = Order("BTC", "BTC_USDT", "BUY", 10.0, 10.0, 100.0)
+    before = observed("BUY", "slippage")
+    metrics.observe_fills([OrderResult(order, True, 200, "OK", 1, b"", Fill("FILLED", 0.1, 100.5, 10.05)),
+                           OrderResult(order, True, 200, "OK", 2, b""),
+                           OrderResult(order, False, 400, "Bad Request", None, b"")], "slippage")
+    assert observed("BUY", "slippage") == before + 1
+
+
+def test_dev_mode_keeps_no_metrics():
+    # The tests run in dev mode, where the stand-in takes every call metrics.py takes
+    assert isinstance(functions.metrics, functions.NoMetrics)
+    with functions.metrics.phase("buy", "fetch", "tests"):
+        functions.metrics.circuit_open.labels("public/get-tickers").set(1)
+        functions.metrics.observe_request("public/get-tickers", "200", 0.1)
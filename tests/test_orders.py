@@ -0,0 +1,93 @@
+import threading
+import time
+import pytest
+import functions
+import mock_exchange
+from functions import Order, OrderDispatcher, OrderTracker, params_to_str
+
+orders = [Order("BTC", "BTC_USDT", "BUY", 10.0, 10.0), Order("ETH", "ETH_USDT", "SELL", 0.5, 1000.0),
+          Order("ETH", "ETH_USDT", "SELL", 5.0, 10000.0), Order("XYZ", "XYZ_USDT", "BUY", 10.0, 10.0)]
+
+
+# Makes every request of the exchange take a while, and counts how many are answered at the same time
+def slow_down(exchange, seconds):
+    lock = threading.Lock()
+    exchange.in_flight = 0
+    exchange.most_in_flight = 0
+
+    def wait():
+        with lock:
+            exchange.in_flight += 1
+            exchange.most_in_flight = max(exchange.most_in_flight, exchange.in_flight)
+        time.sleep(seconds)
+        with lock:
+            exchange.in_flight -= 1
+
+    exchange.wait = wait
+
+
+def test_orders_are_sent_at_the_same_time(exchange):
+    # The instruments are downloaded before the first order
+    functions.instruments.get("BTC_USDT")
+    slow_down(exchange, 0.1)
+
+    results = OrderDispatcher(concurrency=4, exchange=exchange.client).submit(orders)
+    # The results are in the order of the orders, whatever order they were answered in
+    assert [(result.order, result.confirmed) for result in results] == [(orders[0], True), (orders[1], True), (orders[2], False), (orders[3], False)]
+    assert results[2].status_code == 400
+    assert results[3].reason == "Unknown instrument"
+    assert exchange.most_in_flight == 3
+
+
+def test_a_dry_run_sends_nothing(exchange):
+    results = OrderDispatcher(exchange=exchange.client).submit(orders, dry_run=True)
+    assert [(result.confirmed, result.reason) for result in results] == [(True, "Dry run")] * 4
+    assert exchange.stats["requests"] == 0
+
+
+@pytest.mark.parametrize("params, expected", [
+    ({}, ""),
+    ({"b": 1, "a": None}, "anullb1"),
+    ({"ids": [3, 1, 2]}, "ids312"),
+    # The orders of a list are signed key by key, in sorted order
+    ({"order_list": [{"side": "BUY", "instrument_name": "A_USDT"}, {"side": "SELL", "instrument_name": "B_USDT"}], "contingency_type": "LIST"},
+     "contingency_typeLISTorder_listinstrument_nameA_USDTsideBUYinstrument_nameB_USDTsideSELL"),
+    # Deeper than that, a value is signed as it is printed
+    ({"a": [{"b": [{"c": [{"d": 1}]}]}]}, "abc{'d': 1}"),
+])
+def test_params_to_str(params, expected):
+    assert params_to_str(params) == expected
+    # The mock exchange checks signatures with a copy of its own
+    assert mock_exchange.params_to_str(params) == expected
+
+
+def test_a_batch_is_sent_in_lists(exchange):
+    many = [Order("ETH", "ETH_USDT", "SELL", 0.01, 20.0)] * 12 + orders
+    results = OrderDispatcher(exchange=exchange.client).submit(many, batch=True)
+    assert [result.confirmed for result in results] == [True] * 14 + [False, False]
+    # Every order of a list has an outcome of its own
+    assert results[14].reason == "INSUFFICIENT_AVAILABLE_BALANCE"
+    assert results[15].reason == "Unknown instrument"
+    # 15 orders with a known instrument fit in two lists
+    assert exchange.stats["by_method"]["private/create-order-list"] == 2
+    assert "private/create-order" not in exchange.stats["by_method"]
+
+
+def test_the_fills_are_followed(exchange):
+    results = OrderDispatcher(exchange=exchange.client).submit(orders)
+    results = OrderTracker(timeout=5, exchange=exchange.client).wait(results)
+    assert [result.fill.status if result.fill else None for result in results] == ["FILLED", "FILLED", None, None]
+    assert results[1].fill.quantity == pytest.approx(0.5)
+    assert results[1].fill.avg_price == pytest.approx(1999.0)
+    # One request for each confirmed order, as they were filled straight away
+    assert exchange.stats["by_method"]["private/get-order-detail"] == 2
+
+
+def test_an_open_order_is_followed_until_the_timeout(exchange):
+    results = OrderDispatcher(exchange=exchange.client).submit(orders[:1])
+    exchange.orders[str(results[0].order_id)]["status"] = "ACTIVE"
+    started = time.monotonic()
+    results = OrderTracker(timeout=0.5, poll_interval=0.1, exchange=exchange.client).wait(results)
+    assert results[0].fill.status == "ACTIVE"
+    assert 0.3 <= time.monotonic() - started < 2
+    assert exchange.stats["by_method"]["private/get-order-detail"] >= 3
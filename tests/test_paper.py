@@ -0,0 +1,61 @@
+import pytest
+from functions import Order, OrderDispatcher
+from paper import Ledger, Market, PaperClient
+
+
+def test_the_market_takes_the_middle_of_bid_and_ask():
+    market = Market()
+    market.update({"result": {"data": [{"i": "BTC_USDT", "b": "99", "k": "101", "a": "100.5"}, {"i": "ETH_USDT", "a": "2000"}, {"i": "CRO_USDT"}]}})
+    # Without a bid and an ask, the last trade's price is used
+    assert market.prices == {"BTC_USDT": 100.0, "ETH_USDT": 2000.0}
+
+
+# A ledger of 100 USDT, with BTC at 100 and a 1% fee
+@pytest.fixture
+def paper():
+    market = Market(spread=0)
+    market.prices["BTC_USDT"] = 100.0
+    return PaperClient(Ledger(market, {"USDT": 100.0}, fee=0.01, min_order_value=1), market)
+
+
+def test_orders_fill_into_the_ledger(paper):
+    response = paper.private("private/create-order", {"instrument_name": "BTC_USDT", "side": "BUY", "type": "MARKET", "notional": "50"})
+    assert response.status_code == 200
+    assert paper.ledger.balances["USDT"] == 50.0
+    assert paper.ledger.balances["BTC"] == pytest.approx(0.495)
+    assert paper.ledger.fees == pytest.approx(0.5)
+    assert paper.ledger.value() == pytest.approx(99.5)
+
+    # The balances are read from the ledger, and follow the market's prices
+    paper.market.prices["BTC_USDT"] = 200.0
+    balances = paper.private("private/user-balance").json()["result"]["data"][0]["position_balances"]
+    assert {balance["instrument_name"]: float(balance["market_value"]) for balance in balances} == pytest.approx({"USDT": 50.0, "BTC": 99.0})
+    assert paper.ledger.value() == pytest.approx(149.0)
+
+
+@pytest.mark.parametrize("order, code", [
+    # Below the minimum order value
+    ({"instrument_name": "BTC_USDT", "side": "BUY", "type": "MARKET", "notional": "0.5"}, 213),
+    ({"instrument_name": "BTC_USDT", "side": "SELL", "type": "MARKET", "quantity": "0.005"}, 213),
+    ({"instrument_name": "BTC_USDT", "side": "SELL", "type": "MARKET", "quantity": "1"}, 306),
+    ({"instrument_name": "XYZ_USDT", "side": "BUY", "type": "MARKET", "notional": "10"}, 40004),
+])
+def test_orders_the_exchange_would_reject(paper, order, code):
+    response = paper.private("private/create-order", order)
+    assert (response.status_code, response.json()["code"]) == (400, code)
+    assert paper.ledger.balances == {"USDT": 100.0}
+    assert paper.ledger.fees == 0.0
+
+
+def test_paper_orders_never_reach_the_exchange(exchange):
+    market = Market(exchange.client)
+    paper = PaperClient(Ledger(market, {"USDT": 100.0}), market)
+    # The prices are taken from the exchange's tickers
+    assert paper.public("public/get-tickers").status_code == 200
+    assert market.prices["ETH_USDT"] == pytest.approx(2000.0)
+
+    results = OrderDispatcher(exchange=paper).submit([Order("ETH", "ETH_USDT", "BUY", 20.0, 20.0)])
+    assert results[0].confirmed
+    assert paper.ledger.balances["ETH"] == pytest.approx(20.0 / 2001.0 * (1 - 0.00075))
+    assert exchange.balances == {"USDT": 100.0, "ETH": 1.0}
+    assert not [method for method in exchange.stats["by_method"] if method.startswith("private/")]
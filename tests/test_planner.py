@@ -0,0 +1,131 @@
+import pytest
+from planner import Order, available_usdt, plan_buy, plan_rebalance, fit_to_budget, limit_orders, round_to
+
+pairs = [("A", "A_USDT"), ("B", "B_USDT")]
+
+
+def sides(orders):
+    return [(order.coin, order.side) for order in orders]
+
+
+# A is worth 110 and B 90, so the target is 100: A is 10% over it, B 11.1% under it
+@pytest.mark.parametrize("threshold, sells, buys", [
+    (None, [("A", "SELL")], [("B", "BUY")]),
+    (0, [("A", "SELL")], [("B", "BUY")]),
+    (0.10, [("A", "SELL")], [("B", "BUY")]),
+    (0.11, [], [("B", "BUY")]),
+    (0.12, [], []),
+])
+def test_rebalance_threshold(threshold, sells, buys):
+    plan = plan_rebalance(pairs, {"A": 1.1, "B": 0.9}, {"A_USDT": 100.0, "B_USDT": 100.0}, rebalance_threshold=threshold)
+    assert plan.target_per_coin == pytest.approx(100)
+    assert sides(plan.sells) == sells
+    assert sides(plan.buys) == buys
+    # The deviations are reported whether or not they pass the threshold
+    assert [(deviation.coin, deviation.side) for deviation in plan.deviations] == [("A", "+"), ("B", "-")]
+
+
+@pytest.mark.parametrize("balances, prices, sells, buys, skipped", [
+    # Nothing held at all
+    ({}, {"A_USDT": 100.0, "B_USDT": 100.0}, [], [], ()),
+    # A coin without any balance is 100% under target
+    ({"A": 2.0}, {"A_USDT": 100.0, "B_USDT": 100.0}, [("A", "SELL")], [("B", "BUY")], ()),
+    # A pair without a price is skipped, but still counts towards the number of coins
+    ({"A": 2.0, "B": 2.0}, {"A_USDT": 100.0}, [("A", "SELL")], [], ("B_USDT",)),
+    # Differences below the minimum order value are no orders nor deviations
+    ({"A": 1.002, "B": 0.998}, {"A_USDT": 100.0, "B_USDT": 100.0}, [], [], ()),
+])
+def test_rebalance_edge_cases(balances, prices, sells, buys, skipped):
+    plan = plan_rebalance(pairs, balances, prices, rebalance_threshold=0.03)
+    assert sides(plan.sells) == sells
+    assert sides(plan.buys) == buys
+    assert plan.skipped == skipped
+    if not sells and not buys and not skipped:
+        assert plan.deviations == ()
+
+
+def test_rebalance_rounds_to_precision():
+    # A is worth 30 and B 9.1, so 10.45 USDT of A is sold for B
+    plan = plan_rebalance(pairs, {"A": 10.0, "B": 1.3}, {"A_USDT": 3.0, "B_USDT": 7.0}, {"A_USDT": (2, 2), "B_USDT": (0, 4)})
+    assert plan.sells[0].amount == 3.48
+    assert plan.buys[0].amount == 10.0
+    # The value is what the coin is off by, before rounding
+    assert plan.buys[0].value == pytest.approx(10.45)
+
+
+def test_rebalance_leaves_out_orders_that_round_to_nothing():
+    # 20 USDT of A is 0.0004 A, which is 0 with 3 decimals
+    plan = plan_rebalance(pairs, {"A": 0.0008}, {"A_USDT": 50000.0, "B_USDT": 1.0}, {"A_USDT": (2, 3), "B_USDT": (2, 3)})
+    assert plan.sells == ()
+    assert sides(plan.buys) == [("B", "BUY")]
+
+
+@pytest.mark.parametrize("amount, decimals, expected", [
+    (1.23456, None, 1.23456),
+    (1.23456, 2, 1.23),
+    (1.235, 0, 1.0),
+    (0.0004, 3, 0.0),
+])
+def test_round_to(amount, decimals, expected):
+    assert round_to(amount, decimals) == expected
+
+
+def test_buy_plans_the_same_value_of_every_coin():
+    orders = plan_buy(pairs, 0.555, {"A_USDT": (2, 4)}, {"A_USDT": 3.0})
+    assert [(order.coin, order.side, order.amount, order.value, order.price) for order in orders] == [
+        ("A", "BUY", 0.56, 0.555, 3.0),
+        ("B", "BUY", 0.555, 0.555, None),
+    ]
+
+
+def buy(coin, amount):
+    return Order(coin, coin + "_USDT", "BUY", amount, amount)
+
+
+@pytest.mark.parametrize("budget, expected", [
+    # Within the budget nothing changes
+    (30.0, [("A", 10.0), ("B", 20.0)]),
+    (31.0, [("A", 10.0), ("B", 20.0)]),
+    # Shrunk in proportion
+    (15.0, [("A", 5.0), ("B", 10.0)]),
+    # A falls below the minimum order value
+    (0.6, [("B", 0.4)]),
+    # Both do
+    (0.3, []),
+    (-5.0, []),
+])
+def test_fit_to_budget(budget, expected):
+    fitted = fit_to_budget([buy("A", 10.0), buy("B", 20.0)], budget, {"A_USDT": (2, 4), "B_USDT": (2, 4)})
+    assert [(order.coin, order.amount) for order in fitted] == expected
+
+
+def test_fit_to_budget_shrinks_the_value_too():
+    fitted = fit_to_budget([buy("A", 10.0)], 2.5)
+    assert fitted[0].amount == pytest.approx(2.5)
+    assert fitted[0].value == pytest.approx(2.5)
+
+
+def test_nothing_to_fit_into_an_overdrawn_budget():
+    assert fit_to_budget([], -0.01) == ()
+
+
+def test_the_reserve_is_a_share_of_the_portfolio():
+    # 2% of a portfolio worth 1000 is kept aside
+    assert available_usdt(100.0, 1000.0, 0.02) == pytest.approx(80.0)
+
+
+def sell(coin, value):
+    return Order(coin, coin + "_USDT", "SELL", value, value)
+
+
+@pytest.mark.parametrize("max_orders, sells, buys", [
+    (None, ["A", "B", "C"], ["D", "E"]),
+    (5, ["A", "B", "C"], ["D", "E"]),
+    (3, ["A", "C"], ["E"]),
+    (1, ["C"], []),
+    (0, [], []),
+])
+def test_limit_orders_keeps_the_largest(max_orders, sells, buys):
+    kept_sells, kept_buys = limit_orders([sell("A", 5), sell("B", 1), sell("C", 9)], [buy("D", 2), buy("E", 7)], max_orders)
+    assert [order.coin for order in kept_sells] == sells
+    assert [order.coin for order in kept_buys] == buys
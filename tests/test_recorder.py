@@ -0,0 +1,66 @@
+import math
+import os
+import pytest
+import recorder
+
+# 2024-05-01 23:59:00 UTC
+evening = 1714607940
+
+
+def ticker(pair, seconds, bid=None, last=None):
+    return {"i": pair, "t": seconds * 1000, "b": bid, "k": None if bid is None else bid + 1, "a": last}
+
+
+@pytest.fixture
+def directory(tmp_path):
+    ticks = recorder.TickRecorder(str(tmp_path), ["BTC_USDT", "ETH_USDT"])
+    ticks.record([ticker("BTC_USDT", evening, 100), ticker("ETH_USDT", evening, last=10), ticker("CRO_USDT", evening, 1)])
+    # The same tickers, downloaded by another task, and an older one are not written again
+    ticks.record([ticker("BTC_USDT", evening, 100), ticker("ETH_USDT", evening - 30, 9)])
+    # Past midnight
+    ticks.record([ticker("BTC_USDT", evening + 90, 102), ticker("ETH_USDT", evening + 90, 11)])
+    ticks.close()
+    return str(tmp_path)
+
+
+def test_the_ticks_are_written_per_day(directory):
+    assert recorder.days(directory) == ["2024-05-01", "2024-05-02"]
+    assert recorder.pairs(directory) == ["BTC_USDT", "ETH_USDT"]
+
+    ticks = recorder.read_day(directory, "ETH_USDT", "2024-05-01")
+    assert len(ticks) == 1
+    assert ticks["time"][0] == evening * 1000
+    assert math.isnan(ticks["bid"][0]) and ticks["last"][0] == 10
+    assert len(recorder.read_day(directory, "CRO_USDT", "2024-05-01")) == 0
+
+
+def test_the_ticks_are_read_between_two_times(directory):
+    assert recorder.read(directory, "BTC_USDT")["bid"].tolist() == [100, 102]
+    assert recorder.read(directory, "BTC_USDT", start=evening + 1)["bid"].tolist() == [102]
+    assert recorder.read(directory, "BTC_USDT", end=evening + 89)["bid"].tolist() == [100]
+    assert len(recorder.read(directory, "BTC_USDT", start=evening + 91)) == 0
+    # The price is the bid, or the last trade's price without one
+    assert recorder.tick_prices(recorder.read(directory, "ETH_USDT")).tolist() == [10, 11]
+
+
+def test_the_prices_are_sampled_like_candles(directory):
+    timestamps, pairs, close = recorder.load_prices(directory, interval=30)
+    assert timestamps.tolist() == [evening, evening + 30, evening + 60, evening + 90]
+    assert pairs == ["BTC_USDT", "ETH_USDT"]
+    # Every sample is the latest price at that moment
+    assert close.tolist() == [[100, 10], [100, 10], [100, 10], [102, 11]]
+
+    with pytest.raises(ValueError):
+        recorder.load_prices(directory, ["CRO_USDT"])
+
+
+def test_half_a_tick_left_by_a_crash_is_dropped(directory):
+    path = os.path.join(directory, "2024-05-02", "BTC_USDT" + recorder.extension)
+    with open(path, "ab") as handle:
+        handle.write(b"\0" * 10)
+
+    ticks = recorder.TickRecorder(directory)
+    ticks.record([ticker("BTC_USDT", evening + 120, 103)])
+    ticks.close()
+    assert os.path.getsize(path) == 2 * recorder.tick_dtype.itemsize
+    assert recorder.read(directory, "BTC_USDT")["bid"].tolist() == [100, 102, 103]
@@ -0,0 +1,70 @@
+import sqlite3
+import pytest
+from functions import Fill, Order, OrderResult, PortfolioSnapshot
+from store import Store
+
+pairs = [("BTC", "BTC_USDT"), ("ETH", "ETH_USDT")]
+
+
+def snapshot(taken_at, btc_price):
+    return PortfolioSnapshot({"BTC": 0.5, "USDT": 20.0}, {"BTC_USDT": btc_price, "ETH_USDT": 2000.0}, taken_at)
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "state.db")
+
+
+def test_snapshots_are_read_back_per_account(path):
+    main = Store(path, "main", flush_interval=0.01)
+    savings = Store(path, "savings", flush_interval=0.01)
+    main.record_snapshot(snapshot(100, 30000.0), pairs)
+    main.record_snapshot(snapshot(200, 32000.0), pairs)
+    savings.record_snapshot(snapshot(150, 31000.0), pairs)
+    main.flush()
+    savings.flush()
+
+    assert main.value_history("BTC_USDT") == [(100, 0.5, 30000.0, 15000.0), (200, 0.5, 32000.0, 16000.0)]
+    assert main.value_history("BTC_USDT", since=150) == [(200, 0.5, 32000.0, 16000.0)]
+    assert main.value_history("BTC_USDT", account="savings") == [(150, 0.5, 31000.0, 15500.0)]
+    assert sorted(main.last_positions()) == [("BTC", "BTC_USDT", 0.5, 32000.0, 16000.0, 200), ("ETH", "ETH_USDT", 0.0, 2000.0, 0.0, 200),
+                                             ("USDT", None, 20.0, 1.0, 20.0, 200)]
+    main.close()
+    savings.close()
+
+
+def test_orders_and_fills_are_recorded(path):
+    history = Store(path, "main", flush_interval=0.01)
+    order = Order("BTC", "BTC_USDT", "BUY", 10.0, 10.0)
+    history.record_plan("buy", [order])
+    history.record_orders("buy", [OrderResult(order, True, 200, "OK", 42, b'{"code": 0}', Fill("FILLED", 0.0003, 30000.0, 9.0)),
+                                  OrderResult(order, False, 400, "Bad Request", None, b'{"code": 306}')])
+    history.flush()
+
+    orders = history.orders_since(0, "BTC_USDT")
+    assert [(row[2], row[8], row[11], row[12]) for row in orders] == [("buy", 1, "42", '{"code": 0}'), ("buy", 0, None, '{"code": 306}')]
+    assert history.orders_since(0, "ETH_USDT") == []
+    assert history.query("SELECT order_id, status, quantity FROM fills") == [("42", "FILLED", 0.0003)]
+    assert history.query("SELECT COUNT(*) FROM planned_orders") == [(1,)]
+    history.close()
+
+
+def test_a_state_file_that_cant_be_opened_is_reported(tmp_path):
+    with pytest.raises(sqlite3.Error):
+        Store(str(tmp_path / "missing" / "state.db"), "main")
+
+
+def test_a_batch_that_cant_be_written_is_dropped(path):
+    history = Store(path, "main", flush_interval=0.01)
+    history.put("INSERT INTO missing VALUES (?)", [(1,)])
+    history.flush()
+    assert history.dropped == 1
+
+    # The writer carries on
+    history.record_snapshot(snapshot(100, 30000.0), pairs)
+    history.flush()
+    assert len(history.value_history("BTC_USDT")) == 1
+
+    history.close()
+    history.record_snapshot(snapshot(200, 30000.0), pairs)
+    assert history.dropped == 4
@@ -0,0 +1,74 @@
+import time
+import pytest
+import stream
+
+pairs = [("BTC", "BTC_USDT"), ("ETH", "ETH_USDT")]
+
+
+# A book with fresh streams, balances and a ticker of every pair
+@pytest.fixture
+def book():
+    book = stream.MarketBook()
+    book.seen("market")
+    book.seen("user")
+    book.update_balances([{"position_balances": [{"instrument_name": "USDT", "quantity": "10", "max_withdrawal_balance": "10"}]}])
+    book.update_ticker("BTC_USDT", {"i": "BTC_USDT", "b": "100", "k": "101", "a": "100.5"})
+    book.update_ticker("ETH_USDT", {"i": "ETH_USDT", "a": "10"})
+    return book
+
+
+def test_a_snapshot_of_fresh_data(book):
+    snapshot = book.snapshot(pairs, 60)
+    assert snapshot.prices == {"BTC_USDT": 100.0, "ETH_USDT": 10.0}
+    assert snapshot.balance("USDT") == 10.0
+
+
+def test_the_bid_and_ask_are_kept(book):
+    assert book.quote("BTC_USDT", 60)[:3] == (100.0, 101.0, 100.0)
+    # Without a bid, the last trade's price is used
+    assert book.quote("ETH_USDT", 60)[:3] == (None, None, 10.0)
+    assert book.quote("CRO_USDT", 60) is None
+
+
+def age(book, pair, seconds):
+    book.prices[pair] = book.prices[pair]._replace(received_at=time.time() - seconds)
+
+
+def test_a_stale_price_is_missing(book):
+    age(book, "ETH_USDT", 61)
+    assert book.snapshot(pairs, 60) is None
+    assert book.quote("ETH_USDT", 60) is None
+    # The snapshot of the other pair doesn't need it
+    assert book.snapshot(pairs[:1], 60) is not None
+
+
+@pytest.mark.parametrize("change", [
+    lambda book: book.disconnected("market"),
+    lambda book: book.disconnected("user"),
+    lambda book: book.prices.pop("ETH_USDT"),
+])
+def test_no_snapshot_without_the_streams_or_a_price(book, change):
+    change(book)
+    assert book.snapshot(pairs, 60) is None
+
+
+def test_no_snapshot_before_the_balances_arrive():
+    book = stream.MarketBook()
+    book.seen("market")
+    book.seen("user")
+    book.update_ticker("BTC_USDT", {"i": "BTC_USDT", "b": "100"})
+    assert book.snapshot(pairs[:1], 60) is None
+
+
+def test_the_tickers_are_streamed(exchange):
+    book = stream.MarketBook()
+    market = stream.Stream("market", exchange.stream_url.rstrip("/") + "/market", book, ["ticker.BTC_USDT"])
+    market.start()
+    try:
+        deadline = time.time() + 10
+        while book.quote("BTC_USDT", 60) is None and time.time() < deadline:
+            time.sleep(0.1)
+    finally:
+        market.stop()
+    assert book.quote("BTC_USDT", 60).price == 29985.0
+    assert book.fresh("market", 60)
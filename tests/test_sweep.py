@@ -0,0 +1,28 @@
+import numpy as np
+import pytest
+from backtest import Settings, simulate
+from sweep import parse_range, sweep
+
+
+@pytest.mark.parametrize("text, values", [
+    ("0.5", [0.5]),
+    ("1,2,4", [1.0, 2.0, 4.0]),
+    # The stop is included, without the rounding errors of adding up the steps
+    ("0.01:0.05:0.01", [0.01, 0.02, 0.03, 0.04, 0.05]),
+])
+def test_parse_range(text, values):
+    assert parse_range(text) == values
+
+
+def test_every_combination_is_simulated_like_a_backtest():
+    rng = np.random.default_rng(1)
+    close = 100 * np.exp(np.cumsum(rng.normal(0, 0.01, (500, 3)), axis=0))
+    grid = [Settings(0.5, 6, frequency, threshold, 0.02) for frequency in (1, 4) for threshold in (0.01, 0.05)]
+    precisions = {0: (2, 4), 1: (2, 4), 2: (2, 4)}
+
+    results = sweep(close, grid, 100.0, 3600, 0.001, processes=2, precisions=precisions)
+    assert sorted(settings for settings, *outcome in results) == sorted(grid)
+    for settings, final_value, max_drawdown, orders, turnover, fees in results:
+        expected = simulate(close, settings, 100.0, 3600, 0.001, precisions=precisions)
+        assert (final_value, max_drawdown, orders, turnover, fees) == (expected.final_value, expected.max_drawdown, expected.orders,
+                                                                     expected.turnover, expected.fees)